@@ -13,11 +13,27 @@ import math
 import os
 import sys
 import platform
+import time
+import copy
+import itertools
+import operator
+import threading
+from array import array
+from collections import OrderedDict
+try:
+    from collections.abc import MutableSequence
+except ImportError:
+    from collections import MutableSequence  # Python 2
+try:
+    import queue
+except ImportError:
+    import Queue as queue  # Python 2
 
 try:
     import angles
 except ImportError:
-    sys.path.append(os.path.abspath("mgep"))  # needed for some reason
+    # (needed since not a relative import):
+    sys.path.append(os.path.dirname(os.path.abspath(__file__)))
     try:
         import angles
         print("found angles in 'mgep'")
@@ -31,6 +47,15 @@ try:
 except ImportError:
     print("ERROR: save1d library not found.")
     exit(1)
+try:
+    import chunkfile
+except ImportError:
+    print("ERROR: chunkfile library not found.")
+    exit(1)
+try:
+    import numpy as np
+except ImportError:
+    np = None  # optional (generates terrain and steps many units faster)
 square_sprite_size = None
 E_BIT = 1
 """east quartertiles of tile"""
@@ -88,8 +113,12 @@ fails to set 3.1415927 to 3.1415926 see delta_theta in KivyGlops]
 # good_45deg_tile_sizes = [(17,12), (34,24), (41,29), (58,41), (75,53),
 #                          (92,65)]
 good_45deg_tile_sizes = []
-stack_max = None
-stack_max_keys = []  # if len reaches 0, recalculate stack_max
+stack_max = 0
+"""node count of the tallest loaded stack"""
+stack_heights = {}
+"""how many loaded stacks there are of each height (node count)"""
+heights_version = 0
+"""changes whenever the height of any loaded stack changes"""
 block_rise_as_y_px = 1
 tilesets = {}
 heightmap_key = "cave"
@@ -107,16 +136,27 @@ file_surfs = {}
 surf_paths = []  # keys for file_surfs in order of loading
 materials = {}
 material_choose = [None]
+CHUNK_SHIFT = 4
+CHUNK_SIZE = 1 << CHUNK_SHIFT
+"""width and depth of a chunk in blocks (16x16)"""
+CHUNK_MASK = CHUNK_SIZE - 1
 world = {}
-"""the world is a dict of lists (multiple gobs can be on one location)
+"""the world is a dict; its stacks (lists of nodes, since multiple gobs
+can be on one location) are stored in chunks (see get_stack_at)
 """
-world['blocks'] = {}
+world['tmp'] = {}
+world['tmp']['chunks'] = {}
 # screen = None
 player_unit_name = None
 game_tile_size = None
 units = {}
 default_font = None
 default_font_size = None
+font_cache = {}
+"""
+Fonts by (name, size) (see get_font), so widgets and text using the
+same font share one pygame Font.
+"""
 popup_text = ""
 popup_showing_text = None
 popup_surf = None
@@ -131,6 +171,20 @@ bindings['swipe_angle'] = []
 nothing_y = -10.0
 checkerboard = {}
 widgets = []
+widgets_version = 0
+widget_layer = {}
+"""
+The drawing and hit-testing state of widgets, rebuilt only when the
+window size, widgets_version or the number of widgets changes (see
+_get_widget_layer):
+'win_size' -- the window size it was built for
+'version' -- widgets_version when it was built
+'count' -- len(widgets) when it was built
+'blits' -- (surface, position) for every widget that draws anything
+'grid' -- (col, row) of a 'widget_grid_px' cell: list of widgets
+          touching the cell (in the order of widgets)
+'grid_px' -- the cell size the grid was built with
+"""
 
 named_delta_vec2s = {}
 named_delta_vec2s['e'] = [1, 0]
@@ -184,6 +238,7 @@ def add_widget(pos, size, text=None, surface=None, section="main",
     f -- the function to call (must accept param e for event dict)
     f_params_dict -- the dict to send as e['custom']
     """
+    global widgets_version
     if text_pos is None:
         text_pos = (0.0, 0.0)
     widget = {}
@@ -197,20 +252,54 @@ def add_widget(pos, size, text=None, surface=None, section="main",
     widget['f'] = f
     widget['f_params_dict'] = f_params_dict
     widget['tmp'] = {}
-    if font_size is None:
-        font_size = settings['sys_font_size']
-    if font_name is None:
-        font_name = settings['sys_font_name']
     if text is not None:
         aa = font_aa
-        font = pg.font.SysFont(font_name, font_size)
+        font = get_font(name=font_name, size=font_size)
         widget['tmp']['text_surf'] = font.render(text, aa, font_color)
     widget['section'] = section
     if auto_add:
         widgets.append(widget)
+        widgets_version += 1
     return widget
 
 
+def remove_widget(widget):
+    """Remove a widget added by add_widget."""
+    global widgets_version
+    widgets.remove(widget)
+    widgets_version += 1
+
+
+def refresh_widgets():
+    """Lay out and draw every widget again next frame (call this after
+    changing a widget's values, such as 'pos' or 'border_color').
+    """
+    global widgets_version
+    for widget in widgets:
+        widget['tmp'].pop('win_size', None)
+    widgets_version += 1
+
+
+def get_font(name=None, size=None):
+    """Get a system font, loading it only the first time this name and
+    size are used.
+
+    Keyword arguments:
+    name -- (the 'sys_font_name' setting if None)
+    size -- (the 'sys_font_size' setting if None)
+    """
+    if name is None:
+        name = settings['sys_font_name']
+    if size is None:
+        size = settings['sys_font_size']
+    key = (name, int(size))  # pygame only accepts int
+    font = font_cache.get(key)
+    if font is None:
+        font = pg.font.SysFont(name, key[1])
+        font_cache[key] = font
+    return font
+
+
 def get_px_from_multipliers(screen, multipliers):
     w, h = screen.get_size()
     return (
@@ -220,10 +309,8 @@ def get_px_from_multipliers(screen, multipliers):
 
 
 def is_in_widget(screen, widget, px_vec2):
-    pos_px = get_px_from_multipliers(screen, widget['pos'])
-    size_px = get_px_from_multipliers(screen, widget['size'])
-    rect = pg.Rect(pos_px, size_px)
-    return rect.collidepoint(px_vec2)
+    layout = _get_widget_layout(screen.get_size(), widget)
+    return layout['rect'].collidepoint(px_vec2)
 
 
 def draw_outline(screen, color, rect, width=1, inflate=0,
@@ -264,18 +351,29 @@ def draw_outline(screen, color, rect, width=1, inflate=0,
         # this_rect = pg.Rect(tl, )
 
 
-def render_widget(screen, widget):
-    surf = screen
-    win_size = screen.get_size()
+def _get_widget_layout(win_size, widget):
+    """Get widget['tmp'] with the widget's pixel 'rect' and its
+    pre-rendered 'surf' (None if it draws nothing) at 'surf_pos', laying
+    it out and drawing it only if win_size changed.
+    """
+    tmp = widget['tmp']
+    if tmp.get('win_size') == win_size:
+        return tmp
     w, h = win_size
-    text_surf = widget['tmp'].get('text_surf')
+    pos_px = (round(widget['pos'][0] * float(w)),
+              round(widget['pos'][1] * float(h)))
+    size_px = (round(widget['size'][0] * float(w)),
+               round(widget['size'][1] * float(h)))
+    rect = pg.Rect(pos_px, size_px)
+    tmp['win_size'] = win_size
+    tmp['rect'] = rect
+    tmp['surf'] = None
+    text_surf = tmp.get('text_surf')
     border_color = widget.get('border_color')
-    pos_px = get_px_from_multipliers(screen, widget['pos'])
-    size_px = get_px_from_multipliers(screen, widget['size'])
-    center_px = (
-        pos_px[0] + round(size_px[0] / 2.0),
-        pos_px[1] + round(size_px[1] / 2.0)
-    )
+    image = widget.get('surface')
+    parts = []  # (surface or None for the border, rect) to draw
+    if image is not None:
+        parts.append((image, rect))
     if text_surf is not None:
         text_pos = widget.get('text_pos')
         text_size_px = text_surf.get_size()
@@ -285,29 +383,108 @@ def render_widget(screen, widget):
         )
         # pusher is used so -1 is outside left and 1 is outside right
         text_center_px = (
-            center_px[0] + round(pusher[0] * text_pos[0]),
-            center_px[1] + round(pusher[1] * text_pos[1])
+            rect.centerx + round(pusher[0] * text_pos[0]),
+            rect.centery + round(pusher[1] * text_pos[1])
         )
         # round for python2 instead of // floor division:
-        text_pos_px = (
-            text_center_px[0] - round(text_size_px[0] / 2),
-            text_center_px[1] - round(text_size_px[1] / 2)
+        text_rect = pg.Rect(
+            (text_center_px[0] - round(text_size_px[0] / 2),
+             text_center_px[1] - round(text_size_px[1] / 2)),
+            text_size_px
         )
-        screen.blit(text_surf, text_pos_px)
-    border_color = widget.get('border_color')
+        parts.append((text_surf, text_rect))
     if border_color is not None:
-        short_px = min(win_size[0], win_size[1])
-        psd = get_setting('point_size_divisor')
-        # cast at least one to float for python 2:
-        thickness = round(short_px / float(psd))
-        if thickness < 1:
-            thickness = 1
-        draw_outline(
-            screen,
-            border_color,
-            pg.Rect(pos_px, size_px),
-            thickness
-        )
+        # (draw_outline goes 1 past the right and bottom edge)
+        parts.append((None, pg.Rect(rect.topleft,
+                                    (rect.w + 1, rect.h + 1))))
+    if len(parts) < 1:
+        return tmp
+    bounds = parts[0][1].unionall([part[1] for part in parts[1:]])
+    if (bounds.w < 1) or (bounds.h < 1):
+        return tmp
+    surf = pg.Surface(bounds.size, pg.SRCALPHA)
+    for part_surf, part_rect in parts:
+        dest = part_rect.move(-bounds.x, -bounds.y)
+        if part_surf is None:
+            short_px = min(w, h)
+            psd = get_setting('point_size_divisor')
+            # cast at least one to float for python 2:
+            thickness = round(short_px / float(psd))
+            if thickness < 1:
+                thickness = 1
+            draw_outline(surf, border_color,
+                         rect.move(-bounds.x, -bounds.y), thickness)
+        elif part_surf is image:
+            surf.blit(pg.transform.scale(image, rect.size), dest)
+        else:
+            surf.blit(part_surf, dest)
+    tmp['surf'] = surf
+    tmp['surf_pos'] = bounds.topleft
+    return tmp
+
+
+def _get_widget_layer(win_size):
+    """Get widget_layer, rebuilding it if widgets or win_size changed."""
+    grid_px = settings['widget_grid_px']
+    if ((widget_layer.get('win_size') == win_size)
+            and (widget_layer.get('version') == widgets_version)
+            and (widget_layer.get('count') == len(widgets))
+            and (widget_layer.get('grid_px') == grid_px)):
+        return widget_layer
+    blits = []
+    grid = {}
+    for widget in widgets:
+        layout = _get_widget_layout(win_size, widget)
+        if layout['surf'] is not None:
+            blits.append((layout['surf'], layout['surf_pos']))
+        rect = layout['rect']
+        if (rect.w < 1) or (rect.h < 1):
+            continue  # (nothing can touch it)
+        for row in range(rect.top // grid_px,
+                         (rect.bottom - 1) // grid_px + 1):
+            for col in range(rect.left // grid_px,
+                             (rect.right - 1) // grid_px + 1):
+                cell = grid.get((col, row))
+                if cell is None:
+                    cell = []
+                    grid[(col, row)] = cell
+                cell.append(widget)
+    widget_layer['win_size'] = win_size
+    widget_layer['version'] = widgets_version
+    widget_layer['count'] = len(widgets)
+    widget_layer['blits'] = blits
+    widget_layer['grid'] = grid
+    widget_layer['grid_px'] = grid_px
+    return widget_layer
+
+
+def get_widgets_at(screen, px_vec2):
+    """Get a list of the widgets (in the order they were added) at a
+    pixel of the screen, only checking the ones in its grid cell.
+    """
+    layer = _get_widget_layer(screen.get_size())
+    grid_px = layer['grid_px']
+    cell = layer['grid'].get((int(px_vec2[0]) // grid_px,
+                              int(px_vec2[1]) // grid_px))
+    if cell is None:
+        return []
+    return [widget for widget in cell
+            if widget['tmp']['rect'].collidepoint(px_vec2)]
+
+
+def render_widget(screen, widget):
+    layout = _get_widget_layout(screen.get_size(), widget)
+    if layout['surf'] is not None:
+        screen.blit(layout['surf'], layout['surf_pos'])
+
+
+def draw_widgets(screen):
+    """Draw every widget (each was drawn once to its own surface, so
+    this only blits unless the window size or the widgets changed).
+    """
+    layer = _get_widget_layer(screen.get_size())
+    if len(layer['blits']) > 0:
+        screen.blits(layer['blits'], doreturn=False)
 
 
 def on_widget_click(e):
@@ -318,6 +495,21 @@ def on_widget_click(e):
         widget['f'](e)
 
 
+inventory_version = 0
+"""Bumped whenever a unit's items or selected slot change (see
+push_unit_item, pop_unit_what_item, inventory_scroll, set_unit_value and
+_place_unit)."""
+inventory_hud = {}
+"""The inventory bar drawn by _DEPRECTED_draw_slots, kept until
+inventory_version, the window, tile or font size, the font, or an
+icon's frame changes:
+'key' -- what the bar was drawn for
+'surf' -- the bar (None if no slot has an image)
+'pos' -- where surf goes on the screen
+'icons' -- (anim, surface) for each slot's image when it was drawn
+"""
+
+
 def _DEPRECTED_draw_slots(e):
     surf = e.get('screen')
     q = bindings.get('draw_ui')
@@ -331,130 +523,159 @@ def _DEPRECTED_draw_slots(e):
     if (name is not None):
         unit = get_unit(name)
         if unit is not None:
-            inv_cursor_max = 0
-            material_slots = unit.get('material_slots')
-            if material_slots is None:
-                material_slots = []
-                unit['material_slots'] = material_slots
-            items = unit.get('items')
-            if items is None:
-                items = []
-                unit['items'] = items
-            inv_cursor_max = len(items) + len(material_slots)
-            selected_slot = get_unit_value(name, 'selected_slot')
-            if selected_slot is None:
-                selected_slot = 0
-                set_unit_value(name, 'selected_slot', selected_slot)
+            inventory = _get_inventory(unit)
+            material_slots = unit['material_slots']
+            items = unit['items']
+            inv_cursor_max = inventory['items_len'] + inventory['slots_len']
+            selected_slot = unit['selected_slot']
 
-    if surf is not None:
-        side = 'right'
-        win_size = surf.get_size()
-        tile_size = get_tile_size()
-        preview_size = int(tile_size[0]), int(tile_size[1])
-        short_px = min(win_size[0], win_size[1])
-        psd = get_setting('point_size_divisor')
-        # cast at least one to float for python 2:
-        thickness = round(short_px / float(psd))
-        if thickness < 1:
-            thickness = 1
-        margin_px = thickness * 2
-        border_size = (preview_size[0]+thickness*2,
-                       preview_size[1]+thickness*2)
-        offset_coord = 1
-        space_size = (
-            border_size[0] + margin_px,
-            border_size[1] + margin_px
-        )
-        fars = (
-            win_size[0] - preview_size[0] - margin_px - thickness,
-            win_size[1] - preview_size[1] - margin_px - thickness
-        )
-        nears = margin_px + thickness, margin_px + thickness
-        if side == 'bottom':
-            offset_coord = 0
-            x = round(win_size[0] / 2.0 - preview_size[0] / 2.0)
-            y = fars[1]
+    if (surf is None) or (inv_cursor_max is None):
+        return
+    win_size = surf.get_size()
+    tile_size = get_tile_size()
+    key = (name, inventory_version, selected_slot, win_size,
+           tuple(tile_size), get_setting('point_size_divisor'),
+           get_setting('sys_font_name'), get_setting('sys_font_size'))
+    if inventory_hud.get('key') == key:
+        for anim, image in inventory_hud['icons']:
+            if anim.get_surface() is not image:
+                # an animated icon changed frames
+                inventory_hud['key'] = None
+                break
+    if inventory_hud.get('key') != key:
+        _render_inventory_hud(unit, items, material_slots,
+                              inv_cursor_max, selected_slot, win_size,
+                              tile_size)
+        inventory_hud['key'] = key
+    if inventory_hud['surf'] is not None:
+        surf.blit(inventory_hud['surf'], inventory_hud['pos'])
+
+
+def _render_inventory_hud(unit, items, material_slots, inv_cursor_max,
+                          selected_slot, win_size, tile_size):
+    """Draw the inventory bar to inventory_hud['surf'] (see
+    _DEPRECTED_draw_slots).
+    """
+    side = 'right'
+    preview_size = int(tile_size[0]), int(tile_size[1])
+    short_px = min(win_size[0], win_size[1])
+    psd = get_setting('point_size_divisor')
+    # cast at least one to float for python 2:
+    thickness = round(short_px / float(psd))
+    if thickness < 1:
+        thickness = 1
+    margin_px = thickness * 2
+    border_size = (preview_size[0]+thickness*2,
+                   preview_size[1]+thickness*2)
+    offset_coord = 1
+    space_size = (
+        border_size[0] + margin_px,
+        border_size[1] + margin_px
+    )
+    fars = (
+        win_size[0] - preview_size[0] - margin_px - thickness,
+        win_size[1] - preview_size[1] - margin_px - thickness
+    )
+    nears = margin_px + thickness, margin_px + thickness
+    if side == 'bottom':
+        offset_coord = 0
+        x = round(win_size[0] / 2.0 - preview_size[0] / 2.0)
+        y = fars[1]
+    else:
+        x = fars[0]
+        y = round(win_size[1] / 2.0 - preview_size[1] / 2.0)
+    offset = border_size[offset_coord] + margin_px
+    offsets = [0, 0]
+    offsets[offset_coord] = offset
+    if selected_slot is not None:
+        x -= offsets[0] * selected_slot
+        y -= offsets[1] * selected_slot
+    item_color = (64, 64, 64)
+    material_color = (32, 32, 32)
+    color = item_color
+    select_color = (255, 255, 255)
+    # (alpha is ignored when drawing a rect on the screen, so it is
+    # left out to look the same on the bar's surface):
+    blank_color = (64, 64, 64)  # (0, 0, 0, 128)
+    this_color = item_color
+
+    stacks = unit['stacks']
+    slots = []  # (x, y, color, image, count) of each slot to draw
+    icons = []
+    for theoretical_i in range(inv_cursor_max):
+        slot_i = theoretical_i
+        count = None
+        pose = None
+        if slot_i >= len(items):
+            slot_i -= len(items)
+            what = material_slots[slot_i]
+            count = stacks[what]
+            this_color = material_color
         else:
-            x = fars[0]
-            y = round(win_size[1] / 2.0 - preview_size[1] / 2.0)
-        offset = border_size[offset_coord] + margin_px
-        offsets = [0, 0]
-        offsets[offset_coord] = offset
-        if selected_slot is not None:
-            x -= offsets[0] * selected_slot
-            y -= offsets[1] * selected_slot
-        item_color = (64, 64, 64)
-        material_color = (32, 32, 32)
-        color = item_color
-        select_color = (255, 255, 255)
-        blank_color = (64, 64, 64, 64)  # (0, 0, 0, 128)
-        this_color = item_color
-        counts = {}
-        before_mid_count = math.floor(inv_cursor_max / 2)
-        from_mid_count = inv_cursor_max - before_mid_count
-
-        stacks = unit.get('stacks')
-        if stacks is None:
-            stacks = {}
-            unit['stacks'] = stacks
-        for theoretical_i in range(inv_cursor_max):
-            slot_i = theoretical_i
-            count = None
-            pose = None
-            if slot_i >= len(items):
-                slot_i -= len(items)
-                what = material_slots[slot_i]
-                count = stacks[what]
-                this_color = material_color
-            else:
-                what = items[slot_i]['what']
-                pose = items[slot_i].get('pose')
+            what = items[slot_i]['what']
+            pose = items[slot_i].get('pose')
 
-            if theoretical_i == selected_slot:
-                color = select_color
-            else:
-                color = this_color
+        if theoretical_i == selected_slot:
+            color = select_color
+        else:
+            color = this_color
 
-            mat_surf = None
-            if pose is not None:
-                anim = get_anim_from_mat_name(what, pose=pose)
-            else:
-                anim = get_anim_from_mat_name(what)
-            mat_surf = anim.get_surface()
-            if mat_surf is None:
-                continue
+        mat_surf = None
+        if pose is not None:
+            anim = get_anim_from_mat_name(what, pose=pose)
+        else:
+            anim = get_anim_from_mat_name(what)
+        mat_surf = anim.get_surface()
+        icons.append((anim, mat_surf))
+        if mat_surf is None:
+            continue
+        slots.append((x, y, color, mat_surf, count))
+        x += offsets[0]
+        y += offsets[1]
+    inventory_hud['icons'] = icons
+    inventory_hud['surf'] = None
+    if len(slots) < 1:
+        return
+    # (draw_outline goes 1 past the right and bottom edge):
+    left = slots[0][0] - thickness
+    top = slots[0][1] - thickness
+    right = slots[-1][0] - thickness + border_size[0] + 1
+    bottom = slots[-1][1] - thickness + border_size[1] + 1
+    bar = pg.Surface((right - left, bottom - top), pg.SRCALPHA)
+    for x, y, color, mat_surf, count in slots:
+        x -= left
+        y -= top
+        # draw outline
+        draw_outline(
+            bar,
+            color,
+            pg.Rect(x-thickness, y-thickness, border_size[0],
+                    border_size[1]),
+            thickness
+        )
 
-            # draw outline
-            draw_outline(
-                surf,
-                color,
-                pg.Rect(x-thickness, y-thickness, border_size[0],
-                        border_size[1]),
-                thickness
+        # draw item or material
+        if (count is None) or (count > 0):
+            bar.blit(
+                pg.transform.scale(
+                    mat_surf,
+                    (preview_size[0], preview_size[1])
+                ),
+                (x, y)
+            )
+        else:  # draw default background if 0 (empty slot, no image)
+            pg.draw.rect(
+                bar,
+                blank_color,
+                pg.Rect(x, y, preview_size[0], preview_size[1])
             )
 
-            # draw item or material
-            if (count is None) or (count > 0):
-                surf.blit(
-                    pg.transform.scale(
-                        mat_surf,
-                        (preview_size[0], preview_size[1])
-                    ),
-                    (x, y)
-                )
-            else:  # draw default background if 0 (empty slot, no image)
-                pg.draw.rect(
-                    surf,
-                    blank_color,
-                    pg.Rect(x, y, preview_size[0], preview_size[1])
-                )
-
-            # draw the quantity
-            if (count is not None) and (count > 0):
-                draw_text_vec2(str(count), (255, 255, 255), surf,
-                               (x+1, y+1))
-            x += offsets[0]
-            y += offsets[1]
+        # draw the quantity
+        if (count is not None) and (count > 0):
+            draw_text_vec2(str(count), (255, 255, 255), bar,
+                           (x+1, y+1))
+    inventory_hud['surf'] = bar
+    inventory_hud['pos'] = (left, top)
 
 
 def _on_draw_ui(e):
@@ -462,6 +683,8 @@ def _on_draw_ui(e):
     q = bindings.get('draw_ui')
     for f in q:
         f({'screen': surf})
+    if settings['widgets_draw_enable']:
+        draw_widgets(surf)
 
     _DEPRECTED_draw_slots(e)
 
@@ -583,6 +806,14 @@ def load_settings():
     dict_overlay(settings, got, 'popup_sec_per_glyph', .04)
     dict_overlay(settings, got, 'popup_alpha_per_sec', 128.0)
     dict_overlay(settings, got, 'text_antialiasing', True)
+    # how many rendered lines of text to keep (see get_text_surface):
+    dict_overlay(settings, got, 'text_cache_size', 256)
+    # size of the cells used to find widgets at a touch (see
+    # get_widgets_at):
+    dict_overlay(settings, got, 'widget_grid_px', 64)
+    # draw every widget after the 'draw_ui' bindings (if False, draw
+    # them with render_widget or draw_widgets in a 'draw_ui' binding):
+    dict_overlay(settings, got, 'widgets_draw_enable', False)
     # 4.47 m/s = 10 miles per hour:
     dict_overlay(settings, got, 'human_run_slow_mps', 4.47)
     dict_overlay(settings, got, 'human_walk_mps', 3.0)  # approx
@@ -598,6 +829,31 @@ def load_settings():
     dict_overlay(settings, got, 'swipe_factor', .2)
     dict_overlay(settings, got, 'default_world_gravity', 9.8)
     dict_overlay(settings, got, 'default_world_height', 12)
+    # pre-render terrain rows that are not animated:
+    dict_overlay(settings, got, 'terrain_layer_enable', True)
+    # frames per second of animated nodes (see advance_animations):
+    dict_overlay(settings, got, 'node_anim_fps', 6.0)
+    # fixed time step of step_world (60 Hz):
+    dict_overlay(settings, got, 'physics_step_sec', 1.0 / 60.0)
+    dict_overlay(settings, got, 'physics_max_steps', 8)
+    dict_overlay(settings, got, 'physics_interpolate', True)
+    # step units with NumPy arrays when there are at least this many
+    # (see _step_units_batch; 0 to always step them one at a time):
+    dict_overlay(settings, got, 'physics_batch_min_units', 200)
+    # how many recent frames get_frame_profile uses for percentiles:
+    dict_overlay(settings, got, 'profile_frames', 240)
+    # seconds between background saves of changed chunks and units
+    # (0 to turn off autosave):
+    dict_overlay(settings, got, 'autosave_sec', 60.0)
+    # chunks around the camera and each unit to keep loaded (the chunks
+    # draw_frame draws are always kept loaded too):
+    dict_overlay(settings, got, 'stream_radius_chunks', 2)
+    # most chunks to keep in memory (others are saved and unloaded):
+    dict_overlay(settings, got, 'max_loaded_chunks', 400)
+    # how many blocks higher than 2 generated terrain can be:
+    dict_overlay(settings, got, 'generate_relief', 3)
+    # mesa image pixels per block when generating terrain:
+    dict_overlay(settings, got, 'mesa_px_per_block', 4)
 
     if not equal_str_content(settings, got):
         with open(settings_path, "w") as outs:
@@ -707,9 +963,58 @@ def save(name, data):  # , file_format='list'):
         files_path = os.path.join(appdata_path, last_loaded_world_name)
     path = os.path.join(files_path, filename)
     # save1d.save(name, data, file_format=file_format)
-    with open(path, "w") as outs:
-        data_trim = trim_dict(data)
-        json.dump(data_trim, outs)
+    save_json_atomic(path, get_saved_data(data))
+    autosave_state['saved'].pop(path, None)  # (now autosave may differ)
+
+
+def get_saved_data(data):
+    """Get data the way save writes it: without 'tmp', and with a
+    unit's inventory packed (see pack_inventory).
+    """
+    data = trim_dict(data)
+    if 'material_slots' in data:
+        data = pack_inventory(data)
+    return data
+
+
+def pack_inventory(unit):
+    """Get a copy of a unit's values where 'material_slots' and 'stacks'
+    are combined into 'slots' (a list of [what, count] in slot order), so
+    each what is saved once (see unpack_inventory).
+    """
+    data = dict(unit)
+    material_slots = data.pop('material_slots')
+    stacks = dict(data.pop('stacks', {}))
+    data['slots'] = [[what, stacks.pop(what, 0)] for what in material_slots]
+    if len(stacks) > 0:
+        data['stacks'] = stacks  # (counts without a slot)
+    return data
+
+
+def unpack_inventory(unit):
+    """Change the 'slots' saved by pack_inventory in a unit's values back
+    to 'material_slots' and 'stacks'.
+    """
+    slots = unit.pop('slots', None)
+    if slots is None:
+        return
+    stacks = unit.get('stacks')
+    if stacks is None:
+        stacks = {}
+        unit['stacks'] = stacks
+    unit['material_slots'] = [slot[0] for slot in slots]
+    for what, count in slots:
+        stacks[what] = count
+
+
+def save_json_atomic(path, data):
+    """Write data as JSON to a temporary file then rename it to path,
+    so path is never left partially written (such as after a crash).
+    """
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w") as outs:
+        json.dump(data, outs)
+    os.replace(tmp_path, path)
 
 
 def get_preview_tileset_path():
@@ -927,6 +1232,54 @@ def get_unit_location(name):
     return ret
 
 
+unit_cells = {}
+"""spatial index of units, where key is a (col, row) location and value
+is a set of names of units there (see get_unit_names_at)"""
+
+
+def _update_unit_cell(unit):
+    """Move a unit to the correct unit_cells entry after unit['pos']
+    changed (the index is keyed by unit['tmp']['name']).
+    """
+    loc = get_location_at_pos(unit['pos'])
+    prev_loc = unit['tmp'].get('loc')
+    if prev_loc == loc:
+        return
+    name = unit['tmp']['name']
+    if prev_loc is not None:
+        names = unit_cells.get(prev_loc)
+        if names is not None:
+            names.discard(name)
+            if len(names) < 1:
+                del unit_cells[prev_loc]
+    names = unit_cells.get(loc)
+    if names is None:
+        names = set()
+        unit_cells[loc] = names
+    names.add(name)
+    unit['tmp']['loc'] = loc
+
+
+def get_unit_names_at(loc):
+    """Get the set of names of units at a (col, row) location (or an
+    empty tuple if there are none). Do not modify the set.
+    """
+    names = unit_cells.get((loc[0], loc[1]))
+    if names is None:
+        return ()
+    return names
+
+
+def get_units_at(loc):
+    """Get a dict of units at a (col, row) location, where key is the
+    unit's name.
+    """
+    ret = {}
+    for name in get_unit_names_at(loc):
+        ret[name] = units[name]
+    return ret
+
+
 def get_location_at_px(vec2, cam_vec2=None):
     global screen_half
     # see also vec3_from_vec2
@@ -999,12 +1352,8 @@ def vec3_from_vec2(vec2, vec3, cam_vec2=None, occlude=True):
         # TODO: use screen-based value instead of world['height']
         # print("bottom_loc: " + str(bottom_loc))
         for try_row in range(closest_row, row):
-            try_loc = col, try_row
-            stack = get_stack(get_key_at_loc(try_loc))
             abs_y = 0
-            this_len = 0
-            if stack is not None:
-                this_len = len(stack)
+            this_len = max(get_stack_height(col, try_row), 0)
             for try_i in range(this_len):
                 rel_h = 1  # TODO: make blocks variable height
                 if try_row + abs_y >= bottom_loc[1]:
@@ -1061,8 +1410,16 @@ def get_unit_value(name, variable_name):
     return units[name].get(variable_name)
 
 
+INVENTORY_KEYS = ('items', 'stacks', 'material_slots', 'selected_slot')
+"""unit values drawn in the inventory bar (so setting one bumps
+inventory_version)"""
+
+
 def set_unit_value(name, variable_name, v):
+    global inventory_version
     units[name][variable_name] = v
+    if variable_name in INVENTORY_KEYS:
+        inventory_version += 1
 
 
 unstackable = {}
@@ -1084,43 +1441,103 @@ def new_material(what):
     return {'what': what}
 
 
+def _get_inventory(unit, reindex=False):
+    """Get the index of a unit's inventory (unit['tmp']['inventory']),
+    adding any missing inventory values to the unit, and indexing it
+    again if reindex is True or the lists were replaced or changed
+    length other than by push_unit_item and pop_unit_what_item (such as
+    by loading the unit). A list changed in place without changing
+    length (such as an item replaced by another) is found when the
+    index does not match it (see _find_last_item):
+    'slot_of' -- the index in unit['material_slots'] by what
+    'item_counts' -- how many of unit['items'] there are by what
+    'slots_len' -- len(unit['material_slots']) when last indexed
+    'items_len' -- len(unit['items']) when last indexed
+
+    The unit's saved values are still the inventory:
+    'material_slots' -- the what of each stackable slot, in slot order
+    'stacks' -- the count of each stackable what
+    'items' -- unstackable items (each a node dict), in slot order
+    'selected_slot' -- the index of the selected slot (items first, then
+                       material slots)
+    """
+    material_slots = unit.get('material_slots')
+    if material_slots is None:
+        material_slots = []
+        unit['material_slots'] = material_slots
+    items = unit.get('items')
+    if items is None:
+        items = []
+        unit['items'] = items
+    stacks = unit.get('stacks')
+    if stacks is None:
+        stacks = {}
+        unit['stacks'] = stacks
+    if unit.get('selected_slot') is None:
+        unit['selected_slot'] = 0
+    tmp = unit.get('tmp')
+    if tmp is None:
+        tmp = {}
+        unit['tmp'] = tmp
+    inventory = tmp.get('inventory')
+    if ((inventory is not None) and (not reindex)
+            and (inventory['slots'] is material_slots)
+            and (inventory['items'] is items)
+            and (inventory['slots_len'] == len(material_slots))
+            and (inventory['items_len'] == len(items))):
+        return inventory
+    inventory = {}
+    inventory['slots'] = material_slots
+    inventory['items'] = items
+    inventory['slot_of'] = {}
+    for slot_i in range(len(material_slots)):
+        inventory['slot_of'].setdefault(material_slots[slot_i], slot_i)
+    item_counts = {}
+    for item in items:
+        what = item.get('what')
+        item_counts[what] = item_counts.get(what, 0) + 1
+    inventory['item_counts'] = item_counts
+    inventory['slots_len'] = len(material_slots)
+    inventory['items_len'] = len(items)
+    tmp['inventory'] = inventory
+    return inventory
+
+
 def push_unit_item(name, item):
-    items = None
+    global inventory_version
     what = item.get('what')
     if what is None:
         print("ERROR: item missing 'what': " + str(item))
-        # allow exception below
-    stacks = units[name].get('stacks')
-    if stacks is None:
-        stacks = {}
-        units[name]['stacks'] = stacks
+    unit = units[name]
+    inventory = _get_inventory(unit)
     if is_stackable(what):
-        slot_i = -1
-        material_slots = units[name].get('material_slots')
-        if material_slots is None:
-            material_slots = []
-            units[name]['material_slots'] = material_slots
-        else:
-            try:
-                slot_i = material_slots.index(what)
-            except ValueError:
-                slot_i = -1
-                pass
-        if slot_i < 0:
-            slot_i = len(material_slots)
+        material_slots = unit['material_slots']
+        slot_i = inventory['slot_of'].get(what)
+        if (slot_i is not None) and (material_slots[slot_i] != what):
+            # the slots were changed in place, so index them again:
+            inventory = _get_inventory(unit, reindex=True)
+            slot_i = inventory['slot_of'].get(what)
+        if slot_i is None:
+            inventory['slot_of'][what] = len(material_slots)
             material_slots.append(what)
-
-        count = stacks.get(what)
-        if count is None:
-            stacks[what] = 1
-        else:
-            stacks[what] += 1
+            inventory['slots_len'] += 1
+        stacks = unit['stacks']
+        stacks[what] = stacks.get(what, 0) + 1
     else:
-        items = units[name].get('items')
-        if items is None:
-            items = []
-            units[name]['items'] = items
-        items.append(item)
+        unit['items'].append(item)
+        item_counts = inventory['item_counts']
+        item_counts[what] = item_counts.get(what, 0) + 1
+        inventory['items_len'] += 1
+    inventory_version += 1
+
+
+def get_unit_item_count(name, what):
+    """Get how many of what a unit has (stacked or as items)."""
+    unit = units[name]
+    inventory = _get_inventory(unit)
+    if is_stackable(what):
+        return unit['stacks'].get(what, 0)
+    return inventory['item_counts'].get(what, 0)
 
 
 def get_unit(name):
@@ -1132,50 +1549,57 @@ def get_all_slots_count(name):
     if (name is not None):
         unit = units.get(name)
         if unit is not None:
-            inv_cursor_max = 0
-            material_slots = unit.get('material_slots')
-            if material_slots is None:
-                material_slots = []
-                unit['material_slots'] = material_slots
-            items = unit.get('items')
-            if items is None:
-                items = []
-                unit['items'] = items
-            inv_cursor_max = len(items) + len(material_slots)
-            selected_slot = get_unit_value(name, 'selected_slot')
-            if selected_slot is None:
-                selected_slot = 0
-                set_unit_value(name, 'selected_slot', selected_slot)
+            inventory = _get_inventory(unit)
+            inv_cursor_max = (inventory['items_len']
+                              + inventory['slots_len'])
     return inv_cursor_max
 
 
+def get_unit_slot_what(name, slot_i):
+    """Get the what in a slot of a unit's inventory (the slot order is
+    items then material slots, as drawn), or None if there is no such
+    slot.
+    """
+    unit = units.get(name)
+    if unit is None:
+        return None
+    inventory = _get_inventory(unit)
+    if slot_i < 0:
+        return None
+    if slot_i < inventory['items_len']:
+        return unit['items'][slot_i].get('what')
+    slot_i -= inventory['items_len']
+    if slot_i < inventory['slots_len']:
+        return unit['material_slots'][slot_i]
+    return None
+
+
+def select_unit_slot(name, slot_i):
+    """Select a slot of a unit's inventory (clamped to the slots the
+    unit has), and get the slot selected.
+    """
+    global inventory_version
+    unit = units[name]
+    inventory = _get_inventory(unit)
+    slot_count = inventory['items_len'] + inventory['slots_len']
+    if slot_i >= slot_count:
+        slot_i = slot_count - 1
+    if slot_i < 0:
+        slot_i = 0
+    if unit['selected_slot'] != slot_i:
+        unit['selected_slot'] = slot_i
+        inventory_version += 1
+    return slot_i
+
+
 def get_what_unit_wielding(name):
-    ret = None
-    selected_slot = None
-    if (name is not None):
-        unit = get_unit(name)
-        if unit is not None:
-            inv_cursor_max = 0
-            material_slots = unit.get('material_slots')
-            if material_slots is None:
-                material_slots = []
-                unit['material_slots'] = material_slots
-            items = unit.get('items')
-            if items is None:
-                items = []
-                unit['items'] = items
-            inv_cursor_max = len(items) + len(material_slots)
-            selected_slot = get_unit_value(name, 'selected_slot')
-            if selected_slot is None:
-                selected_slot = 0
-                set_unit_value(name, 'selected_slot', selected_slot)
-    if selected_slot >= len(items):
-        if selected_slot < len(material_slots):
-            ret = material_slots[selected_slot]
-    else:
-        if len(items) > 0:
-            ret = items[selected_slot]['what']
-    return ret
+    if name is None:
+        return None
+    unit = units.get(name)
+    if unit is None:
+        return None
+    _get_inventory(unit)  # (sets 'selected_slot' if the unit has none)
+    return get_unit_slot_what(name, unit['selected_slot'])
 
 
 def pop_unit_item(name):
@@ -1186,25 +1610,56 @@ def pop_unit_item(name):
     return result
 
 
+def _find_last_item(inventory, items, what):
+    """Get the index of the last of a unit's items with what, or None if
+    the index says there is none or the items do not match the index.
+    """
+    if inventory['item_counts'].get(what, 0) < 1:
+        return None
+    for item_i in range(len(items) - 1, -1, -1):
+        if items[item_i].get('what') == what:
+            return item_i
+    return None
+
+
 def pop_unit_what_item(name, what):
+    """Take one of what from a unit's inventory and get it (the last
+    one with this what if it is unstackable), or None if the unit has
+    none.
+    """
+    global inventory_version
     result = None
-    stacks = None
-    items = None
+    unit = units[name]
+    inventory = _get_inventory(unit)
     if is_stackable(what):
-        stacks = units[name].get('stacks')
-        count = 0
-        if stacks is not None:
-            count = stacks.get(what)
-            if count is None:
-                count = 0
+        stacks = unit['stacks']
+        count = stacks.get(what)
+        if count is None:
+            count = 0
         if count > 0:
             stacks[what] -= 1
             result = new_material(what)
     else:
-        items = units[name].get('items')
-        if items is not None:
-            if len(items) > 0:
-                result = items.pop()
+        items = unit['items']
+        item_i = _find_last_item(inventory, items, what)
+        if item_i is None:
+            # (the items may have been changed in place, such as an item
+            # replaced by another, so index them again to be sure)
+            inventory = _get_inventory(unit, reindex=True)
+            item_i = _find_last_item(inventory, items, what)
+        if item_i is not None:
+            item_counts = inventory['item_counts']
+            result = items.pop(item_i)
+            item_counts[what] -= 1
+            inventory['items_len'] -= 1
+            # keep the selected slot on the same slot (or the last):
+            selected_slot = unit['selected_slot']
+            if (selected_slot > item_i) or (
+                    selected_slot >= inventory['items_len']
+                    + inventory['slots_len']):
+                select_unit_slot(name, selected_slot - 1)
+    if result is not None:
+        inventory_version += 1
     return result
 
 
@@ -1323,7 +1778,8 @@ def move_camera_to(name):
     camera_target_unit_name = name
     unit = units.get(name)
     if unit is not None:
-        camera['pos'] = unit['pos'][0], camera['pos'][1], unit['pos'][2]
+        pos = get_unit_render_pos(unit)
+        camera['pos'] = pos[0], camera['pos'][1], pos[2]
     else:
         raise ValueError("Cannot move_camera_to since no unit '" +
                          name + "'")
@@ -1358,6 +1814,28 @@ def find_graphic(haystack_material, needle_path, needle_loc):
     return ret
 
 
+LOWLIGHT_LEVELS = (.75, .9)
+"""lowlight multipliers prepared for every frame by load_material (the
+sides of stacks are drawn using these)"""
+
+
+def get_lowlit_copy(image, lowlight):
+    """Get a copy of image darkened by a lowlight multiplier (1.0 is
+    unchanged, 0.0 is black) without changing its alpha.
+    """
+    darkness = int((1.0 - lowlight) * 255)
+    lowlit_surf = pg.Surface(image.get_size(), flags=pg.SRCALPHA)
+    black_surf = pg.Surface(image.get_size(), flags=pg.SRCALPHA)
+    black_surf.fill((darkness, darkness, darkness, 0))
+    lowlit_surf.blit(image, (0, 0))
+    # this blend is slow, but seems necessary so alpha
+    # doesn't get overwritten:
+    lowlit_surf.blit(black_surf, (0, 0), special_flags=pg.BLEND_RGBA_SUB)
+    # See also https://www.reddit.com/r/pygame/comments/\
+    # 4b8mnz/is_it_possible_to_make_an_image_darker/
+    return lowlit_surf
+
+
 # Spritesheet class from https://www.pygame.org/wiki/Spritesheet
 # changes by poikilos: file_surfs cache
 class SpriteSheet(object):
@@ -1438,14 +1916,17 @@ class SpriteStripAnim(object):
         if order is not None:
             self._go_to_order()
         self.image = self.images[self.i]
+        self.image_i = self.i  # index of self.image (i may be ahead)
+        self.image_oi = self.oi  # index in order of self.image
+        self.fps = None
+        """how many times per second the animation clock advances this
+        (if None, use the 'node_anim_fps' setting)"""
+        self.clock_enable = False  # True if in clock_anims
+        self.clock_sec = 0.0  # time since the clock last advanced it
 
-        self.lowlit_surf = pg.Surface(self.image.get_size(),
-                                      flags=pg.SRCALPHA)
-        self.black_surf = pg.Surface(self.image.get_size(),
-                                     flags=pg.SRCALPHA)
         self.lowlight = .75
-        self._lowlit = None
-        self._lowlit_i = None
+        self.lowlit_images = {}
+        """shaded copies of images, where key is lowlight"""
 
         self.loop = loop
 
@@ -1464,34 +1945,47 @@ class SpriteStripAnim(object):
         self.f = self.delay_count
         return self
 
-    def get_lowlit_surface(self):
-        if self.lowlight is not None:
-            if self.lowlight < 0.0:
-                self.lowlight = 0.0
-            elif self.lowlight > 1.0:
-                self.lowlight = 1.0
-            darkness = 1.0 - self.lowlight
-            if (self._lowlit is None) or \
-               (self._lowlit != self.lowlight) or \
-               (self._lowlit_i != self.i):
-                self.black_surf.fill((darkness*255,
-                                      darkness*255,
-                                      darkness*255, 0))
-                self.lowlit_surf.fill((0, 0, 0, 0))
-                self.lowlit_surf.blit(self.image, (0, 0))
-                # this blend is slow, but seems necessary so alpha
-                # doesn't get overwritten:
-                self.lowlit_surf.blit(self.black_surf, (0, 0),
-                                      special_flags=pg.BLEND_RGBA_SUB)
-                # See also https://www.reddit.com/r/pygame/comments/\
-                # 4b8mnz/is_it_possible_to_make_an_image_darker/
-                self._lowlit = self.lowlight
-                self._lowlit_i = self.i
-            return self.lowlit_surf
-        else:
-            return self.image
+    def prepare_lowlights(self, levels):
+        """Generate the shaded copy of every frame for each lowlight
+        in levels, so get_lowlit_surface only has to look them up.
+        """
+        for lowlight in levels:
+            lowlight = clamp(lowlight, 0.0, 1.0)
+            frames = self.lowlit_images.get(lowlight)
+            if (frames is None) or (len(frames) != len(self.images)):
+                self.lowlit_images[lowlight] = [
+                    get_lowlit_copy(image, lowlight)
+                    for image in self.images
+                ]
+
+    def get_image_i(self, phase=0):
+        """Get the index in self.images of the current frame, or of the
+        frame that is phase frames later (wrapping around).
+        """
+        if phase == 0:
+            return self.image_i
+        if self.order is not None:
+            return self.order[(self.image_oi + phase)
+                              % len(self.order)] - 1
+        return (self.image_i + phase) % len(self.images)
 
-        return self.lowlit_surf
+    def get_lowlit_surface(self, lowlight=None, image_i=None):
+        """Get the current frame (or self.images[image_i]) shaded by
+        lowlight (or by self.lowlight if None).
+        """
+        if image_i is None:
+            image_i = self.image_i
+        if lowlight is None:
+            lowlight = self.lowlight
+        if lowlight is None:
+            return self.images[image_i]
+        lowlight = clamp(lowlight, 0.0, 1.0)
+        frames = self.lowlit_images.get(lowlight)
+        if (frames is None) or (len(frames) != len(self.images)):
+            # not one of the prepared levels, or frames were added
+            self.prepare_lowlights([lowlight])
+            frames = self.lowlit_images[lowlight]
+        return frames[image_i]
 
     def get_surface(self):
         # return self.images[self.i]
@@ -1531,6 +2025,8 @@ class SpriteStripAnim(object):
                 else:
                     self.i = 0
         self.image = self.images[self.i]
+        self.image_i = self.i
+        self.image_oi = self.oi
         self.f -= 1
         if self.f == 0:
             if self.order is not None:
@@ -1545,9 +2041,95 @@ class SpriteStripAnim(object):
 
     def __add__(self, ss):
         self.images.extend(ss.images)
+        # get_lowlit_surface regenerates shaded frames if count changed
         return self
 
 
+scaled_frames = {}
+"""scaled (and optionally lowlit) copies of animation frames, where
+key is (frame surface, lowlight, size) (see get_scaled_frame)"""
+scaled_frames_scale = None
+"""(win_size, b_scale_h) that scaled_frames was generated for"""
+
+
+def get_scaled_frame(anim, size, lowlight=None, phase=0):
+    """Get the current frame of a SpriteStripAnim scaled to size,
+    only calling pg.transform.scale the first time a given frame is
+    needed at a given lowlight and size.
+
+    Sequential arguments:
+    anim -- a SpriteStripAnim
+    size -- a (width, height) tuple
+
+    Keyword arguments:
+    lowlight -- if not None, get a version shaded by the lowlight
+                multiplier (see SpriteStripAnim.get_lowlit_surface)
+    phase -- get the frame this many frames later (see node['phase'])
+    """
+    image_i = anim.get_image_i(phase)
+    key = (anim.images[image_i], lowlight, size)
+    surf = scaled_frames.get(key)
+    if surf is None:
+        if lowlight is None:
+            src = anim.images[image_i]
+        else:
+            src = anim.get_lowlit_surface(lowlight, image_i=image_i)
+        surf = pg.transform.scale(src, size)
+        scaled_frames[key] = surf
+    return surf
+
+
+def _update_scaled_frames_scale():
+    """Clear scaled_frames if the window size or scale changed."""
+    global scaled_frames_scale
+    scale = (win_size, b_scale_h)
+    if scale != scaled_frames_scale:
+        scaled_frames.clear()
+        scaled_frames_scale = scale
+
+
+clock_anims = []
+"""animations that advance_animations advances (each is a
+SpriteStripAnim shared by all animated nodes of a material and pose)"""
+
+
+def add_clock_anim(anim):
+    """Make advance_animations advance a SpriteStripAnim (this happens
+    automatically the first time a node with 'animate' is drawn).
+    """
+    if not anim.clock_enable:
+        anim.clock_enable = True
+        clock_anims.append(anim)
+
+
+def advance_animations(seconds):
+    """Advance each clock animation once per frame duration (1/fps)
+    that passed, so playback does not depend on how many nodes use it
+    or on the frame rate.
+    """
+    node_anim_fps = settings['node_anim_fps']
+    for anim in clock_anims:
+        fps = anim.fps
+        if fps is None:
+            fps = node_anim_fps
+        if fps <= 0:
+            continue
+        anim.clock_sec += seconds
+        frame_sec = 1.0 / fps
+        count = int(anim.clock_sec / frame_sec)
+        if count < 1:
+            continue
+        anim.clock_sec -= count * frame_sec
+        # there is no need to loop more than once after a long pause:
+        count = min(count, len(anim.images) * anim.delay_count)
+        try:
+            for i in range(count):
+                anim.advance()
+        except StopIteration:
+            # not loop, so stay on the last frame
+            anim.clock_sec = 0.0
+
+
 shown_node_graphics_warnings = {}
 
 
@@ -1636,14 +2218,10 @@ def unit_is_on_ground(name, double_jump_y=kEpsilon):
     """Returns True, False, or None (no ground directly under)
     for the unit with the given name.
     """
-    stacks = world['blocks']
     unit = units.get(name)
     if unit is not None:
-        sk = get_key_at_pos(unit['pos'])
-        ground_y = nothing_y
-        stack = stacks.get(sk)
-        if stack is not None:
-            ground_y = float(len(stack))
+        ground_y = ground_height(unit['pos'][0], unit['pos'][2])
+        if ground_y != nothing_y:
             # offset = len(stack) * block_rise_as_y_px
             if unit['pos'][1] - ground_y <= double_jump_y:
                 return True
@@ -1654,15 +2232,10 @@ def unit_is_on_ground(name, double_jump_y=kEpsilon):
 
 def unit_jump(name, vel_y, vel_x=None, vel_z=None,
               double_jump_y=kEpsilon):
-    stacks = world['blocks']
     unit = units.get(name)
     if unit is not None:
-        sk = get_key_at_pos(unit['pos'])
-        ground_y = nothing_y
-        stack = stacks.get(sk)
-        if stack is not None:
-            ground_y = float(len(stack))
-            # offset = len(stack) * block_rise_as_y_px
+        ground_y = ground_height(unit['pos'][0], unit['pos'][2])
+        # offset = len(stack) * block_rise_as_y_px
         if unit['pos'][1] - ground_y <= double_jump_y:
             if (ground_y >= nothing_y) or (double_jump_y > kEpsilon):
                     # on ground, or allow double jump above nothing
@@ -1687,7 +2260,13 @@ def unit_jump(name, vel_y, vel_x=None, vel_z=None,
 
 
 def render_unit(screen, unit_name, unit, sprite_scale,
-                camera_vec2=None):
+                camera_vec2=None, blits=None):
+    """Draw a unit.
+
+    Keyword arguments:
+    blits -- if not None, append (surface, dest) to this list (for
+             Surface.blits) instead of drawing to screen now
+    """
     global square_sprite_size
     if square_sprite_size is None:
         print("ERROR: no square_sprite_size global in render_unit")
@@ -1705,7 +2284,7 @@ def render_unit(screen, unit_name, unit, sprite_scale,
     #     continue
 
     this_size = src_size[0]*sprite_scale, src_size[1]*sprite_scale
-    x, y = vec2_from_vec3_via_camera(unit['pos'],
+    x, y = vec2_from_vec3_via_camera(get_unit_render_pos(unit),
                                      cam_vec2=camera_px)
     x -= this_size[0] / 2
     rise_factor = .125
@@ -1715,9 +2294,12 @@ def render_unit(screen, unit_name, unit, sprite_scale,
     # if y+w < 0 or y >= win_size[0]:
     #     continue
     # scalable_surf.blit(anim.get_surface(), (x,y-offset))
-    screen.blit(pg.transform.scale(anim.get_surface(),
-                                   square_sprite_size),
-                (x, y))  # y-offset
+    if blits is not None:
+        blits.append((get_scaled_frame(anim, square_sprite_size),
+                      (x, y)))  # y-offset
+    else:
+        screen.blit(get_scaled_frame(anim, square_sprite_size),
+                    (x, y))  # y-offset
     # surface = next(anim)
 
 
@@ -1728,15 +2310,21 @@ def ensure_default_font():
     if (default_font is None) or (default_font_size != new_font_size):
         print("new_font_size: " + str(new_font_size))
         default_font_size = new_font_size
-        default_font = pg.font.SysFont(settings['sys_font_name'],
-                                       default_font_size)
+        default_font = get_font(size=default_font_size)
+        # forget text rendered with the old font:
+        text_cache.clear()
+        glyph_cache.clear()
 
 
 def teleport_unit(unit, pos):
-    sk = get_key_at_pos(pos)
-    y = max(pos[1], float(len(get_stack(sk))))
+    loc = get_location_at_pos(pos)
+    # load the chunk if not loaded:
+    _get_streamed_chunk(get_chunk_loc(loc[0], loc[1]))
+    y = max(pos[1], ground_height(pos[0], pos[2]))
     unit['pos'] = (pos[0], y, pos[2])
+    _set_prev_pos(unit, unit['pos'])  # do not interpolate
     unit['mps_vec3'] = [0.0, 0.0, 0.0]
+    _update_unit_cell(unit)
 
 
 def teleport_unit_2d(unit, x, z):
@@ -1843,60 +2431,1023 @@ def get_terrain_image(frame, cutout_3x5_path, crop_from=None,
         y += cell_size[1]
     return dst
 
-def draw_frame(screen):
-    global settings
-    global temp_screen
-    global text_pos
-    global win_size
-    # global scaled_size
-    global scaled_b_size
-    global block_half_counts
-    global start_loc
-    global end_loc
-    global block_rise_as_y_px
-    global b_scale_h
-    global desired_scale
-    # global scalable_surf
-    # global scalable_surf_scale
-    global visual_debug_enable
-    global default_font
-    global popup_showing_text
-    global popup_surf
-    global popup_shadow_surf
-    global popup_text
-    global popup_alpha
-    global popup_sec
-    global prev_frame_ticks
-    global total_ticks
-    global frame_count
-    global good_45deg_tile_sizes
-    global square_sprite_size
+# region simulation
+sim_state = {}
+sim_state['accumulator'] = 0.0  # seconds not yet simulated
+sim_state['auto_step'] = True  # if True, draw_frame calls step_world
+sim_state['step_count'] = 0
+
+
+def set_auto_step(enable):
+    """If enable is False, draw_frame will only draw, and you must call
+    step_world yourself (such as at a different rate than drawing).
+    """
+    sim_state['auto_step'] = enable
+
+
+def step_world(seconds):
+    """Advance the simulation (unit physics) by seconds, using fixed
+    steps of the 'physics_step_sec' setting. Time left over is kept for
+    the next call (see get_unit_render_pos for interpolation).
+
+    Returns the number of fixed steps that were run.
+    """
+    step_sec = settings['physics_step_sec']
+    max_steps = settings['physics_max_steps']
+    update_streaming()
+    sim_state['accumulator'] += seconds
+    count = 0
+    while sim_state['accumulator'] >= step_sec:
+        if count >= max_steps:
+            # too far behind (such as after loading), so drop the time
+            # instead of spending more and more time catching up:
+            sim_state['accumulator'] = 0.0
+            break
+        batch_min = settings['physics_batch_min_units']
+        if ((np is not None) and (batch_min > 0)
+                and (len(units) >= batch_min)):
+            _step_units_batch(step_sec)
+        else:
+            if len(unit_arrays) > 0:
+                _detach_units()  # (step them as ordinary dicts)
+            for name, unit in units.items():
+                unit['tmp']['prev_pos'] = unit['pos']
+                _step_unit(name, unit, step_sec)
+        sim_state['accumulator'] -= step_sec
+        count += 1
+    sim_state['step_count'] += count
+    return count
+
+
+def get_unit_render_pos(unit):
+    """Get where to draw a unit: between its position before and after
+    the latest step, by how far into the next step the simulation is
+    (only if the 'physics_interpolate' setting is True).
+    """
+    pos = unit['pos']
+    prev_pos = _get_prev_pos(unit)
+    if (prev_pos is None) or (not settings['physics_interpolate']):
+        return pos
+    alpha = sim_state['accumulator'] / settings['physics_step_sec']
+    if alpha > 1.0:
+        alpha = 1.0
+    return (prev_pos[0] + (pos[0] - prev_pos[0]) * alpha,
+            prev_pos[1] + (pos[1] - prev_pos[1]) * alpha,
+            prev_pos[2] + (pos[2] - prev_pos[2]) * alpha)
+
+
+def _step_unit(k, unit, passed):
+    """Apply one physics step of passed seconds to a unit (gravity,
+    land acceleration, climbing and ground collision).
+    """
     places = 2
-    passed = 0.0  # seconds
-    passed_ms = 0
-    this_frame_ticks = pg.time.get_ticks()
-    fps = 0.0  # clock.get_fps()
-    global fps_s
-    global world
-    frame_gravity = None
-    if prev_frame_ticks is not None:
-        passed_ms = this_frame_ticks - prev_frame_ticks
-        prev_frame_ticks = this_frame_ticks
-        passed = float(passed_ms) / 1000.0
-        total_ticks += passed_ms
-        frame_count += 1
-        if total_ticks >= min_fps_ticks:
-            # avg = float(total_ticks) / float(min_fps_ticks)
-            fps = frame_count / (float(total_ticks)/1000.0)
-            fps_s = "{0:.1f}".format(round(fps, 1))
-        # if passed > 0.0:
-            # fps = 1000/passed
-            # fps_s = str(fps)
-            # fps_s = str(clock.get_fps())  # clock is only in game
+    debug_unit = visual_debug_enable and (k == player_unit_name)
+    debug_lines = None
+    if debug_unit:
+        debug_lines = []
+    what = unit.get('what')
+    if what is None:
+        print("ERROR: no 'what' (graphic aka material name) in"
+              " unit: " + str(unit))
+    material = materials[unit['what']]
+    anim = material['tmp']['sprites'][unit['pose']]
+    frame_gravity = world['gravity'] * passed
+    moved_vec3 = [0.0, 0.0, 0.0]
+    posA = (unit['pos'][0], unit['pos'][1], unit['pos'][2])
+    ground_yA = ground_height(posA[0], posA[2])
+    aglA = posA[1] - ground_yA
+    if debug_unit:
+        debug_lines.append(k+":")
+
+    on_ground = False
+    if posA[1] - ground_yA < kEpsilon:
+        on_ground = True
+    unit['tmp']['on_ground'] = on_ground
+
+    input_x = unit['tmp']['move_multipliers'][0]
+    input_y = unit['tmp']['move_multipliers'][2]
+    dest_heading = math.atan2(input_y, input_x)
+    mls = unit.get('max_land_mps', settings['human_run_mps'])
+    desired_multiplier = max(abs(input_x), abs(input_y))
+    if desired_multiplier > 1.0:
+        if debug_unit:
+            print("WARNING: desired_multiplier is " +
+                  str(desired_multiplier) + " (should be <=1)")
+        desired_multiplier = 1.0
+    mla = unit.get('max_land_accel',
+                   settings['human_run_accel'])
+    desired_accel = desired_multiplier * mla
+    ls_x = unit['mps_vec3'][0]
+    ls_y = unit['mps_vec3'][2]
+    ls = math.sqrt(ls_x*ls_x+ls_y*ls_y)  # current land speed
+    decel = 27  # TODO: make setting and override
+    if desired_accel <= kEpsilon:
+        ls -= (decel) * passed
+    else:
+        ls += desired_accel * passed
+    heading = math.radians(unit['yaw_deg'])
+    course = heading  # refined below if moving
+    if ls > mls:
+        ls = mls
+        course = math.atan2(ls_y, ls_x)
+    elif ls <= kEpsilon:
+        ls = 0.0
+    prev_heading = heading
+    mode = 'idle'
+    pose = unit.get('pose')
+    parts = pose.split(".")
+    prev_mode = parts[0]
+    if desired_multiplier > kEpsilon:
+        heading = dest_heading   # TODO: rotate toward
+        unit['yaw_deg'] = math.degrees(heading)
+        mode = 'walk'
+        if mode != prev_mode:
+            anim.iter()  # reset to frame 0
+    if (unit['move_in_air'] or on_ground or
+            (unit['tmp'].get('at_edge') is True)):
+        unit['mps_vec3'][0] = ls * math.cos(heading)
+        unit['mps_vec3'][2] = ls * math.sin(heading)
+    unit['mps_vec3'][1] -= frame_gravity
+
+    moved_vec3 = [unit['mps_vec3'][0] * passed,
+                  unit['mps_vec3'][1] * passed,
+                  unit['mps_vec3'][2] * passed]
+    if on_ground:
+        auto_pose(unit, mode=mode)
+    pose = unit.get('pose')
+    if debug_unit:
+        debug_lines.append("  unit['pos']: " +
+                           fmt_vec(unit['pos'], places=places))
+        debug_lines.append("  cell: " + get_key_at_pos(unit['pos']))
+        debug_lines.append("  yaw_deg: " + str(unit['yaw_deg']))
+        debug_lines.append("  prev_heading: " +
+                           str(math.degrees(prev_heading)))
+        debug_lines.append("  heading: " + str(math.degrees(heading)))
+        debug_lines.append("  pose: " + str(pose))
+        debug_lines.append("  max_land_mps: " + fmt_f(mls))
+        debug_lines.append("  unit['tmp']['move_multipliers']: " +
+                           fmt_vec(unit['tmp']['move_multipliers']))
+        debug_lines.append("  dest_heading: " +
+                           fmt_f(math.degrees(dest_heading)))
+        debug_lines.append("  land_speed_vec3: " +
+                           fmt_vec((ls_x, 0.0, ls_y)))
+        debug_lines.append("  desired_accel: " +
+                           fmt_f(desired_accel))
+
+    # NOTE: atan2 takes y,x and returns radians
+    dist_per_frame = 0.5  # TODO: make setting and override
+    if on_ground or \
+       (unit['tmp']['move_multipliers'][0] != 0.0) or \
+       (unit['tmp']['move_multipliers'][2] != 0.0):
+        if unit['animate']:
+            msa = unit['tmp'].get('moved_since_advance')
+            if msa is None:
+                msa = 0.0
+            msa += ls * passed
+            if msa >= dist_per_frame:
+                msa -= dist_per_frame
+                anim.advance()
+            unit['tmp']['moved_since_advance'] = msa
+
+    posB = [posA[0] + moved_vec3[0],
+            posA[1] + moved_vec3[1],
+            posA[2] + moved_vec3[2]]
+    ground_yB = ground_height(posB[0], posB[2])
+
+    # agl: # above ground level
+    aglB = posB[1] - ground_yB
+    limited_horz = False
+
+    push_msg = ""
+
+    if ground_yB - posB[1] > unit['auto_climb_max']:
+        if debug_unit:
+            push_msg += (" -- hit side since" +
+                         fmt_f(ground_yB - posB[1]) +
+                         "  >  " + fmt_f(unit['auto_climb_max']) +
+                         " auto_climb_max")
+        unit['mps_vec3'][0] = 0.0
+        unit['mps_vec3'][2] = 0.0
+        posB[0] = posA[0]
+        posB[2] = posA[2]
+        moved_vec3[0] = 0.0
+        moved_vec3[2] = 0.0
+        aglB = aglA
+        ground_yB = ground_yA
+        limited_horz = True
+        unit['tmp']['at_edge'] = True
+    else:
+        unit['tmp']['at_edge'] = False
+
+    if posB[1] < ground_yB:
+        aglB = 0.0
+        posB[1] = ground_yB
+        moved_vec3[1] = posB[1] - posA[1]
+
+    if aglB <= 0.0:
+        if debug_unit:
+            debug_lines.append("on ground " + push_msg)
+        if unit['mps_vec3'][1] < 0.0:
+            unit['mps_vec3'][1] = 0.0
+        # else must be jumping or no vertical movement
+    else:
+        if debug_unit:
+            debug_lines.append("airborne")
+
+    unit['pos'] = (posB[0], posB[1], posB[2])
+    _update_unit_cell(unit)
+
+    if limited_horz:
+        ground_yB = ground_height(unit['pos'][0], unit['pos'][2])
+    if debug_unit:
+        debug_lines.append("  unit['mps_vec3']: " +
+                           fmt_vec(unit['mps_vec3'], places=places))
+        debug_lines.append("  moved_vec3:" +
+                           fmt_vec(moved_vec3, places=places))
+    unit['tmp']['debug_lines'] = debug_lines
+    unit['tmp']['prev_ground_yB'] = ground_yB
+    if unit['pos'][1] < -8:
+        # return to spawn (origin)
+        teleport_unit_2d(unit, 0, 0)
+
+
+class UnitDict(dict):
+    """A unit's values (units[name] for units placed by _place_unit).
+    While _step_units_batch steps the unit, its class is UnitView
+    instead, so the dict stays the same object.
+    """
+
+
+class UnitView(UnitDict):
+    """A unit whose physics values (see UNIT_ARRAY_KEYS) are stored in
+    unit_arrays at index self.row, so reading or setting unit[key] reads
+    or sets the arrays. Other keys (and unit['tmp']) are stored in the
+    dict as usual. unit['mps_vec3'] is a row of unit_arrays['mps'] (so
+    it can be changed in place as with a list), and so is
+    unit['tmp']['move_multipliers'] (setting either to a new list copies
+    the list into the row).
+    """
+
+    def __getitem__(self, key):
+        name = UNIT_ARRAY_KEYS.get(key)
+        if name is None:
+            return dict.__getitem__(self, key)
+        if not dict.__contains__(self, key):
+            raise KeyError(key)
+        values = unit_arrays[name]
+        if name == 'pos':
+            return tuple(values[self.row].tolist())
+        if name == 'mps':
+            return values[self.row]
+        return values[self.row].item()
+
+    def get(self, key, default=None):
+        if dict.__contains__(self, key):
+            return self[key]
+        return default
+
+    def __setitem__(self, key, value):
+        dict.__setitem__(self, key, value)
+        if key in UNIT_ARRAY_KEYS:
+            _set_unit_array_value(self.row, key, value)
+
+    def __delitem__(self, key):
+        dict.__delitem__(self, key)
+        name = UNIT_ARRAY_KEYS.get(key)
+        if name is not None:
+            unit_arrays[name][self.row] = np.nan  # (see _get_arrays_mls)
+
+    def __iter__(self):
+        # (overridden so dict(unit) gets values with __getitem__)
+        return dict.__iter__(self)
+
+    def items(self):
+        return [(key, _get_plain_value(self, key))
+                for key in dict.keys(self)]
+
+    def values(self):
+        return [_get_plain_value(self, key) for key in dict.keys(self)]
+
+    def copy(self):
+        return dict(self.items())
+
+    def update(self, *args, **kwargs):
+        for key, value in dict(*args, **kwargs).items():
+            self[key] = value
+
+    def setdefault(self, key, default=None):
+        if not dict.__contains__(self, key):
+            self[key] = default
+        return self[key]
+
+    def pop(self, key, *args):
+        if dict.__contains__(self, key):
+            value = _get_plain_value(self, key)
+            del self[key]
+            return value
+        return dict.pop(self, key, *args)
+
+    def __reduce_ex__(self, protocol):
+        # copies (such as by copy.deepcopy) are plain dicts
+        return (dict, (self.items(),))
+
+    def __repr__(self):
+        return repr(dict(self.items()))
+
+
+UNIT_ARRAY_KEYS = {
+    'pos': 'pos',
+    'mps_vec3': 'mps',
+    'yaw_deg': 'yaw',
+    'max_land_mps': 'mls',
+    'max_land_accel': 'mla',
+    'auto_climb_max': 'climb_max',
+    'move_in_air': 'free_move',
+    'animate': 'animate',
+    'pose': None,
+    'tmp': None,
+}
+"""unit keys that a UnitView stores in unit_arrays, where value is the
+array (None for keys stored in the dict that _step_units_batch still
+has to know were set)"""
+unit_arrays = {}
+"""the units _step_units_batch steps, stored as arrays where index i is
+unit_arrays['units'][i] (a UnitView): 'pos', 'mps' (velocity),
+'moves' (unit['tmp']['move_multipliers']) and 'prev_pos' (count by 3),
+'yaw', 'mls' and 'mla' (max_land_mps and max_land_accel, NaN for the
+default), 'climb_max', 'free_move' (move_in_air), 'animate',
+'at_edge', 'on_ground' and 'moved_since_advance' (of unit['tmp']),
+'walk_pose' (the pose is a walk pose), 'pose_set' (unit['pose'] was
+set since the latest step), and 'placed' (unit['pos'] or unit['tmp']
+was set since the latest step). It also has the unit dicts' 'tmps' and
+the 'move_views' rows given to them, the 'cells' (col, row) units were
+in and the 'ground' height there, 'heights_version' (of those ground
+heights), and 'posed_walking' and 'posed_yaw' (the mode and yaw_deg of
+each unit's latest auto_pose). The arrays are only gathered from the
+unit dicts again when units are added or removed (see
+_set_unit_arrays)."""
+
+
+def _set_unit_array_value(row, key, value):
+    """Store a value set on a UnitView in unit_arrays."""
+    if key == 'pose':
+        unit_arrays['walk_pose'][row] = value.partition(".")[0] == 'walk'
+        unit_arrays['pose_set'][row] = True
+    elif key == 'tmp':
+        unit_arrays['tmps'][row] = value
+        unit_arrays['placed'][row] = True  # (get its values again)
     else:
+        unit_arrays[UNIT_ARRAY_KEYS[key]][row] = value
+        if key == 'pos':
+            unit_arrays['placed'][row] = True
+
+
+def _get_plain_value(unit, key):
+    """Get a UnitView's value as it would be in a plain unit dict."""
+    value = unit[key]
+    if key == 'mps_vec3':
+        return value.tolist()
+    return value
+
+
+def _get_prev_pos(unit):
+    """Get where get_unit_render_pos interpolates a unit from."""
+    if type(unit) is UnitView:
+        return tuple(unit_arrays['prev_pos'][unit.row].tolist())
+    return unit['tmp'].get('prev_pos')
+
+
+def _set_prev_pos(unit, pos):
+    if type(unit) is UnitView:
+        unit_arrays['prev_pos'][unit.row] = pos
+    else:
+        unit['tmp']['prev_pos'] = pos
+
+
+def _detach_units():
+    """Store unit_arrays back into the unit dicts (making them
+    ordinary dicts again), then forget unit_arrays.
+    """
+    views = unit_arrays.get('units')
+    if views is not None:
+        columns = {}
+        for key, name in UNIT_ARRAY_KEYS.items():
+            if name is not None:
+                columns[key] = unit_arrays[name].tolist()
+        moves = unit_arrays['moves'].tolist()
+        prev_pos = unit_arrays['prev_pos'].tolist()
+        at_edge = unit_arrays['at_edge'].tolist()
+        on_ground = unit_arrays['on_ground'].tolist()
+        msa = unit_arrays['moved_since_advance'].tolist()
+        for i, unit in enumerate(views):
+            for key, values in columns.items():
+                if dict.__contains__(unit, key):
+                    dict.__setitem__(unit, key, values[i])
+            dict.__setitem__(unit, 'pos', tuple(columns['pos'][i]))
+            tmp = unit_arrays['tmps'][i]
+            if tmp['move_multipliers'] is unit_arrays['move_views'][i]:
+                tmp['move_multipliers'] = moves[i]
+            tmp['prev_pos'] = tuple(prev_pos[i])
+            tmp['at_edge'] = at_edge[i]
+            tmp['on_ground'] = on_ground[i]
+            tmp['moved_since_advance'] = msa[i]
+            unit.__class__ = UnitDict
+            unit.row = None
+    unit_arrays.clear()
+
+
+def _set_unit_arrays(named_units):
+    """Gather unit_arrays from a list of (name, unit) pairs, making each
+    unit a UnitView (a unit that is a plain dict is replaced in units by
+    a UnitView with the same values).
+    """
+    _detach_units()
+    views = []
+    for name, unit in named_units:
+        if type(unit) is UnitDict:
+            unit.__class__ = UnitView
+        elif type(unit) is not UnitView:
+            unit = UnitView(unit)
+            units[name] = unit
+        views.append(unit)
+    count = len(views)
+    get = dict.get
+    tmps = [get(unit, 'tmp') for unit in views]
+    pos = _gather_vec3s([get(unit, 'pos') for unit in views], count)
+    unit_arrays['units'] = views
+    unit_arrays['tmps'] = tmps
+    unit_arrays['pos'] = pos
+    unit_arrays['mps'] = _gather_vec3s([get(unit, 'mps_vec3')
+                                        for unit in views], count)
+    moves = _gather_vec3s([tmp['move_multipliers'] for tmp in tmps], count)
+    unit_arrays['moves'] = moves
+    unit_arrays['move_views'] = list(moves)  # (rows, not copies)
+    for tmp, row in zip(tmps, unit_arrays['move_views']):
+        tmp['move_multipliers'] = row
+    unit_arrays['prev_pos'] = _gather_vec3s(
+        [tmp.get('prev_pos', get(unit, 'pos'))
+         for unit, tmp in zip(views, tmps)],
+        count
+    )
+    for key, dtype in (('yaw_deg', float), ('max_land_mps', float),
+                       ('max_land_accel', float), ('auto_climb_max', float),
+                       ('move_in_air', bool), ('animate', bool)):
+        default = np.nan if dtype is float else False
+        unit_arrays[UNIT_ARRAY_KEYS[key]] = np.array(
+            [get(unit, key, default) for unit in views], dtype=dtype
+        )
+    unit_arrays['at_edge'] = np.array([tmp.get('at_edge') is True
+                                       for tmp in tmps], dtype=bool)
+    unit_arrays['on_ground'] = np.array([tmp.get('on_ground') is True
+                                         for tmp in tmps], dtype=bool)
+    unit_arrays['moved_since_advance'] = np.array(
+        [tmp.get('moved_since_advance', 0.0) for tmp in tmps], dtype=float
+    )
+    unit_arrays['walk_pose'] = np.array(
+        [get(unit, 'pose').partition(".")[0] == 'walk' for unit in views],
+        dtype=bool
+    )
+    unit_arrays['pose_set'] = np.ones(count, dtype=bool)  # never posed
+    unit_arrays['placed'] = np.zeros(count, dtype=bool)
+    # no cell is this far away, so the ground under each is looked up:
+    unit_arrays['cells'] = np.full((count, 2), np.iinfo(np.int64).max,
+                                   dtype=np.int64)
+    unit_arrays['ground'] = np.zeros(count)
+    unit_arrays['heights_version'] = heights_version
+    unit_arrays['posed_walking'] = np.zeros(count, dtype=bool)
+    unit_arrays['posed_yaw'] = np.full(count, np.nan)
+    for i, unit in enumerate(views):
+        unit.row = i
+
+
+def _gather_vec3s(vec3s, count):
+    """Get a count by 3 array from a sequence of count 3-long sequences
+    (faster than np.array for a list of tuples).
+    """
+    return np.fromiter(itertools.chain.from_iterable(vec3s), dtype=float,
+                       count=count * 3).reshape(count, 3)
+
+
+def _step_units_batch(passed):
+    """Apply one physics step of passed seconds to every unit like
+    _step_unit does, but to all of them at once using unit_arrays
+    (except the player unit, which _step_unit steps so that it still
+    has debug information).
+
+    The units stay in unit_arrays between steps, and units[name] is a
+    UnitView of them, so game code can read and change units[name]
+    between steps as usual. The arrays are only gathered again when
+    units are added or removed.
+    """
+    named_units = []
+    player_unit = None
+    for name, unit in units.items():
+        if name == player_unit_name:
+            player_unit = unit
+        else:
+            named_units.append((name, unit))
+    views = unit_arrays.get('units')
+    if (views is None) or (len(views) != len(named_units)) or any(
+            map(operator.is_not, views, map(_get_second, named_units))):
+        _set_unit_arrays(named_units)
+        views = unit_arrays['units']
+    if player_unit is not None:
+        player_unit['tmp']['prev_pos'] = player_unit['pos']
+        _step_unit(player_unit_name, player_unit, passed)
+    count = len(views)
+    if count < 1:
+        return
+    a = unit_arrays
+    if a['heights_version'] != heights_version:
+        # a stack changed or a chunk (un)loaded, so look up all ground:
+        a['cells'][:] = np.iinfo(np.int64).max
+        a['heights_version'] = heights_version
+    tmps = a['tmps']
+    moves = a['moves']
+    move_views = a['move_views']
+    replaced = np.fromiter(map(operator.is_not,
+                               map(_get_move_multipliers, tmps),
+                               move_views),
+                           dtype=bool, count=count)
+    for i in np.nonzero(replaced)[0].tolist():
+        # game code set a new list, so use it (and make it a row again):
+        moves[i] = tmps[i]['move_multipliers']
+        tmps[i]['move_multipliers'] = move_views[i]
+    placed = a['placed']
+    for i in np.nonzero(placed)[0].tolist():
+        # (teleported or new tmp, so its tmp values may have changed)
+        a['at_edge'][i] = tmps[i].get('at_edge') is True
+        a['on_ground'][i] = tmps[i].get('on_ground') is True
+    placed[:] = False
+    posA = a['pos'].copy()
+    a['prev_pos'][:] = posA
+    mps = a['mps']
+    yaw_deg = a['yaw']
+    mls = np.where(np.isnan(a['mls']), settings['human_run_mps'],
+                   a['mls'])
+    mla = np.where(np.isnan(a['mla']), settings['human_run_accel'],
+                   a['mla'])
+    climb_max = a['climb_max']
+    free_move = a['free_move'] | a['at_edge']
+    animate = a['animate']
+
+    cellsA = np.rint(posA[:, 0::2]).astype(np.int64)
+    ground_yA = a['ground'].copy()
+    old_cells = a['cells']
+    for i in np.nonzero((cellsA[:, 0] != old_cells[:, 0])
+                        | (cellsA[:, 1] != old_cells[:, 1]))[0].tolist():
+        ground_yA[i] = ground_height(posA[i, 0], posA[i, 2])
+    aglA = posA[:, 1] - ground_yA
+    on_ground = aglA < kEpsilon
+
+    input_x = moves[:, 0]
+    input_y = moves[:, 2]
+    dest_heading = np.arctan2(input_y, input_x)
+    desired_multiplier = np.minimum(
+        np.maximum(np.abs(input_x), np.abs(input_y)), 1.0
+    )
+    desired_accel = desired_multiplier * mla
+    ls = np.sqrt(mps[:, 0] * mps[:, 0] + mps[:, 2] * mps[:, 2])
+    decel = 27  # TODO: make setting and override (see _step_unit)
+    ls = np.where(desired_accel <= kEpsilon, ls - decel * passed,
+                  ls + desired_accel * passed)
+    ls = np.where(ls > mls, mls, np.where(ls <= kEpsilon, 0.0, ls))
+    walking = desired_multiplier > kEpsilon
+    heading = np.where(walking, dest_heading, np.radians(yaw_deg))
+    yaw_deg[walking] = np.degrees(dest_heading[walking])
+    steer = free_move | on_ground
+    mps[steer, 0] = ls[steer] * np.cos(heading[steer])
+    mps[steer, 2] = ls[steer] * np.sin(heading[steer])
+    mps[:, 1] -= world['gravity'] * passed
+
+    # animation (only units that need it call into Python):
+    msa = a['moved_since_advance']
+    msa += np.where(animate & (on_ground | (input_x != 0.0)
+                               | (input_y != 0.0)),
+                    ls * passed, 0.0)
+    dist_per_frame = 0.5  # TODO: make setting and override
+    advanced = msa >= dist_per_frame
+    msa -= np.where(advanced, dist_per_frame, 0.0)
+    started = walking & ~a['walk_pose']
+    for i in np.nonzero(advanced | started)[0].tolist():
+        unit = views[i]
+        anim = materials[unit['what']]['tmp']['sprites'][unit['pose']]
+        if started[i]:
+            anim.iter()  # reset to frame 0
+        if advanced[i]:
+            anim.advance()
+    # auto_pose only if the mode or yaw changed since the last time:
+    # (or game code changed the pose):
+    repose = np.nonzero(on_ground & ((walking != a['posed_walking'])
+                                     | (yaw_deg != a['posed_yaw'])
+                                     | a['pose_set']))[0]
+    for i in repose.tolist():
+        auto_pose(views[i], mode=('walk' if walking[i] else 'idle'))
+    a['posed_walking'][repose] = walking[repose]
+    a['posed_yaw'][repose] = yaw_deg[repose]
+    a['pose_set'][:] = False
+
+    posB = posA + mps * passed
+    cellsB = np.rint(posB[:, 0::2]).astype(np.int64)
+    ground_yB = ground_yA.copy()
+    for i in np.nonzero((cellsB[:, 0] != cellsA[:, 0])
+                        | (cellsB[:, 1] != cellsA[:, 1]))[0].tolist():
+        ground_yB[i] = ground_height(posB[i, 0], posB[i, 2])
+    aglB = posB[:, 1] - ground_yB
+    at_edge = (ground_yB - posB[:, 1]) > climb_max
+    mps[at_edge, 0] = 0.0
+    mps[at_edge, 2] = 0.0
+    posB[at_edge, 0] = posA[at_edge, 0]
+    posB[at_edge, 2] = posA[at_edge, 2]
+    cellsB[at_edge] = cellsA[at_edge]
+    aglB = np.where(at_edge, aglA, aglB)
+    ground_yB = np.where(at_edge, ground_yA, ground_yB)
+    below = posB[:, 1] < ground_yB
+    aglB[below] = 0.0
+    posB[below, 1] = ground_yB[below]
+    mps[(aglB <= 0.0) & (mps[:, 1] < 0.0), 1] = 0.0
+    a['pos'][:] = posB
+
+    # store only the values game code reads from unit['tmp']:
+    for i in np.nonzero(at_edge != a['at_edge'])[0].tolist():
+        tmps[i]['at_edge'] = bool(at_edge[i])
+    for i in np.nonzero(on_ground != a['on_ground'])[0].tolist():
+        tmps[i]['on_ground'] = bool(on_ground[i])
+    a['at_edge'] = at_edge
+    a['on_ground'] = on_ground
+    for i in np.nonzero((cellsB[:, 0] != cellsA[:, 0])
+                        | (cellsB[:, 1] != cellsA[:, 1]))[0].tolist():
+        _update_unit_cell(views[i])
+    a['cells'] = cellsB
+    a['ground'] = ground_yB
+    for i in np.nonzero(posB[:, 1] < -8)[0].tolist():
+        # return to spawn (origin)
+        teleport_unit_2d(views[i], 0, 0)
+
+
+_get_second = operator.itemgetter(1)
+_get_move_multipliers = operator.itemgetter('move_multipliers')
+# endregion simulation
+
+
+# region headless
+headless = False
+"""True after init_headless (nothing is drawn, and text is ignored)"""
+
+
+def init_headless():
+    """Prepare pygame for running without a display (such as on a server
+    or for batch simulation): use SDL's dummy video and audio drivers
+    (unless SDL_VIDEODRIVER or SDL_AUDIODRIVER is already set) and make
+    the tiny display surface that loading sprites requires.
+
+    Afterward, load materials and a world, place units, then call
+    step_world, push_node and pop_node as usual, but do not call
+    draw_frame.
+    """
+    global headless
+    os.environ.setdefault('SDL_VIDEODRIVER', 'dummy')
+    os.environ.setdefault('SDL_AUDIODRIVER', 'dummy')
+    pg.display.init()
+    pg.display.set_mode((1, 1))
+    set_auto_step(False)
+    headless = True
+
+
+def run_ticks(count, seconds=None):
+    """Run step_world count times without drawing.
+
+    Keyword arguments:
+    seconds -- how much time each tick simulates (default: the
+               'physics_step_sec' setting, so each tick is one step)
+
+    Returns the total number of physics steps that were run.
+    """
+    if seconds is None:
+        seconds = settings['physics_step_sec']
+    steps = 0
+    for i in range(count):
+        steps += step_world(seconds)
+    return steps
+# endregion headless
+
+
+# region frame profiling
+PROFILE_PHASES = ['input', 'physics', 'setup', 'terrain', 'units', 'ui',
+                  'debug', 'frame']
+"""named parts of draw_frame (setup is scaling and placing the view,
+debug includes the profile overlay, and frame is the whole draw_frame
+call)"""
+frame_phase_ms = {}  # time spent in each phase so far this frame
+frame_times = {}
+"""recent frames' times (in milliseconds), where key is a phase and
+value is a list of up to the 'profile_frames' setting (oldest first)"""
+profile_overlay_enable = False
+
+
+def profile_add(phase, start):
+    """Add the time since start (a time.perf_counter() value) to phase
+    for this frame. A phase can be added more than once per frame.
+
+    Returns time.perf_counter() so calls can be chained.
+    """
+    now = time.perf_counter()
+    frame_phase_ms[phase] = (frame_phase_ms.get(phase, 0.0)
+                             + (now - start) * 1000.0)
+    return now
+
+
+def _end_profile_frame():
+    max_count = settings['profile_frames']
+    for phase in PROFILE_PHASES:
+        times = frame_times.get(phase)
+        if times is None:
+            times = []
+            frame_times[phase] = times
+        times.append(frame_phase_ms.get(phase, 0.0))
+        if len(times) > max_count:
+            del times[:len(times)-max_count]
+    frame_phase_ms.clear()
+
+
+def get_percentile(values, percent):
+    """Get the value at percent (0 to 100) of values (nearest rank).
+
+    Sequential arguments:
+    values -- a list of numbers which must already be sorted
+    """
+    if len(values) < 1:
+        return None
+    i = int(math.ceil(percent / 100.0 * len(values))) - 1
+    return values[clamp(i, 0, len(values) - 1)]
+
+
+def get_frame_profile():
+    """Get the recent frame time of each phase of draw_frame (see
+    PROFILE_PHASES), in milliseconds, as a dict where key is a phase
+    and value is a dict with 'last', 'p50', 'p95', 'p99' and 'max'.
+    """
+    ret = {}
+    for phase, times in frame_times.items():
+        if len(times) < 1:
+            continue
+        sorted_times = sorted(times)
+        ret[phase] = {
+            'last': times[-1],
+            'p50': get_percentile(sorted_times, 50),
+            'p95': get_percentile(sorted_times, 95),
+            'p99': get_percentile(sorted_times, 99),
+            'max': sorted_times[-1],
+        }
+    return ret
+
+
+def toggle_profile_overlay():
+    global profile_overlay_enable
+    profile_overlay_enable = not profile_overlay_enable
+
+
+def draw_profile_overlay(screen):
+    """Draw a graph of recent frame times (with a line at 60 FPS) and
+    the percentiles of each phase in the upper right.
+    """
+    times = frame_times.get('frame')
+    if not times:
+        return
+    ensure_default_font()
+    graph_h = 60
+    ms_per_px = 50.0 / graph_h  # top of the graph is 50 ms
+    right = screen.get_width() - 4
+    left = right - len(times)
+    graph_rect = pg.Rect(left, 4, len(times), graph_h)
+    screen.fill((0, 0, 0), graph_rect)
+    for i in range(len(times)):
+        bar_h = min(int(times[i] / ms_per_px), graph_h)
+        color = (60, 200, 60)
+        if times[i] > 1000.0 / 30.0:
+            color = (225, 60, 60)
+        elif times[i] > 1000.0 / 60.0:
+            color = (225, 200, 60)
+        x = left + i
+        pg.draw.line(screen, color, (x, 4 + graph_h),
+                     (x, 4 + graph_h - bar_h))
+    y_60 = 4 + graph_h - int((1000.0 / 60.0) / ms_per_px)
+    pg.draw.line(screen, (128, 128, 128), (left, y_60), (right, y_60))
+    profile = get_frame_profile()
+    y = 4 + graph_h + 2
+    for phase in PROFILE_PHASES:
+        stats = profile.get(phase)
+        if stats is None:
+            continue
+        line = (phase + " p50 " + fmt_f(stats['p50']) + " p95 " +
+                fmt_f(stats['p95']) + " p99 " + fmt_f(stats['p99']))
+        # (the numbers change every frame, so draw cached characters
+        # instead of filling text_cache; see _push_glyph_line)
+        y += _push_glyph_line(line, (255, 255, 255), right, y,
+                              right=True)
+    flush_text(screen)
+# endregion frame profiling
+
+
+# region cached terrain layer
+terrain_layer_chunks = set()
+"""locations of chunks that have a cached chunk['layer']"""
+
+
+def _get_stack_screen_pos(col, row, camera_px):
+    """Get the screen position of the bottom block of a stack (each
+    block above it is block_rise_as_y_px higher).
+
+    The position is floored so that a pre-rendered row of a chunk lines
+    up with stacks drawn one at a time even when partly offscreen.
+    """
+    x, y = vec2_from_vec3_via_camera((float(col), 0.0, float(row)),
+                                     cam_vec2=camera_px)
+    return (int(math.floor(x - scaled_b_size[0] / 2)),
+            int(math.floor(y - scaled_b_size[1] / 2)))
+
+
+def _blit_stack(blits, stack, x, y, rise_px):
+    """Add the nodes of a stack, from the bottom up, to a list of
+    (surface, dest) pairs for Surface.blits.
+
+    Sequential arguments:
+    stack -- palette ids (see get_stack_ids_at)
+    x, y -- position of the bottom block (see _get_stack_screen_pos)
+    rise_px -- how many pixels higher each block is
+    """
+    rise = 0
+    for node_id in stack:
+        anim = palette_anims[node_id]
+        if anim is False:
+            anim = get_palette_anim(node_id)
+        if anim is not None:
+            phase = 0
+            if palette_animated[node_id]:
+                if not anim.clock_enable:
+                    add_clock_anim(anim)
+                phase = node_palette[node_id].get('phase', 0)
+            if rise > 0:
+                # the side of every block above the bottom one shows
+                if rise >= 2:
+                    lowlight = LOWLIGHT_LEVELS[1]
+                else:
+                    lowlight = LOWLIGHT_LEVELS[0]
+                blits.append((get_scaled_frame(anim, scaled_b_size,
+                                               lowlight=lowlight,
+                                               phase=phase),
+                              (x, y - rise * rise_px)))
+            blits.append((get_scaled_frame(anim, scaled_b_size,
+                                           phase=phase),
+                          (x, y - (rise + 1) * rise_px)))
+        rise += 1
+
+
+def _render_terrain_strip(chunk, local_row):
+    """Pre-render one row of a chunk at the current scaled_b_size.
+
+    Returns a dict where 'surf' is the pre-composited surface (None if
+    the row is empty or animated), 'height' is the height of the
+    tallest stack in the row, and 'animated' is True if any node is
+    animated (so the row must be drawn live).
+    """
+    strip = {'surf': None, 'height': 0, 'animated': False}
+    offset = local_row << CHUNK_SHIFT
+    stacks = chunk['stacks'][offset:offset+CHUNK_SIZE]
+    for stack in stacks:
+        if stack is None:
+            continue
+        if len(stack) > strip['height']:
+            strip['height'] = len(stack)
+        for node_id in stack:
+            if palette_animated[node_id]:
+                strip['animated'] = True
+    if strip['animated'] or (strip['height'] < 1):
+        return strip
+    w, h = scaled_b_size
+    rise_px = block_rise_as_y_px
+    surf = pg.Surface((w * CHUNK_SIZE, rise_px * strip['height']),
+                      flags=pg.SRCALPHA)
+    blits = []
+    for i in range(CHUNK_SIZE):
+        if stacks[i] is not None:
+            _blit_stack(blits, stacks[i], i * w,
+                        rise_px * strip['height'], rise_px)
+    surf.blits(blits, doreturn=False)
+    strip['surf'] = surf
+    return strip
+
+
+def _get_terrain_strip(chunk, local_row):
+    """Get a cached row of a chunk (see _render_terrain_strip),
+    rendering it if it is missing or was rendered at another scale.
+    """
+    layer = chunk.get('layer')
+    if (layer is None) or (layer['size'] != scaled_b_size):
+        layer = {}
+        layer['size'] = scaled_b_size
+        layer['strips'] = [None] * CHUNK_SIZE
+        chunk['layer'] = layer
+        terrain_layer_chunks.add(chunk['loc'])
+    strip = layer['strips'][local_row]
+    if strip is None:
+        strip = _render_terrain_strip(chunk, local_row)
+        layer['strips'][local_row] = strip
+    return strip
+
+
+def mark_stack_dirty(col, row):
+    """Make the cached terrain layer redraw the row containing a stack,
+    make save_world save the stack's chunk, and update stack_max. Call
+    this if you change a stack without push_node or pop_node.
+    """
+    chunk = get_chunk((col >> CHUNK_SHIFT, row >> CHUNK_SHIFT))
+    if chunk is not None:
+        chunk['dirty'] = True
+        _track_stack_height(chunk, col, row)
+        layer = chunk.get('layer')
+        if layer is not None:
+            layer['strips'][row & CHUNK_MASK] = None
+
+
+def _discard_terrain_layers(keep_locs):
+    """Free the cached layers of chunks that were not drawn."""
+    global terrain_layer_chunks
+    for chunk_loc in terrain_layer_chunks - keep_locs:
+        chunk = get_chunk(chunk_loc)
+        if chunk is not None:
+            chunk['layer'] = None
+    terrain_layer_chunks = keep_locs
+# endregion cached terrain layer
+
+
+def draw_frame(screen):
+    global settings
+    global temp_screen
+    global text_pos
+    global win_size
+    # global scaled_size
+    global scaled_b_size
+    global block_half_counts
+    global start_loc
+    global end_loc
+    global block_rise_as_y_px
+    global b_scale_h
+    global desired_scale
+    # global scalable_surf
+    # global scalable_surf_scale
+    global visual_debug_enable
+    global default_font
+    global popup_showing_text
+    global popup_surf
+    global popup_shadow_surf
+    global popup_text
+    global popup_alpha
+    global popup_sec
+    global prev_frame_ticks
+    global total_ticks
+    global frame_count
+    global good_45deg_tile_sizes
+    global square_sprite_size
+    frame_start = time.perf_counter()
+    passed = 0.0  # seconds
+    passed_ms = 0
+    this_frame_ticks = pg.time.get_ticks()
+    fps = 0.0  # clock.get_fps()
+    global fps_s
+    global world
+    if prev_frame_ticks is not None:
+        passed_ms = this_frame_ticks - prev_frame_ticks
         prev_frame_ticks = this_frame_ticks
+        passed = float(passed_ms) / 1000.0
+        total_ticks += passed_ms
+        frame_count += 1
+        if total_ticks >= min_fps_ticks:
+            # avg = float(total_ticks) / float(min_fps_ticks)
+            fps = frame_count / (float(total_ticks)/1000.0)
+            fps_s = "{0:.1f}".format(round(fps, 1))
+            # start over so FPS is recent (see get_frame_profile for
+            # spikes):
+            total_ticks = 0
+            frame_count = 0
+        # if passed > 0.0:
+            # fps = 1000/passed
+            # fps_s = str(fps)
+            # fps_s = str(clock.get_fps())  # clock is only in game
+    else:
+        prev_frame_ticks = this_frame_ticks
+    t = frame_start
+    if sim_state['auto_step']:
+        step_world(passed)
+    else:
+        update_streaming()
+    t = profile_add('physics', t)
+    advance_animations(passed)
     ensure_default_font()
     text_pos = [4, 4]
+    # Lines pushed since the last frame (such as by step_world) were
+    # placed using the last frame's text_pos, so drop them:
+    del text_blits[:]
     # pg.draw.rect(screen, color, pg.Rect(x, y, 64, 64))
     new_win_size = screen.get_size()
     if (win_size is None or
@@ -1940,10 +3491,13 @@ def draw_frame(screen):
     # scaled_b_size = (game_tile_size[0] * b_scale_h,
     #                      game_tile_size[1] * block_scale_vert)
     scaled_b_size = None
-    push_text("stack_max: " + str(stack_max))
-    push_text("stack_max_keys: " + str(stack_max_keys))
-    push_text("get_target_node_key(): "
-              + str(get_target_node_key()))
+    if visual_debug_enable:
+        push_text("stack_max: " + str(stack_max))
+        # (the count of stacks at stack_max, without finding them):
+        push_text("tallest stack count: "
+                  + str(stack_heights.get(stack_max, 0)))
+        push_text("get_target_node_key(): "
+                  + str(get_target_node_key()))
     for try_size in good_45deg_tile_sizes:
         if try_size[0] >= ideal_tile_w:
             scaled_b_size = try_size
@@ -1992,6 +3546,7 @@ def draw_frame(screen):
         # scalable_surf_scale = b_scale_h
         # temp_screen = scalable_surf
     temp_screen = screen
+    _update_scaled_frames_scale()
 
     # scalable_surf.fill((0, 0, 0))
     screen.fill((0, 0, 0))
@@ -2021,17 +3576,19 @@ def draw_frame(screen):
     screen_half = win_size[0] / 2, win_size[0] / 2
     w, h = scaled_b_size
 
-    stacks = world['blocks']
     # for k, v in stacks.items():
     block_y = start_loc[1]
     camera_px = (int(camera['pos'][0] * scaled_b_size[0]),
                  int(camera['pos'][2] * scaled_b_size[1]))
 
+    t = profile_add('setup', t)
     e = _process_touch(screen)
     if e is not None:
         if e.get('ignore') is True:
             e = None
+    t = profile_add('input', t)
     sel_key = None
+    sel_loc = None
     # blue cube for selection
     reachable_color = (60, 90, 225)
     sel_color = (200, 200, 128)  # yellow
@@ -2052,79 +3609,107 @@ def draw_frame(screen):
     is_top = True
     if e is not None:
         sel_key = e.get('spatial_key')
+        if sel_key is not None:
+            sel_loc = get_loc_from_key(sel_key)
         sel_vec3 = e.get('spatial_pos')
-    push_text("sel_vec3: " + str(sel_vec3))
-
+    if visual_debug_enable:
+        push_text("sel_vec3: " + str(sel_vec3))
+
+    layer_enable = settings['terrain_layer_enable']
+    rise_px = block_rise_as_y_px
+    sel_i = None
+    if (sel_loc is not None) and (sel_vec3 is not None):
+        sel_i = round(sel_vec3[1])
+    start_cx = start_loc[0] >> CHUNK_SHIFT
+    end_cx = end_loc[0] >> CHUNK_SHIFT
+    layer_chunks = set()
+    row_blits = []
+    # Rows below the screen are only drawn if something there is tall
+    # enough to reach the screen:
+    reach = stack_max
+    for unit in units.values():
+        if unit['pos'][1] + 2 > reach:
+            reach = int(math.ceil(unit['pos'][1])) + 2
+    bottom_y = win_size[1] + scaled_b_size[1]
+    if world.get('tmp') is not None:
+        # Keep every chunk these rows use loaded (stream_chunks_near
+        # loads stream_state['draw_area'] too):
+        low_row = block_y
+        while ((low_row - 1 >= end_loc[1]) and
+               (_get_stack_screen_pos(start_loc[0], low_row - 1,
+                                      camera_px)[1]
+                - reach * rise_px <= bottom_y)):
+            low_row -= 1
+        stream_state['draw_area'] = (start_loc[0], low_row,
+                                     end_loc[0], start_loc[1])
+        _stream_area(stream_state['draw_area'], stream_state['clock'])
     while block_y >= end_loc[1]:
-        block_x = start_loc[0]
+        row_y = _get_stack_screen_pos(start_loc[0], block_y, camera_px)[1]
+        if row_y - reach * rise_px > bottom_y:
+            break  # and rows after this are even lower
         sel_x = None
         sel_y = None
         prev_sel = False
         prev_units = {}
+        if layer_enable:
+            local_row = block_y & CHUNK_MASK
+            for cx in range(start_cx, end_cx + 1):
+                chunk = get_chunk((cx, block_y >> CHUNK_SHIFT))
+                if chunk is None:
+                    continue
+                if row_y - chunk['max_height'] * rise_px > bottom_y:
+                    continue  # nothing in the chunk reaches the screen
+                layer_chunks.add(chunk['loc'])
+                strip = _get_terrain_strip(chunk, local_row)
+                first_col = cx << CHUNK_SHIFT
+                if strip['animated']:
+                    # draw live since frames change
+                    stacks = chunk['stacks']
+                    offset = local_row << CHUNK_SHIFT
+                    for i in range(CHUNK_SIZE):
+                        col = first_col + i
+                        v = stacks[offset + i]
+                        if ((v is not None) and (col >= start_loc[0]) and
+                                (col <= end_loc[0])):
+                            x, y = _get_stack_screen_pos(col, block_y,
+                                                         camera_px)
+                            _blit_stack(row_blits, v, x, y, rise_px)
+                elif strip['surf'] is not None:
+                    x, y = _get_stack_screen_pos(first_col, block_y,
+                                                 camera_px)
+                    row_blits.append((strip['surf'],
+                                      (x, y - strip['height'] * rise_px)))
+        else:
+            block_x = start_loc[0]
+            while block_x <= end_loc[0]:
+                v = get_stack_ids_at(block_x, block_y)
+                if v is not None:
+                    x, y = _get_stack_screen_pos(block_x, block_y,
+                                                 camera_px)
+                    _blit_stack(row_blits, v, x, y, rise_px)
+                block_x += 1
+        # draw the terrain of the row, in order, with one call:
+        screen.blits(row_blits, doreturn=False)
+        del row_blits[:]
+        t = profile_add('terrain', t)
+        if (sel_i is not None) and (sel_loc[1] == block_y):
+            v = get_stack_ids_at(sel_loc[0], sel_loc[1])
+            if ((v is not None) and (sel_i >= 0) and (sel_i < len(v))
+                    and (sel_loc[0] >= start_loc[0])
+                    and (sel_loc[0] <= end_loc[0])):
+                prev_sel = True
+                sel_x, sel_y = _get_stack_screen_pos(sel_loc[0],
+                                                     sel_loc[1],
+                                                     camera_px)
+                sel_y -= sel_i * rise_px
+                sel_rise = rise_px
+        block_x = start_loc[0]
         while block_x <= end_loc[0]:
-            k = str(block_x) + "," + str(block_y)
-            v = stacks.get(k)
-            if v is not None:
-                cs = k.split(",")
-                sk = k  # spatial key
-                for unit_name, unit in units.items():
-                    if get_key_at_pos(unit['pos']) == k:
-                        prev_units[unit_name] = unit
-                col, row = (int(cs[0]), int(cs[1]))
-                # offset = 0
-                # rise_factor = .5
-                rise = 0.0
-                side = None
-                is_top = True
-                for i in range(len(v)):
-                    # rise_px = block_rise_as_y_px
-                    node = v[i]
-                    name = k + "[" + str(i) + "]"  # such as '0,0[1]'
-                    pos = (float(col), rise, float(row))
-                    anim = get_anim_from_node(node)
-                    if anim is None:
-                        rise += 1.0
-                        continue
-                    top = anim.get_surface()
-                    src_size = top.get_size()
-                    if rise > 0.0:
-                        if rise >= 2.0:
-                            anim.lowlight = .9
-                        else:
-                            anim.lowlight = .75
-                        side = anim.get_lowlit_surface()
-                    block_vec2 = vec2_from_vec3_via_camera(
-                        pos,
-                        cam_vec2=camera_px
-                    )
-                    x, y = block_vec2
-                    x -= scaled_b_size[0]/2
-                    y -= scaled_b_size[1]/2
-                    # x = ((pos[0]-camera_px[0]) + screen_half[0] -
-                    #      scaled_b_size[0]/2)
-                    # y = (-1*(pos[2]-camera_px[1]) + screen_half[1] -
-                    #      scaled_b_size[1]/2)
-                    if (sel_key == sk) and (i == round(sel_vec3[1])):
-                        prev_sel = True
-                        sel_x = x
-                        sel_y = y
-                        sel_rise = block_rise_as_y_px
-                        is_top = True
-                    else:
-                        is_top = False
-                    is_top = True
-                    if side is not None:
-                        screen.blit(pg.transform.scale(side,
-                                                       scaled_b_size),
-                                    (x, y))  # y-offset
-                    screen.blit(pg.transform.scale(top,
-                                                   scaled_b_size),
-                                (x, y-block_rise_as_y_px))  # y-offset
-                    animate = node.get('animate')
-                    if animate is True:
-                        anim.advance()
-                    # offset += block_rise_as_y_px
-                    rise += 1.0
+            names = unit_cells.get((block_x, block_y))
+            if names is not None:
+                if get_stack_ids_at(block_x, block_y) is not None:
+                    for unit_name in names:
+                        prev_units[unit_name] = units[unit_name]
             block_x += 1
         if prev_sel:
             pg.draw.rect(
@@ -2149,8 +3734,13 @@ def draw_frame(screen):
                 target_enable = False
         for unit_name, unit in prev_units.items():
             render_unit(screen, unit_name, unit, sprite_scale,
-                        camera_vec2=camera_px)
+                        camera_vec2=camera_px, blits=row_blits)
+        screen.blits(row_blits, doreturn=False)
+        del row_blits[:]
+        t = profile_add('units', t)
         block_y -= 1
+    _discard_terrain_layers(layer_chunks)
+    t = profile_add('terrain', t)
     global camera_target_unit_name
     if visual_debug_enable:
         if sel_key is None:
@@ -2159,287 +3749,69 @@ def draw_frame(screen):
         else:
             push_text("selection:")
             push_text("  key: " + str(sel_key))
-    sk = None  # must get specific one under unit
-    if passed is not None:
-        frame_gravity = world['gravity'] * passed
-
-    for k, unit in units.items():
-        # TODO: check for python2 units.iteritems()
-        debug_unit = visual_debug_enable and (k == player_unit_name)
-        what = unit.get('what')
-        if what is None:
-            print("ERROR: no 'what' (graphic aka material name) in"
-                  " unit: " + str(unit))
-        material = materials[unit['what']]
-        anim = material['tmp']['sprites'][unit['pose']]
-        moved_vec3 = [0.0, 0.0, 0.0]
-        posA = (unit['pos'][0], unit['pos'][1], unit['pos'][2])
-        posB = (posA[0], posA[1], posA[2])  # new pos after physics
-        skA = get_key_at_pos(posA)
-        skB = get_key_at_pos(posB)
-        ground_yA = None
-        # ground_yA = unit['tmp'].get('prev_ground_yB')
-
-        if ground_yA is None:
-            stackA = stacks.get(skA)
-            if stackA is not None:
-                ground_yA = float(len(stackA))
-            else:
-                ground_yA = nothing_y
-        aglA = posA[1] - ground_yA
-        if debug_unit:
-            # push_text("frame_gravity: " +
-            # fmt_f(frame_gravity, places=places))
-            push_text(k+":")
-            # push_text("  before.ground_y:" + str(ground_yA))
-            # push_text("  before.posA[1]:" + str(posA[1]))
-            # push_text("  before.agl:" + str(aglA))
-
-        on_ground = False
-        if posA[1] - ground_yA < kEpsilon:
-            on_ground = True
-        unit['tmp']['on_ground'] = on_ground
-
-        if passed is not None:
-            input_x = unit['tmp']['move_multipliers'][0]
-            input_y = unit['tmp']['move_multipliers'][2]
-            dest_heading = math.atan2(input_y, input_x)
-            mls = unit.get('max_land_mps', settings['human_run_mps'])
-            desired_multiplier = max(abs(input_x), abs(input_y))
-            if desired_multiplier > 1.0:
-                if debug_unit:
-                    print("WARNING: desired_multiplier is " +
-                          str(desired_multiplier) + " (should be <=1)")
-                desired_multiplier = 1.0
-            mla = unit.get('max_land_accel',
-                           settings['human_run_accel'])
-            desired_accel = desired_multiplier * mla
-            ls_x = unit['mps_vec3'][0]
-            ls_y = unit['mps_vec3'][2]
-            ls = math.sqrt(ls_x*ls_x+ls_y*ls_y)  # current land speed
-            decel = 27  # TODO: make setting and override
-            if desired_accel <= kEpsilon:
-                ls -= (decel) * passed
-            else:
-                ls += desired_accel * passed
-            heading = math.radians(unit['yaw_deg'])
-            course = heading  # refined below if moving
-            if ls > mls:
-                ls = mls
-                course = math.atan2(ls_y, ls_x)
-            elif ls <= kEpsilon:
-                ls = 0.0
-            # heading = math.radians(unit['yaw_deg'])
-            prev_heading = heading
-            mode = 'idle'
-            pose = unit.get('pose')
-            parts = pose.split(".")
-            prev_mode = parts[0]
-            if desired_multiplier > kEpsilon:
-                heading = dest_heading   # TODO: rotate toward
-                unit['yaw_deg'] = math.degrees(heading)
-                mode = 'walk'
-                if mode != prev_mode:
-                    anim.iter()  # reset to frame 0
-            if (unit['move_in_air'] or on_ground or
-                    (unit['tmp'].get('at_edge') is True)):
-                unit['mps_vec3'][0] = ls * math.cos(heading)
-                unit['mps_vec3'][2] = ls * math.sin(heading)
-            unit['mps_vec3'][1] -= frame_gravity
-
-            moved_vec3 = [unit['mps_vec3'][0] * passed,
-                          unit['mps_vec3'][1] * passed,
-                          unit['mps_vec3'][2] * passed]
-            if on_ground:
-                auto_pose(unit, mode=mode)
-            pose = unit.get('pose')
-            if debug_unit:
-                # push_text("  before.ground_y: " + str(ground_yA))
-                push_text("  unit['pos']: " +
-                          fmt_vec(unit['pos'], places=places))
-                push_text("  cell: " + get_key_at_pos(unit['pos']))
-                push_text("  yaw_deg: " + str(unit['yaw_deg']))
-                push_text("  prev_heading: " +
-                          str(math.degrees(prev_heading)))
-                push_text("  heading: " + str(math.degrees(heading)))
-                push_text("  pose: " + str(pose))
-                push_text("  max_land_mps: " + fmt_f(mls))
-                push_text("  unit['tmp']['move_multipliers']: " +
-                          fmt_vec(unit['tmp']['move_multipliers']))
-                push_text("  dest_heading: " +
-                          fmt_f(math.degrees(dest_heading)))
-                push_text("  land_speed_vec3: " +
-                          fmt_vec((ls_x, 0.0, ls_y)))
-                push_text("  desired_accel: " +
-                          fmt_f(desired_accel))
-                # push_text("  unit['mps_vec3']: " +
-                #           fmt_vec(unit['mps_vec3'], places=places))
-                # push_text("  moved_vec3: " +
-                #           fmt_vec(moved_vec3, places=places))
-
-            # NOTE: atan2 takes y,x and returns radians
-            dist_per_frame = 0.5  # TODO: make setting and override
-            if on_ground or \
-               (unit['tmp']['move_multipliers'][0] != 0.0) or \
-               (unit['tmp']['move_multipliers'][2] != 0.0):
-                if unit['animate']:
-                    msa = unit['tmp'].get('moved_since_advance')
-                    if msa is None:
-                        msa = 0.0
-                    msa += ls * passed
-                    if msa >= dist_per_frame:
-                        msa -= dist_per_frame
-                        anim.advance()
-                    unit['tmp']['moved_since_advance'] = msa
-
-            # if unit['pose'] != 0: print("iter " + unit['pose'])
-        # else:
-            # if unit['pose'] != 0: print("hold " + unit['pose'])
-        # screen_half = scaled_size[0] / 2, scaled_size[1] / 2
-        screen_half = win_size[0] / 2, win_size[0] / 2
-        w, h = game_tile_size
-        # center_tile_tl_pos = win_size[0]/2-game_tile_size[0]/2,
-        #                      win_size[1]/2-game_tile_size[1]/2
-        # center_tile_tl_pos = (0,0)
-        # unit['pos'][0] += moved_vec3[0]
-        # unit['pos'][1] + moved_vec3[2]
-        posB = [posA[0] + moved_vec3[0],
-                posA[1] + moved_vec3[1],
-                posA[2] + moved_vec3[2]]
-        skB = get_key_at_pos(posB)
-        stackB = stacks.get(skB)
-        if stackB is not None:
-            ground_yB = float(len(stackB))
-        else:
-            ground_yB = nothing_y
-
-        # offset = -block_rise_as_y_px
-        # prev_agl = posA[1] - ground_yA
-        # agl: # above ground level
-
-        aglB = posB[1] - ground_yB
-        # if debug_unit:
-        #     push_text("  processing.ground_y:" + str(ground_yB))
-        #     push_text("  processing.posB[1]:" + str(posB[1]))
-        #     push_text("  processing.agl:" + str(aglB))
-        limited_horz = False
-
-        push_msg = ""
-
-        if ground_yB - posB[1] > unit['auto_climb_max']:
-            push_msg += (" -- hit side since" +
-                         fmt_f(ground_yB - posB[1]) +
-                         "  >  " + fmt_f(unit['auto_climb_max']) +
-                         " auto_climb_max")
-            unit['mps_vec3'][0] = 0.0
-            unit['mps_vec3'][2] = 0.0
-            posB[0] = posA[0]
-            posB[2] = posA[2]
-            moved_vec3[0] = 0.0
-            moved_vec3[2] = 0.0
-            aglB = aglA
-            ground_yB = ground_yA
-            limited_horz = True
-            unit['tmp']['at_edge'] = True
-        else:
-            unit['tmp']['at_edge'] = False
-
-        if posB[1] < ground_yB:
-            # push_msg = "pushed up"
-            # fmt_f(posB[1]) + " to " + fmt_f(ground_yB)
-            aglB = 0.0
-            posB[1] = ground_yB
-            moved_vec3[1] = posB[1] - posA[1]
-
-        if aglB <= 0.0:
-            if debug_unit:
-                push_text("on ground " + push_msg)
-            if unit['mps_vec3'][1] < 0.0:
-                unit['mps_vec3'][1] = 0.0
-            # else must be jumping or no vertical movement
-        else:
-            if debug_unit:
-                push_text("airborne")
-
-        unit['pos'] = (posB[0], posB[1], posB[2])
-
-        if limited_horz:
-            skB = get_key_at_pos(unit['pos'])
-            stackB = stacks.get(skB)
-            if stackB is not None:
-                ground_yB = float(len(stackB))
-            else:
-                ground_yB = nothing_y
-        if debug_unit:
-            push_text("  unit['mps_vec3']: " +
-                      fmt_vec(unit['mps_vec3'], places=places))
-        unit['tmp']['prev_ground_yB'] = ground_yB
-        # render_unit(unit, sprite_scale)
-        if unit['pos'][1] < -8:
-            # return to spawn (origin)
-            teleport_unit_2d(unit, 0, 0)
-        if k == player_unit_name:
-            if visual_debug_enable:
-                # push_text("  after.ground_y:" + str(ground_yB))
-                # push_text("  after.agl:" + str(aglB))
-                # push_text("  after.unit['mps_vec3']:" +
-                #           fmt_vec(unit['mps_vec3'], places=places))
-                # push_text("  after.unit['pos']:" +
-                #           fmt_vec(unit['pos'], places=places))
-                push_text("  moved_vec3:" +
-                          fmt_vec(moved_vec3, places=places))
-            if target_enable:
-                target = get_unit_crosshairs_vec3(unit)
-                x, y = vec2_from_vec3_via_camera(target,
-                                                 cam_vec2=camera_px)
-                # color = (200, 10, 0)  # red target
-                color = reachable_color
-                thin = round(thickness/2.0)
-                if thin < 1:
-                    thin = 1
-                border_size = (
-                    target_size[0] + thickness,
-                    target_size[1] + thickness
-                )
-                # dark red outline
-                # pg.draw.rect(
-                    # screen,  # scalable_surf,
-                    # (color[0]/2, color[1]/2, color[2]/2),
-                    # pg.Rect(x-round(float(target_size[0])/2.0)-thin,
-                            # y-round(float(target_size[1])/2.0)-thin,
-                            # border_size[0],
-                            # border_size[1])
-                # )
-                # dark blue cross
-                # horizontal
-                border_size = target_size[0] * 2, target_size[1]
-                pg.draw.rect(
-                    screen,  # scalable_surf,
-                    (color[0]/2, color[1]/2, color[2]/2),
-                    pg.Rect(x-round(float(target_size[0])/2.0)-thin,
-                            y-round(float(target_size[1])/2.0),
-                            border_size[0],
-                            border_size[1])
-                )
-                # vertical
-                border_size = target_size[0], target_size[1] * 2
-                pg.draw.rect(
-                    screen,  # scalable_surf,
-                    (color[0]/2, color[1]/2, color[2]/2),
-                    pg.Rect(x-round(float(target_size[0])/2.0),
-                            y-round(float(target_size[1])/2.0)-thin,
-                            border_size[0],
-                            border_size[1])
-                )
-                # blue dot
-                pg.draw.rect(
-                    screen,  # scalable_surf,
-                    color,
-                    pg.Rect(x-round(float(target_size[0])/2.0),
-                            y-round(float(target_size[1])/2.0),
-                            target_size[0],
-                            target_size[1])
-                )
+    t = profile_add('debug', t)
+    if visual_debug_enable:
+        unit = units.get(player_unit_name)
+        if unit is not None:
+            debug_lines = unit['tmp'].get('debug_lines')
+            if debug_lines is not None:
+                for line in debug_lines:
+                    push_text(line)
+    if player_unit_name in units:
+        unit = units[player_unit_name]
+        if target_enable:
+            target = get_unit_crosshairs_vec3(unit)
+            x, y = vec2_from_vec3_via_camera(target,
+                                             cam_vec2=camera_px)
+            # color = (200, 10, 0)  # red target
+            color = reachable_color
+            thin = round(thickness/2.0)
+            if thin < 1:
+                thin = 1
+            border_size = (
+                target_size[0] + thickness,
+                target_size[1] + thickness
+            )
+            # dark red outline
+            # pg.draw.rect(
+                # screen,  # scalable_surf,
+                # (color[0]/2, color[1]/2, color[2]/2),
+                # pg.Rect(x-round(float(target_size[0])/2.0)-thin,
+                        # y-round(float(target_size[1])/2.0)-thin,
+                        # border_size[0],
+                        # border_size[1])
+            # )
+            # dark blue cross
+            # horizontal
+            border_size = target_size[0] * 2, target_size[1]
+            pg.draw.rect(
+                screen,  # scalable_surf,
+                (color[0]/2, color[1]/2, color[2]/2),
+                pg.Rect(x-round(float(target_size[0])/2.0)-thin,
+                        y-round(float(target_size[1])/2.0),
+                        border_size[0],
+                        border_size[1])
+            )
+            # vertical
+            border_size = target_size[0], target_size[1] * 2
+            pg.draw.rect(
+                screen,  # scalable_surf,
+                (color[0]/2, color[1]/2, color[2]/2),
+                pg.Rect(x-round(float(target_size[0])/2.0),
+                        y-round(float(target_size[1])/2.0)-thin,
+                        border_size[0],
+                        border_size[1])
+            )
+            # blue dot
+            pg.draw.rect(
+                screen,  # scalable_surf,
+                color,
+                pg.Rect(x-round(float(target_size[0])/2.0),
+                        y-round(float(target_size[1])/2.0),
+                        target_size[0],
+                        target_size[1])
+            )
+    t = profile_add('units', t)
 
     if (popup_surf is None) or (popup_showing_text != popup_text):
         if popup_text is not None:
@@ -2479,6 +3851,8 @@ def draw_frame(screen):
             text_pos[1] += text_size[1]
             popup_alpha -= settings["popup_alpha_per_sec"] * passed
     global bindings
+    # Draw lines pushed so far under the UI (and the rest over it):
+    flush_text(screen)
     _on_draw_ui({'screen': screen})
     # screen.blit(pg.transform.scale(scalable_surf,
     #                                (int(win_size[0]),int(win_size[1]))),
@@ -2486,6 +3860,7 @@ def draw_frame(screen):
     show_stats_once()
     if camera_target_unit_name is not None:
             move_camera_to(camera_target_unit_name)
+    t = profile_add('ui', t)
 
     if visual_debug_enable:
         push_text("b_scale_h: " + str(b_scale_h))
@@ -2581,6 +3956,14 @@ def draw_frame(screen):
                 push_text("  ID: " + str(cell_y*cols+cell_x))
         else:
             push_text("  col,row: None")
+    flush_text(screen)
+    if profile_overlay_enable:
+        # (before ending the frame, so drawing it is counted too)
+        draw_profile_overlay(screen)
+    t = profile_add('debug', t)
+    update_autosave()
+    profile_add('frame', frame_start)
+    _end_profile_frame()
 
 
 show_stats_enable = True
@@ -2600,17 +3983,126 @@ def show_stats_once():
     show_stats_enable = False
 
 
+text_cache = OrderedDict()
+"""rendered lines by (font, text, antialias, color), least recently used
+first, where a value of None means the line was only seen once (see
+get_text_surface)"""
+glyph_cache = {}
+"""rendered characters by (font, antialias, color), each a dict where
+the key is a character and the value is (surface, advance) where advance
+is how far the font moves right after the character (see
+_push_glyph_line)"""
+
+
+def get_text_surface(s, color, font=None, antialias=None, render=True):
+    """Get a rendered line of text, rendering it only if it is not in
+    text_cache (which keeps the 'text_cache_size' setting's number of
+    most recently used lines).
+
+    Keyword arguments:
+    font -- a pygame Font (default_font if None)
+    antialias -- (the 'text_antialiasing' setting if None)
+    render -- if False, get None instead of rendering a line that was
+              not seen before (but remember it, so it is rendered and
+              cached if it is asked for again)
+    """
+    if font is None:
+        ensure_default_font()
+        font = default_font
+    if antialias is None:
+        antialias = settings['text_antialiasing']
+    key = (font, s, antialias, tuple(color))
+    surf = text_cache.pop(key, False)
+    if (surf is None) or ((surf is False) and render):
+        surf = font.render(s, antialias, color)
+    elif surf is False:
+        surf = None
+    text_cache[key] = surf  # (re)inserting makes it the most recent
+    while len(text_cache) > settings['text_cache_size']:
+        text_cache.popitem(last=False)
+    return surf
+
+
+def _get_glyphs(s, color):
+    """Get (surface, advance) for each character of a line from
+    glyph_cache, rendering only characters not seen before.
+    """
+    antialias = settings['text_antialiasing']
+    key = (default_font, antialias, tuple(color))
+    glyphs = glyph_cache.get(key)
+    if glyphs is None:
+        glyphs = {}
+        glyph_cache[key] = glyphs
+    result = []
+    for c in s:
+        glyph = glyphs.get(c)
+        if glyph is None:
+            surf = default_font.render(c, antialias, color)
+            # Advance by the font's metrics like font.render does for a
+            # whole line (not by the surface, which includes overhang):
+            metrics = default_font.metrics(c)[0]
+            if metrics is not None:
+                glyph = (surf, metrics[4])
+            else:
+                glyph = (surf, surf.get_width())  # (not in the font)
+            glyphs[c] = glyph
+        result.append(glyph)
+    return result
+
+
+def _push_glyph_line(s, color, x, y, right=False):
+    """Add the characters of a line to text_blits one at a time from
+    glyph_cache (so a line that changes every frame, such as a
+    position, does not have to be rendered), and get its height.
+
+    The characters are placed by the font's advances, so they line up
+    with the same line rendered whole (see get_text_surface) except for
+    kerning, and a right-aligned line ends where the whole line would.
+
+    Keyword arguments:
+    right -- if True, x is where the line ends instead of starts
+    """
+    glyphs = _get_glyphs(s, color)
+    if right:
+        x -= default_font.size(s)[0]
+    for surf, advance in glyphs:
+        text_blits.append((surf, (x, y)))
+        x += advance
+    return default_font.get_height()
+
+
 def draw_text_vec2(s, color, surf, vec2):
-    global default_font
-    ensure_default_font()
     if surf is not None:
-        s_surf = default_font.render(s, settings['text_antialiasing'],
-                                     color)
-        text_size = s_surf.get_size()
-        surf.blit(s_surf, (vec2[0], vec2[1]))
+        surf.blit(get_text_surface(s, color), (vec2[0], vec2[1]))
+
+
+text_blits = []
+"""lines from push_text waiting for flush_text, as (surface, dest)"""
+
+
+def flush_text(screen=None):
+    """Draw all lines added by push_text since the last flush with one
+    Surface.blits call (draw_frame calls this before drawing the UI and
+    at the end of each frame, and drops lines pushed between frames).
+    """
+    global temp_screen
+    if screen is not None:
+        temp_screen = screen
+    if temp_screen is not None:
+        temp_screen.blits(text_blits, doreturn=False)
+    del text_blits[:]
 
 
 def push_text(s, color=(255, 255, 255), screen=None):
+    """Add a line of text below the previous one. The text is drawn
+    when flush_text is called (such as by draw_frame).
+
+    A line is rendered and cached (see get_text_surface) once it has
+    been pushed twice, so a line that is different every frame is drawn
+    one cached character at a time instead.
+    """
+    if headless:
+        return
     if (len(s) > 500):
         print("UH OH, string length is " + str(len(s)) + "so truncating"
               " to prevent pygame surface size overflow:")
@@ -2630,12 +4122,14 @@ def push_text(s, color=(255, 255, 255), screen=None):
             # print("s: " + str(s))
             # print("text_antialiasing: " + str(settings['text_antialiasing']))
             # print("color: " + str(color))
-            s_surf = default_font.render(s,
-                                         settings['text_antialiasing'],
-                                         color)
-            text_size = s_surf.get_size()
-            temp_screen.blit(s_surf, (text_pos[0], text_pos[1]))
-            text_pos[1] += text_size[1]
+            # Render only lines that repeat; draw others by character:
+            s_surf = get_text_surface(s, color, render=False)
+            if s_surf is not None:
+                text_blits.append((s_surf, (text_pos[0], text_pos[1])))
+                text_pos[1] += s_surf.get_height()
+            else:
+                text_pos[1] += _push_glyph_line(s, color, text_pos[0],
+                                                text_pos[1])
         except AttributeError:
             # TODO: remove this? it is probably wrong--was put here for
             # either Pygame Zero (game engine) or pgs4a (Pygame subset
@@ -2661,6 +4155,9 @@ def _load_sprite(what, cells, order=None, gettable=True,
               loop
     order -- (requires len(series)>1) indices of frames specifying order
              starting at 1
+    default_animate -- if True, nodes of this material that load_world
+                       generates are animated (None to leave the
+                       material's setting as it is)
     """
     # results = {}
     if path is None:
@@ -2708,9 +4205,13 @@ def _load_sprite(what, cells, order=None, gettable=True,
         material['tmp']['sprites'][pose] = series
     else:
         material['tmp']['sprites'][pose] += series
+    material['tmp']['sprites'][pose].prepare_lowlights(LOWLIGHT_LEVELS)
 
     if material.get('default_pose') is None:
         material['default_pose'] = pose
+    if default_animate is not None:
+        # load_world sets node['animate'] for nodes of this material
+        material['default_animate'] = default_animate
     material['overlayable'] = overlayable
     material['biome'] = biome
     surf = file_surfs.get(path)
@@ -2731,11 +4232,11 @@ def load_material(what, column, row, gettable=True,
 
     Keyword arguments:
     path -- if None, then uses last loaded tileset
+    default_animate -- if True, nodes of this material that load_world
+                       generates are animated (None to leave them still
+                       even if count is more than 1)
     """
     global game_tile_size
-    if default_animate is None:
-        if count > 1:
-            default_animate = True
     if path is None:
         path = last_loaded_path
     cells = []
@@ -2783,6 +4284,7 @@ def load_material(what, column, row, gettable=True,
     if game_tile_size is None:
         game_tile_size = tilesets[path]['tile_size']
         print("game_tile_size from material: " + str(game_tile_size))
+    _reset_palette_anims()
 
 
 def load_character(what, column, row, gettable=False,
@@ -2825,11 +4327,13 @@ def load_character_3x4(what, column, row, order="NWSE"):
 overrides_help_enable = False
 
 
-def _place_unit(what, name, pos, pose=None, animate=True, overrides=None):
+def _place_unit(what, name, pos, pose=None, animate=True, overrides=None,
+                load_saved=True):
     global overrides_help_enable
+    global inventory_version
     if name in units:
         raise ValueError("There is already a unit named " + name)
-    units[name] = {}
+    units[name] = UnitDict()
     units[name]['what'] = what
     if len(pos) < 3:
         units[name]['pos'] = float(pos[0]), 10.0, float(pos[1])
@@ -2850,12 +4354,17 @@ def _place_unit(what, name, pos, pose=None, animate=True, overrides=None):
     units[name]['auto_climb_max'] = 0.2  # usually low (catch edge)
     units[name]['move_in_air'] = False
 
-    old_unit = load(name)
+    old_unit = None
+    if load_saved:
+        old_unit = load(name)
     if old_unit is not None:
-        units[name] = old_unit
+        unpack_inventory(old_unit)
+        units[name] = UnitDict(old_unit)
+    inventory_version += 1  # (a new unit may have the same name)
     unit = units[name]
     # tmp is not saved, so add it AFTER loading:
     unit['tmp'] = {}
+    unit['tmp']['name'] = name
     unit['tmp']['move_multipliers'] = [0.0, 0.0, 0.0]
     unit['tmp']['prev_interact_ticks'] = pg.time.get_ticks()
     # overlay missing values for compatibility with old saved units:
@@ -2871,6 +4380,7 @@ def _place_unit(what, name, pos, pose=None, animate=True, overrides=None):
     if overrides is not None:
         for k, v in overrides.items():
             units[name][k] = v
+    _update_unit_cell(unit)
 
 
 def stop_unit(name):
@@ -2893,7 +4403,7 @@ def stop_unit(name):
             unit['animate'] = False
 
 
-def place_character(what, name, pos, overrides=None):
+def place_character(what, name, pos, overrides=None, load_saved=True):
     """creates a new unit based on 'what' graphic, with a unique name
 
     Sequential arguments:
@@ -2904,9 +4414,12 @@ def place_character(what, name, pos, overrides=None):
 
     Keyword arguments:
     overrides -- not yet implemented
+    load_saved -- use the unit saved with this name if there is one
+                  (False to always place a new unit, such as for
+                  generated units that were never saved)
     """
     # TODO: implement overrides
-    _place_unit(what, name, pos)
+    _place_unit(what, name, pos, load_saved=load_saved)
     global player_unit_name
     if player_unit_name is None:
         player_unit_name = name
@@ -2946,6 +4459,8 @@ def default_keydown(event):
         if visual_debug_enable is False:
             tileset_cycle_enable = True
         toggle_visual_debug(tileset_cycle_enable=tileset_cycle_enable)
+    elif event.key == pg.K_F4:
+        toggle_profile_overlay()
     elif event.key == pg.K_UP:
         change_preview_tile(move_x=0, move_y=-1)
     elif event.key == pg.K_LEFT:
@@ -2988,7 +4503,7 @@ def inventory_scroll(amount):
                     selected_slot = 0
             else:
                 selected_slot = inv_cursor_max - 1
-        set_unit_value(name, 'selected_slot', selected_slot)
+        select_unit_slot(name, selected_slot)
 
 buttons = [None, None, None, None, None, None, None, None]
 
@@ -3136,19 +4651,20 @@ def _process_touch(screen):
     """
     e['state']['new_press'] is True only
     once (per MOUSEBUTTONDOWN/touch)
+    e['spatial_unit_names'] is the set of names of units at the touched
+    location (only if there is a player unit)
     """
     e = get_touch()
     if e is not None:
         new_press = e['state']['new_press']
         act_enable = True
         if screen is not None:
-            for widget in widgets:
-                if is_in_widget(screen, widget, e['state']['pos']):
-                    if new_press:
-                        e['widget'] = widget
-                        on_widget_click(e)
-                        # del e['widget']
-                    act_enable = False
+            for widget in get_widgets_at(screen, e['state']['pos']):
+                if new_press:
+                    e['widget'] = widget
+                    on_widget_click(e)
+                    # del e['widget']
+                act_enable = False
             if e.get('widget') is not None:
                 e['ignore'] = True
         unit = get_unit(e.get('unit_name'))
@@ -3162,6 +4678,7 @@ def _process_touch(screen):
                 vec3[1],  # unit['pos'][1],
                 float(loc[1])
             )
+            e['spatial_unit_names'] = get_unit_names_at(loc)
             dist = distance_planar(e['spatial_pos'], unit['pos'])
             if (dist - unit['reach']) > kEpsilon:
                 e['far'] = True
@@ -3293,90 +4810,488 @@ def get_whats(nodes):
     return results
 
 
+# region chunked block store
+def get_loc_from_key(key):
+    """Get an integer (col, row) location from a spatial key, which can
+    be either an (int, int) location or a legacy 'col,row' string.
+    """
+    if isinstance(key, str):
+        cs = key.split(",")
+        return int(cs[0]), int(cs[1])
+    return key[0], key[1]
+
+
+def get_chunk_loc(col, row):
+    """Get the (chunk_col, chunk_row) of the chunk containing a block
+    (floor division, so negative locations work the same way).
+    """
+    return col >> CHUNK_SHIFT, row >> CHUNK_SHIFT
+
+
+def new_chunk(chunk_loc):
+    """Create an empty chunk: a dict where chunk['stacks'] is a flat
+    list of CHUNK_SIZE*CHUNK_SIZE columns (each None or a stack) indexed
+    by `(row & CHUNK_MASK) * CHUNK_SIZE + (col & CHUNK_MASK)`.
+    """
+    chunk = {}
+    chunk['loc'] = chunk_loc
+    chunk['stacks'] = [None] * (CHUNK_SIZE * CHUNK_SIZE)
+    chunk['count'] = 0  # how many stacks are not None
+    chunk['dirty'] = True  # True if changed since saved
+    chunk['heights'] = array('h', [-1]) * (CHUNK_SIZE * CHUNK_SIZE)
+    """node count of each stack (-1 if None) as of the last
+    mark_stack_dirty or _add_chunk_heights"""
+    chunk['max_height'] = -1  # the largest of chunk['heights']
+    return chunk
+
+
+def get_chunk(chunk_loc, create=False):
+    chunks = world['tmp']['chunks']
+    chunk = chunks.get(chunk_loc)
+    if (chunk is None) and create:
+        chunk = new_chunk(chunk_loc)
+        chunks[chunk_loc] = chunk
+    return chunk
+
+
+def get_stack_ids_at(col, row):
+    """Get the stack at an integer world location as an array of
+    palette ids (see get_node_id), or None if there is no stack there.
+    Do not change the array except by push_node or pop_node.
+    """
+    chunk = world['tmp']['chunks'].get((col >> CHUNK_SHIFT,
+                                        row >> CHUNK_SHIFT))
+    if chunk is None:
+        return None
+    return chunk['stacks'][((row & CHUNK_MASK) << CHUNK_SHIFT)
+                           | (col & CHUNK_MASK)]
+
+
+class StackView(MutableSequence):
+    """A list-like view of the nodes in the stack at a location (bottom
+    first), where changing the view (such as by append or pop) changes
+    the stack in the world and calls mark_stack_dirty. The nodes are
+    shared by every block of the same kind (see node_palette), so do
+    not change them; set an index to a new node instead.
+    """
+
+    def __init__(self, col, row):
+        self.col = col
+        self.row = row
+
+    def _get_ids(self, create=False):
+        ids = get_stack_ids_at(self.col, self.row)
+        if (ids is None) and create:
+            set_stack_at(self.col, self.row, [])
+            ids = get_stack_ids_at(self.col, self.row)
+        return ids
+
+    def __len__(self):
+        ids = self._get_ids()
+        if ids is None:
+            return 0
+        return len(ids)
+
+    def __getitem__(self, i):
+        ids = self._get_ids()
+        if ids is None:
+            ids = ()
+        if isinstance(i, slice):
+            return [node_palette[node_id] for node_id in ids[i]]
+        return node_palette[ids[i]]
+
+    def __setitem__(self, i, node):
+        ids = self._get_ids(create=True)
+        if isinstance(i, slice):
+            ids[i] = array('H', [get_node_id(n) for n in node])
+        else:
+            ids[i] = get_node_id(node)
+        mark_stack_dirty(self.col, self.row)
+
+    def __delitem__(self, i):
+        ids = self._get_ids()
+        if ids is None:
+            raise IndexError("no stack at " + str((self.col, self.row)))
+        del ids[i]
+        mark_stack_dirty(self.col, self.row)
+
+    def insert(self, i, node):
+        self._get_ids(create=True).insert(i, get_node_id(node))
+        mark_stack_dirty(self.col, self.row)
+
+    def __eq__(self, other):
+        if isinstance(other, (list, tuple, StackView)):
+            return list(self) == list(other)
+        return NotImplemented
+
+    def __ne__(self, other):
+        result = self.__eq__(other)
+        if result is NotImplemented:
+            return result
+        return not result
+
+    __hash__ = None
+
+    def __repr__(self):
+        return repr(list(self))
+
+
+def get_stack_at(col, row):
+    """Get the stack at an integer world location as a StackView (a
+    list of nodes, bottom first, where changing the list changes the
+    world), or None if there is no stack there.
+    """
+    if get_stack_ids_at(col, row) is None:
+        return None
+    return StackView(col, row)
+
+
+node_palette = []
+"""the node for each palette id (see get_node_id)"""
+node_ids = {}
+"""palette id by node key (a sorted tuple of the node's items, or JSON
+if a value is unhashable)"""
+palette_anims = []
+"""the SpriteStripAnim for each palette id, or False if not found since
+materials last changed (see get_palette_anim)"""
+palette_animated = []
+"""True for each palette id whose node has 'animate' set to True"""
+
+
+def get_node_id(node):
+    """Get the palette id of a kind of node (adding a copy of node to
+    node_palette if it is a new kind), so stacks can store small whole
+    numbers instead of a dict for every block.
+    """
+    try:
+        key = tuple(sorted(node.items()))
+        node_id = node_ids.get(key)
+    except TypeError:
+        # an unhashable value (such as a list), so key it by JSON
+        # (like chunkfile does):
+        key = json.dumps(node, sort_keys=True)
+        node_id = node_ids.get(key)
+    if node_id is None:
+        node_id = len(node_palette)
+        node = dict(node)
+        node_palette.append(node)
+        palette_anims.append(False)
+        palette_animated.append(node.get('animate') is True)
+        node_ids[key] = node_id
+    return node_id
+
+
+def intern_node(node):
+    """Get the shared node (from node_palette) that is equal to node."""
+    return node_palette[get_node_id(node)]
+
+
+def get_palette_anim(node_id):
+    """Get the SpriteStripAnim for a palette id (see get_anim_from_node),
+    finding it only the first time after materials change.
+    """
+    anim = palette_anims[node_id]
+    if anim is False:
+        anim = get_anim_from_node(node_palette[node_id])
+        palette_anims[node_id] = anim
+    return anim
+
+
+def _reset_palette_anims():
+    """Find the anim of each palette id again (after materials change),
+    and free the cached terrain layers, since strips rendered before
+    the materials loaded show the old (or no) sprites.
+    """
+    palette_anims[:] = [False] * len(palette_anims)
+    _discard_terrain_layers(set())
+
+
+def set_stack_at(col, row, stack):
+    """Set or (if stack is None) remove the stack at a location, where
+    stack is a list of nodes (stored as palette ids; see get_node_id).
+    """
+    chunk = get_chunk((col >> CHUNK_SHIFT, row >> CHUNK_SHIFT),
+                      create=(stack is not None))
+    if chunk is None:
+        return
+    if stack is not None:
+        stack = array('H', [get_node_id(node) for node in stack])
+    i = ((row & CHUNK_MASK) << CHUNK_SHIFT) | (col & CHUNK_MASK)
+    if chunk['stacks'][i] is None:
+        if stack is not None:
+            chunk['count'] += 1
+    elif stack is None:
+        chunk['count'] -= 1
+    chunk['stacks'][i] = stack
+    mark_stack_dirty(col, row)
+
+
 def get_stack(key):
-    return world['blocks'].get(key)
+    """Get the stack at a spatial key (see get_loc_from_key), loading
+    or generating its chunk if not loaded (see update_streaming).
+    """
+    col, row = get_loc_from_key(key)
+    _get_streamed_chunk((col >> CHUNK_SHIFT, row >> CHUNK_SHIFT))
+    return get_stack_at(col, row)
+
+
+def iterate_stacks():
+    """Yield ((col, row), stack) for every stack in the world (where
+    stack is a StackView like get_stack_at gets).
+    """
+    for chunk_loc, chunk in world['tmp']['chunks'].items():
+        base_col = chunk_loc[0] << CHUNK_SHIFT
+        base_row = chunk_loc[1] << CHUNK_SHIFT
+        stacks = chunk['stacks']
+        for i in range(len(stacks)):
+            stack = stacks[i]
+            if stack is not None:
+                yield ((base_col + (i & CHUNK_MASK),
+                        base_row + (i >> CHUNK_SHIFT)),
+                       StackView(base_col + (i & CHUNK_MASK),
+                                 base_row + (i >> CHUNK_SHIFT)))
+
+
+def clear_chunks():
+    global stack_max
+    global heights_version
+    world['tmp']['chunks'] = {}
+    stack_heights.clear()
+    stack_max = 0
+    heights_version += 1
+
+
+def get_stack_height(col, row):
+    """Get the node count of the stack at an integer location, or -1
+    if there is no stack there (or it is not loaded).
+    """
+    chunk = world['tmp']['chunks'].get((col >> CHUNK_SHIFT,
+                                        row >> CHUNK_SHIFT))
+    if chunk is None:
+        return -1
+    return chunk['heights'][((row & CHUNK_MASK) << CHUNK_SHIFT)
+                            | (col & CHUNK_MASK)]
+
+
+def ground_height(x, z):
+    """Get the elevation of the top of the stack at a position (x and z
+    are rounded to a location like get_location_at_pos does), or
+    nothing_y if there is no stack there (or it is not loaded).
+    """
+    col = int(round(x))
+    row = int(round(z))
+    chunk = world['tmp']['chunks'].get((col >> CHUNK_SHIFT,
+                                        row >> CHUNK_SHIFT))
+    if chunk is None:
+        return nothing_y
+    height = chunk['heights'][((row & CHUNK_MASK) << CHUNK_SHIFT)
+                              | (col & CHUNK_MASK)]
+    if height < 0:
+        return nothing_y
+    return float(height)
+
+
+def get_tallest_stack_keys():
+    """Get the set of (col, row) of the tallest loaded stacks (each
+    stack_max nodes tall).
+    """
+    keys = set()
+    if stack_max < 1:
+        return keys
+    for chunk_loc, chunk in world['tmp']['chunks'].items():
+        if chunk['max_height'] != stack_max:
+            continue
+        heights = chunk['heights']
+        for i in range(len(heights)):
+            if heights[i] == stack_max:
+                keys.add(((chunk_loc[0] << CHUNK_SHIFT) + (i & CHUNK_MASK),
+                          (chunk_loc[1] << CHUNK_SHIFT)
+                          + (i >> CHUNK_SHIFT)))
+    return keys
+
+
+def _add_height(height, count=1):
+    global stack_max
+    stack_heights[height] = stack_heights.get(height, 0) + count
+    if height > stack_max:
+        stack_max = height
+
+
+def _remove_height(height, count=1):
+    global stack_max
+    stack_heights[height] -= count
+    if stack_heights[height] < 1:
+        del stack_heights[height]
+        if height == stack_max:
+            while (stack_max > 0) and (stack_max not in stack_heights):
+                stack_max -= 1
+
+
+def _track_stack_height(chunk, col, row):
+    """Update stack_heights and the chunk's heights if the length of
+    the stack at col, row changed.
+    """
+    global heights_version
+    i = ((row & CHUNK_MASK) << CHUNK_SHIFT) | (col & CHUNK_MASK)
+    stack = chunk['stacks'][i]
+    new_height = -1
+    if stack is not None:
+        new_height = len(stack)
+    heights = chunk['heights']
+    old_height = heights[i]
+    if new_height == old_height:
+        return
+    if old_height >= 0:
+        _remove_height(old_height)
+    heights[i] = new_height
+    heights_version += 1
+    if new_height >= 0:
+        _add_height(new_height)
+    if new_height > chunk['max_height']:
+        chunk['max_height'] = new_height
+    elif old_height == chunk['max_height']:
+        chunk['max_height'] = max(heights)
+
+
+def _add_chunk_heights(chunk):
+    """Track the heights of all stacks in a chunk that was just loaded
+    (or generated) with its stacks already set.
+    """
+    global heights_version
+    heights = chunk['heights']
+    stacks = chunk['stacks']
+    counts = {}
+    for i in range(len(stacks)):
+        stack = stacks[i]
+        if stack is None:
+            heights[i] = -1
+            continue
+        heights[i] = len(stack)
+        counts[heights[i]] = counts.get(heights[i], 0) + 1
+    for height, count in counts.items():
+        _add_height(height, count=count)
+    chunk['max_height'] = max(heights)
+    heights_version += 1
+
+
+def _remove_chunk_heights(chunk):
+    """Stop tracking the heights of a chunk that is being unloaded."""
+    global heights_version
+    heights_version += 1
+    counts = {}
+    for height in chunk['heights']:
+        if height >= 0:
+            counts[height] = counts.get(height, 0) + 1
+    for height, count in counts.items():
+        _remove_height(height, count=count)
+
+
+def _load_legacy_blocks(blocks):
+    """Move stacks from a legacy world['blocks'] dict (keys are
+    'col,row' strings) into chunks.
+    """
+    for sk, stack in blocks.items():
+        col, row = get_loc_from_key(sk)
+        set_stack_at(col, row, stack)
+
+
+def _take_dirty_chunks(files_path, snapshot=False):
+    """Get the chunkfile store for files_path and a list of
+    (chunk_loc, stacks) for each chunk changed since loaded or saved (or
+    every chunk if the world was loaded from another store, such as
+    when saving as a new name), and mark them as saved. Chunks generated
+    from the seed and not changed are not saved, since generating them
+    again gets the same stacks.
+
+    Keyword arguments:
+    snapshot -- if True, copy the stacks so they can be saved
+                on another thread while the world keeps changing
+    """
+    old_store = world['tmp'].get('chunk_store')
+    store, is_new = _get_chunk_store(files_path)
+    # Only a world whose clean chunks match another store needs every
+    # chunk copied (a world that was never saved, or was imported from
+    # legacy 'blocks', has no other store, and its imported chunks are
+    # already dirty):
+    save_all = is_new and (old_store is not None)
+    dirty = []
+    chunks = world['tmp']['chunks']
+    for chunk_loc, chunk in chunks.items():
+        if save_all or chunk['dirty']:
+            stacks = chunk['stacks']
+            if snapshot:
+                stacks = [None if (stack is None) else stack[:]
+                          for stack in stacks]
+            dirty.append((chunk_loc, stacks))
+            chunk['dirty'] = False
+    if save_all:
+        # also copy saved chunks that are not loaded:
+        with save_lock:
+            for chunk_loc in chunkfile.get_chunk_locs(old_store):
+                if chunk_loc not in chunks:
+                    dirty.append((chunk_loc, chunkfile.read_chunk(
+                        old_store, chunk_loc, CHUNK_SIZE * CHUNK_SIZE,
+                        intern=get_node_id
+                    )))
+    return store, dirty
+
+
+def _get_chunk_store(files_path):
+    """Get (store, is_new) where store is the chunkfile store of the
+    world in files_path, which is new (empty) if the world was not
+    loaded from there.
+    """
+    store = world['tmp'].get('chunk_store')
+    if (store is not None) and (store['path'] == files_path):
+        return store, False
+    with save_lock:
+        store = chunkfile.open_store(files_path, reset=True)
+    world['tmp']['chunk_store'] = store
+    return store, True
+
+
+def _save_chunk_store(files_path):
+    """Save changed chunks (see _take_dirty_chunks) to the chunkfile
+    store in files_path.
+    """
+    store, dirty = _take_dirty_chunks(files_path)
+    with save_lock:
+        chunkfile.write_chunks(store, dirty, palette=node_palette)
+    return len(dirty)
+# endregion chunked block store
+
+
 
 def _recalculate_tops():
+    """Track the heights of all loaded stacks again from scratch (only
+    needed if stacks were changed without calling mark_stack_dirty).
+    """
     global stack_max
-    global stack_max_keys
-    if len(stack_max_keys) > 0:
-        print("WARNING: _recalculate_tops called but has tops: "
-              + str(stack_max_keys))
-        stack_max_keys = []
+    stack_heights.clear()
     stack_max = 0
-    #if stack_max
-    stacks = world['blocks']
-    for sk, stack in stacks.items():
-        stack_len = len(stack)
-        if len(stack) > stack_max:
-            stack_max = len(stack)
-            stack_max_keys = [sk]
-        elif len(stack) == stack_max:
-            if stack_max > 2:
-                stack_max_keys.append(sk)
-            # other code must assume ALL keys are needed if 0 or 1
-            stack_max = len(stack)
-        # for i in range(stack):
-            # block = stack[i]
-    if stack_max < 3:
-        stack_max_keys = []
+    for chunk in world['tmp']['chunks'].values():
+        _add_chunk_heights(chunk)
+
 
 def pop_node(key):
-    global stack_max
-    global stack_max_keys
-    sk = key  # spatial key
+    sk = get_loc_from_key(key)  # spatial key
     result = None
-    stacks = world['blocks']
-    if stack_max is None:
-        _recalculate_tops()
-    if sk in stacks:
-        stack_prev_len = len(stacks[sk])
-        stack_len = stack_prev_len
-        if stack_len > 1:
-            result = stacks[sk].pop()
-            stack_len -= 1
-            if stack_len > stack_max:
-                print("WARNING: pop, yet raising stack_max to stack_len")
-                print("  stack_max: " + str(stack_max))
-                print("  stack_prev_len: " + str(stack_prev_len))
-                print("  stack_len: " + str(stack_len))
-                print("  stack_max_keys: " + str(stack_max_keys))
-                print("  key: " + str(sk))
-                stack_max = stack_len
-                stack_max_keys = [sk]
-            if stack_prev_len == stack_max:
-                if stack_prev_len > 2:
-                    try:
-                        prev_keys_len = len(stack_max_keys)
-                        i = stack_max_keys.index(sk)
-                        del stack_max_keys[i]
-                        if prev_keys_len == 1:
-                            _recalculate_tops()
-                    except ValueError:
-                        print("ERROR: forced recalculate tops")
-                        print("  stack_max: " + str(stack_max))
-                        print("  stack_prev_len: " + str(stack_prev_len))
-                        print("  stack_len: " + str(stack_len))
-                        print("  stack_max_keys: "
-                              + str(stack_max_keys))
-                        print("  key: " + sk)
-                        _recalculate_tops()
-                else:
-                    # not keeping track of low stacks
-                    stack_max_keys = []
-                    # do not set stack_max, already stack_prev_len
-            # else less than max, so do not affect max
+    _get_streamed_chunk((sk[0] >> CHUNK_SHIFT, sk[1] >> CHUNK_SHIFT))
+    stack = get_stack_ids_at(sk[0], sk[1])
+    if stack is not None:
+        if len(stack) > 1:
+            # copy it, since palette nodes are shared:
+            result = dict(node_palette[stack.pop()])
+            mark_stack_dirty(sk[0], sk[1])  # also updates stack_max
         # else there is only 1 block left (leave bedrock there)
     else:
         print("ERROR in pop_unit: bad key " + str(key) + "(must be "
-              "'int,int' where int are whole numbers and location "
-              "is a loaded part of the world")
+              "(int, int) or 'int,int' where int are whole numbers and"
+              " location is a loaded part of the world")
     return result
 
 def push_node(key, node):
-    global stack_max
-    global stack_max_keys
-    sk = key
+    sk = get_loc_from_key(key)
     if node is None:
         print("ERROR in push_node: tried to push None")
         return
@@ -3384,19 +5299,242 @@ def push_node(key, node):
     if what is None:
         print("ERROR in push_node: tried to push node without 'what'")
         return
-    if sk not in world['blocks']:
-        world['blocks'][sk] = []
-    stack_len = len(world['blocks'][sk]) + 1
-    world['blocks'][sk].append(node)
-    if (stack_max is None) or (stack_len > stack_max):
-        stack_max = stack_len
-        stack_max_keys = [sk]
-    elif stack_len == stack_max:
-        stack_max_keys.append(sk)
+    _get_streamed_chunk((sk[0] >> CHUNK_SHIFT, sk[1] >> CHUNK_SHIFT))
+    stack = get_stack_ids_at(sk[0], sk[1])
+    if stack is None:
+        set_stack_at(sk[0], sk[1], [node])
+        return
+    stack.append(get_node_id(node))
+    mark_stack_dirty(sk[0], sk[1])  # also updates stack_max
+
+
+# region bulk region edits
+def _get_region_bounds(corner1, corner2):
+    """Get (min_col, min_row, max_col, max_row) of the box between two
+    spatial keys (see get_loc_from_key), including both corners.
+    """
+    col1, row1 = get_loc_from_key(corner1)
+    col2, row2 = get_loc_from_key(corner2)
+    return min(col1, col2), min(row1, row2), max(col1, col2), max(row1, row2)
+
+
+def _edit_region(corner1, corner2, edit, create=False):
+    """Call edit(stack, col, row) for every location in the box between
+    two corners (including both), where stack is the array of palette
+    ids at the location (or None), then update the heights, stack_max,
+    the chunks to save and the cached terrain layer once for the whole
+    box instead of once per stack. Get how many stacks changed.
+
+    Sequential arguments:
+    edit -- a function that changes the stack in place and returns it,
+            returns a new stack (or None to remove the stack), or
+            returns False if it did not change anything
+
+    Keyword arguments:
+    create -- if True, create empty chunks where a chunk is neither
+              saved nor generated (so edit can add stacks there)
+    """
+    global heights_version
+    min_col, min_row, max_col, max_row = _get_region_bounds(corner1,
+                                                            corner2)
+    added = {}  # height: how many stacks became that tall
+    removed = {}  # height: how many stacks stopped being that tall
+    changed_count = 0
+    for chunk_row in range(min_row >> CHUNK_SHIFT,
+                           (max_row >> CHUNK_SHIFT) + 1):
+        for chunk_col in range(min_col >> CHUNK_SHIFT,
+                               (max_col >> CHUNK_SHIFT) + 1):
+            chunk_loc = (chunk_col, chunk_row)
+            chunk = _get_streamed_chunk(chunk_loc)
+            if chunk is None:
+                if not create:
+                    continue
+                chunk = get_chunk(chunk_loc, create=True)
+            stacks = chunk['stacks']
+            heights = chunk['heights']
+            layer = chunk.get('layer')
+            base_col = chunk_col << CHUNK_SHIFT
+            base_row = chunk_row << CHUNK_SHIFT
+            cols = range(max(min_col, base_col),
+                         min(max_col, base_col + CHUNK_MASK) + 1)
+            chunk_changed = False
+            for row in range(max(min_row, base_row),
+                             min(max_row, base_row + CHUNK_MASK) + 1):
+                row_changed = False
+                row_i = (row & CHUNK_MASK) << CHUNK_SHIFT
+                for col in cols:
+                    i = row_i | (col & CHUNK_MASK)
+                    old_stack = stacks[i]
+                    stack = edit(old_stack, col, row)
+                    if stack is False:
+                        continue
+                    if old_stack is None:
+                        if stack is not None:
+                            chunk['count'] += 1
+                    elif stack is None:
+                        chunk['count'] -= 1
+                    stacks[i] = stack
+                    row_changed = True
+                    changed_count += 1
+                    height = -1
+                    if stack is not None:
+                        height = len(stack)
+                    old_height = heights[i]
+                    if height == old_height:
+                        continue
+                    if old_height >= 0:
+                        removed[old_height] = removed.get(old_height, 0) + 1
+                    if height >= 0:
+                        added[height] = added.get(height, 0) + 1
+                    heights[i] = height
+                if row_changed:
+                    chunk_changed = True
+                    if layer is not None:
+                        layer['strips'][row & CHUNK_MASK] = None
+            if chunk_changed:
+                chunk['dirty'] = True
+                chunk['max_height'] = max(heights)
+    # (add before removing, so if removing the tallest height makes
+    # stack_max search down, it stops at the tallest added height):
+    for height, count in added.items():
+        _add_height(height, count=count)
+    for height, count in removed.items():
+        _remove_height(height, count=count)
+    if (len(added) > 0) or (len(removed) > 0):
+        heights_version += 1
+    return changed_count
+
+
+def fill_region(corner1, corner2, node, top):
+    """Add node to every stack in the box between two spatial keys
+    (including both corners, and starting a stack where there is none)
+    until it is top nodes tall, and get how many stacks changed.
+    """
+    if (node is None) or (node.get('what') is None):
+        print("ERROR in fill_region: tried to fill with " + str(node))
+        return 0
+    filler = array('H', [get_node_id(node)])
+
+    def fill(stack, col, row):
+        if stack is None:
+            stack = array('H')
+        elif len(stack) >= top:
+            return False
+        stack.extend(filler * (top - len(stack)))
+        return stack
+
+    return _edit_region(corner1, corner2, fill, create=True)
+
+
+def clear_region(corner1, corner2, bottom=1):
+    """Remove all but the bottom nodes of every stack in the box between
+    two spatial keys (including both corners), and get how many stacks
+    changed.
+
+    Keyword arguments:
+    bottom -- how many nodes to leave in each stack (1 leaves the
+              bedrock like pop_node does; 0 removes the stacks)
+    """
+    def clear(stack, col, row):
+        if (stack is None) or (len(stack) <= bottom):
+            return False
+        if bottom < 1:
+            return None
+        del stack[bottom:]
+        return stack
+
+    return _edit_region(corner1, corner2, clear)
+
+
+def replace_in_region(corner1, corner2, what, node):
+    """Change every node whose 'what' is what to node, in the box
+    between two spatial keys (including both corners), and get how many
+    stacks changed.
+    """
+    new_id = get_node_id(node)
+    old_ids = set()
+    for node_id in range(len(node_palette)):
+        if node_palette[node_id].get('what') == what:
+            old_ids.add(node_id)
+    old_ids.discard(new_id)
+    if len(old_ids) < 1:
+        return 0
+
+    def replace(stack, col, row):
+        if (stack is None) or old_ids.isdisjoint(stack):
+            return False
+        for i in range(len(stack)):
+            if stack[i] in old_ids:
+                stack[i] = new_id
+        return stack
+
+    return _edit_region(corner1, corner2, replace)
+
+
+def copy_region(corner1, corner2):
+    """Get a copy of the stacks in the box between two spatial keys
+    (including both corners) as a dict for paste_region:
+    'size' -- (column count, row count)
+    'stacks' -- each location's array of palette ids (see get_node_id)
+                or None, row by row from the lowest corner
+    """
+    min_col, min_row, max_col, max_row = _get_region_bounds(corner1,
+                                                            corner2)
+    region = {}
+    region['size'] = (max_col - min_col + 1, max_row - min_row + 1)
+    stacks = []
+    for row in range(min_row, max_row + 1):
+        for col in range(min_col, max_col + 1):
+            _get_streamed_chunk((col >> CHUNK_SHIFT, row >> CHUNK_SHIFT))
+            stack = get_stack_ids_at(col, row)
+            if stack is not None:
+                stack = stack[:]
+            stacks.append(stack)
+    region['stacks'] = stacks
+    return region
+
+
+def paste_region(region, corner):
+    """Replace the stacks starting at a spatial key (the lowest corner)
+    with the stacks of a region from copy_region, and get how many
+    stacks changed.
+    """
+    col0, row0 = get_loc_from_key(corner)
+    cols, rows = region['size']
+    if (cols < 1) or (rows < 1):
+        return 0
+    stacks = region['stacks']
+
+    def paste(stack, col, row):
+        new_stack = stacks[(row - row0) * cols + (col - col0)]
+        if new_stack is None:
+            if stack is None:
+                return False
+            return None
+        return new_stack[:]
+
+    return _edit_region((col0, row0), (col0 + cols - 1, row0 + rows - 1),
+                        paste, create=True)
+# endregion bulk region edits
+
+
+def _save_world_settings(files_path):
+    """Write world.json to files_path (the world's values, such as its
+    seed, but not its chunks).
+    """
+    if not os.path.isdir(files_path):
+        os.makedirs(files_path)
+    path = os.path.join(files_path, "world.json")
+    # world.json only has settings (stacks are in chunks.dat):
+    with save_lock:
+        save_json_atomic(path, trim_dict(world))
+    autosave_state['saved'].pop(path, None)  # (now autosave may differ)
+    world['tmp']['settings_saved'] = True
 
 
 def save_world(name=None):
     print("saving world...")
+    wait_for_autosave()  # so older autosaved chunks are not written last
     global last_loaded_world_name
     global world
     if name is None:
@@ -3409,14 +5547,16 @@ def save_world(name=None):
         if not os.path.isdir(files_path):
             os.makedirs(files_path)
         path = os.path.join(files_path, filename)
-        with open(path, "w") as outs:
-            json.dump(world, outs)
-        print("saved '" + os.path.abspath(path))
+        _save_world_settings(files_path)
+        count = _save_chunk_store(files_path)
+        print("saved '" + os.path.abspath(path) + "' and " + str(count)
+              + " changed chunk(s)")
     else:
         print("ERROR: Can't save world--no load_world nor name param")
 
 
 def load_world(name, generate=False):
+    wait_for_autosave()
     global world
     global last_loaded_world_name
     global settings
@@ -3434,58 +5574,588 @@ def load_world(name, generate=False):
         with open(path, "r") as ins:
             world = json.load(ins)
     if world is not None:
+        world['tmp'] = {}
+        world['tmp']['settings_saved'] = True  # (loaded from world.json)
+        clear_chunks()
+        blocks = world.get('blocks')
+        if blocks is not None:
+            # import a world.json from before chunks.dat (the next
+            # save_world replaces any chunks.dat and removes blocks):
+            _load_legacy_blocks(blocks)
+            del world['blocks']
+        else:
+            # chunks are loaded when needed (see update_streaming):
+            world['tmp']['chunk_store'] = chunkfile.open_store(files_path)
         if 'gravity' not in world:
             world['gravity'] = settings['default_world_gravity']
         if 'height' not in world:
             world['height'] = settings['default_world_height']
+        update_streaming()
         print("  loaded existing world.")
         return
     else:
         print("  generating...")
     world = {}
     world['gravity'] = settings['default_world_gravity']
-    world['blocks'] = {}
-    stacks = world['blocks']
-    # TODO: if generate:
+    # Chunks are generated from the seed when first needed (see
+    # generate_chunk and update_streaming), so the world has no edge:
+    world['seed'] = random.randrange(1 << 31)
+    world['generator'] = 'mesa'  # see generate_chunk
+    world['mesa'] = heightmap_key
+    world['tmp'] = {}
+    clear_chunks()
+    stream_chunks_near([(0, 0)])
+    print("  placing...")
+    _place_world()
+    print("  finished (load_world).")
+
+
+# region terrain generation
+HASH_MASK = 0xFFFFFFFF
+NOISE_OCTAVES = [(5, 0.5), (3, 0.2)]
+"""(shift, weight) of each value noise layer (the lattice is 2**shift
+blocks apart)"""
+MESA_WEIGHT = 0.3  # how much the mesa image adds to generated height
+
+
+def _hash32(seed, x, z):
+    """Get a pseudorandom 32-bit number from integers (the same as
+    _hash32_np, so terrain is the same with or without NumPy).
+    """
+    h = (x * 0x27d4eb2d + z * 0x165667b1 + seed * 0x9e3779b1) & HASH_MASK
+    h ^= h >> 15
+    h = (h * 0x85ebca6b) & HASH_MASK
+    h ^= h >> 13
+    h = (h * 0xc2b2ae35) & HASH_MASK
+    h ^= h >> 16
+    return h
+
+
+def _hash32_np(seed, xs, zs):
+    """Get _hash32 of each x, z in NumPy int64 arrays."""
+    # (masked first, since seed * 0x9e3779b1 may not fit in an int64):
+    seed_h = (seed * 0x9e3779b1) & HASH_MASK
+    h = ((xs * 0x27d4eb2d + zs * 0x165667b1 + seed_h)
+         & HASH_MASK).astype(np.uint64)
+    h ^= h >> np.uint64(15)
+    h = (h * np.uint64(0x85ebca6b)) & np.uint64(HASH_MASK)
+    h ^= h >> np.uint64(13)
+    h = (h * np.uint64(0xc2b2ae35)) & np.uint64(HASH_MASK)
+    h ^= h >> np.uint64(16)
+    return h
+
+
+def _fade(f):
+    return f * f * (3.0 - 2.0 * f)
+
+
+def _noise01(seed, col, row, shift):
+    """Get smooth value noise from 0 to 1 at a block location."""
+    size = 1 << shift
+    x0 = col >> shift
+    z0 = row >> shift
+    fx = _fade((col & (size - 1)) / float(size))
+    fz = _fade((row & (size - 1)) / float(size))
+    v00 = _hash32(seed, x0, z0) / 4294967296.0
+    v10 = _hash32(seed, x0 + 1, z0) / 4294967296.0
+    v01 = _hash32(seed, x0, z0 + 1) / 4294967296.0
+    v11 = _hash32(seed, x0 + 1, z0 + 1) / 4294967296.0
+    top = v00 + (v10 - v00) * fx
+    bottom = v01 + (v11 - v01) * fx
+    return top + (bottom - top) * fz
+
+
+def _noise01_np(seed, cols, rows, shift):
+    """Get _noise01 of each col, row in NumPy int64 arrays."""
+    size = 1 << shift
+    x0 = cols >> shift
+    z0 = rows >> shift
+    fx = _fade((cols & (size - 1)) / float(size))
+    fz = _fade((rows & (size - 1)) / float(size))
+    # only hash each lattice point once:
+    min_x = int(x0.min())
+    min_z = int(z0.min())
+    lat_z, lat_x = np.mgrid[min_z:int(z0.max())+2,
+                            min_x:int(x0.max())+2].astype(np.int64)
+    lattice = _hash32_np(seed, lat_x, lat_z) / 4294967296.0
+    xi = x0 - min_x
+    zi = z0 - min_z
+    v00 = lattice[zi, xi]
+    v10 = lattice[zi, xi + 1]
+    v01 = lattice[zi + 1, xi]
+    v11 = lattice[zi + 1, xi + 1]
+    top = v00 + (v10 - v00) * fx
+    bottom = v01 + (v11 - v01) * fx
+    return top + (bottom - top) * fz
+
+
+def get_mesa_alpha(key):
+    """Get (alpha, width, height) of the mesa image in maps/mesa named
+    key, where alpha is bytes (one per pixel, row by row).
+    """
+    cache = heightmap.get('alphas')
+    if cache is None:
+        cache = {}
+        heightmap['alphas'] = cache
+    got = cache.get(key)
+    if got is None:
+        path = os.path.join(mesas_path, key + ".png")
+        surf = pg.image.load(path)
+        w, h = surf.get_size()
+        to_bytes = getattr(pg.image, 'tobytes', None)
+        if to_bytes is None:
+            to_bytes = pg.image.tostring  # before pygame 2
+        got = (to_bytes(surf, "RGBA")[3::4], w, h)
+        cache[key] = got
+    return got
+
+
+def generate_heights(col, row, width, depth, seed=None):
+    """Get the generated terrain for an area (using NumPy if installed)
+    as (heights, tops, variants): each is a list of depth rows (or a
+    NumPy array with depth rows), each with width values, where heights
+    are stack lengths including bedrock, tops are indices in
+    material_choose, and variants are numbers for choosing poses.
+
+    Keyword arguments:
+    seed -- (default: world['seed'])
+    """
+    if seed is None:
+        seed = world['seed']
+    seed &= HASH_MASK
+    relief = settings['generate_relief']
+    mesa_key = world.get('mesa', heightmap_key)
+    alpha, mesa_w, mesa_h = get_mesa_alpha(mesa_key)
+    px_per_block = settings['mesa_px_per_block']
+    choose_count = len(material_choose)
+    if np is not None:
+        rows, cols = np.mgrid[row:row+depth, col:col+width].astype(np.int64)
+        h01 = np.zeros((depth, width))
+        for shift, weight in NOISE_OCTAVES:
+            h01 += _noise01_np(seed, cols, rows, shift) * weight
+        mesa = np.frombuffer(alpha, dtype=np.uint8).reshape(mesa_h, mesa_w)
+        h01 += (mesa[(rows * px_per_block) % mesa_h,
+                     (cols * px_per_block) % mesa_w] / 255.0
+                * MESA_WEIGHT)
+        heights = 2 + (h01 * relief).astype(np.int64)
+        tops = (_hash32_np(seed + 1, cols, rows)
+                % np.uint64(choose_count)).astype(np.int64)
+        variants = _hash32_np(seed + 2, cols, rows).astype(np.int64)
+        return heights, tops, variants
+    heights = []
+    tops = []
+    variants = []
+    for r in range(row, row + depth):
+        height_row = []
+        top_row = []
+        variant_row = []
+        for c in range(col, col + width):
+            h01 = 0.0
+            for shift, weight in NOISE_OCTAVES:
+                h01 += _noise01(seed, c, r, shift) * weight
+            a = alpha[((r * px_per_block) % mesa_h) * mesa_w
+                      + (c * px_per_block) % mesa_w]
+            h01 += a / 255.0 * MESA_WEIGHT
+            height_row.append(2 + int(h01 * relief))
+            top_row.append(_hash32(seed + 1, c, r) % choose_count)
+            variant_row.append(_hash32(seed + 2, c, r))
+        heights.append(height_row)
+        tops.append(top_row)
+        variants.append(variant_row)
+    return heights, tops, variants
+
+
+def _generate_mesa_chunk(chunk_loc):
+    """Create a chunk from generate_heights: each stack is bedrock,
+    filler (dirt if loaded) up to the height, then a top node chosen
+    from material_choose (or none if it chooses None).
+    """
+    chunk = new_chunk(chunk_loc)
+    stacks = chunk['stacks']
+    heights, tops, variants = generate_heights(
+        chunk_loc[0] << CHUNK_SHIFT, chunk_loc[1] << CHUNK_SHIFT,
+        CHUNK_SIZE, CHUNK_SIZE
+    )
+    if np is not None:
+        heights = heights.tolist()
+        tops = tops.tolist()
+        variants = variants.tolist()
+    bedrock_what = None
+    if 'bedrock' in materials:
+        bedrock_what = 'bedrock'
+    elif 'dirt' in materials:
+        bedrock_what = 'dirt'
+    filler_what = bedrock_what
+    if 'dirt' in materials:
+        filler_what = 'dirt'
+    poses = {}
+    for what in materials:
+        # converting a dict to a list yields the keys:
+        poses[what] = list(materials[what]['tmp']['sprites'])
+    if bedrock_what is not None:
+        bedrock = get_node_id({'what': bedrock_what})
+        filler = get_node_id({'what': filler_what})
+    top_ids = {}  # (top_what, pose): palette id
+    for z in range(CHUNK_SIZE):
+        for x in range(CHUNK_SIZE):
+            stack = array('H')
+            stacks[(z << CHUNK_SHIFT) | x] = stack
+            if (len(materials) < 1) or (bedrock_what is None):
+                continue
+            stack.append(bedrock)
+            top_what = material_choose[tops[z][x]]
+            count = heights[z][x]
+            if top_what is not None:
+                count -= 1
+            if count > 1:
+                stack.extend(array('H', [filler]) * (count - 1))
+            if top_what is not None:
+                what_poses = poses[top_what]
+                pose = what_poses[variants[z][x] % len(what_poses)]
+                top_id = top_ids.get((top_what, pose))
+                if top_id is None:
+                    node = {}
+                    node['what'] = top_what
+                    if materials[top_what].get('default_animate') is True:
+                        node['animate'] = True
+                    node['pose'] = pose
+                    top_id = get_node_id(node)
+                    top_ids[(top_what, pose)] = top_id
+                stack.append(top_id)
+    chunk['count'] = len(stacks)
+    chunk['dirty'] = False
+    return chunk
+# endregion terrain generation
+
+
+# region streaming
+stream_state = {}
+stream_state['clock'] = 0  # counts calls to stream_chunks_near
+# (min_col, min_row, max_col, max_row) of the stacks draw_frame drew
+# last (or None before the first frame):
+stream_state['draw_area'] = None
+
+
+def generate_chunk(chunk_loc):
+    """Create a chunk using world['seed'] and the chunk location, so it
+    is the same every time it is generated (if the same materials are
+    loaded in the same order).
+    """
+    if world.get('generator') == 'mesa':
+        return _generate_mesa_chunk(chunk_loc)
+    # else generate flat terrain the same as worlds from before
+    # world['generator'] was added:
+    rng = random.Random(str(world['seed']) + ":" + str(chunk_loc[0]) +
+                        "," + str(chunk_loc[1]))
+    chunk = new_chunk(chunk_loc)
+    stacks = chunk['stacks']
     bedrock_what = None
     material_all = list(materials)
     if 'bedrock' in material_all:
         bedrock_what = 'bedrock'
     elif 'dirt' in material_all:
         bedrock_what = 'dirt'
-    for col in range(-30, 30):
-        for row in reversed(range(-30, 30)):
-            sk = str(col)+","+str(row)
-            stacks[sk] = []
-            if len(materials) > 0:
-                if bedrock_what is not None:
-                    bedrock = {}  # recreate each time so not instance
-                    bedrock['what'] = bedrock_what
-                    if bedrock is not None:
-                        stacks[sk].append(bedrock)
-                    else:
-                        print("WARNING: no 'bedrock' material")
-                node = {}
-                node['what'] = random.choice(material_choose)
-                if node['what'] is not None:
-                    default_animate = \
-                        materials[node['what']].get('default_animate')
-                    if default_animate is True:
-                        node['animate'] = True
-                    # else None or False so don't waste storage space
-                    material = materials[node['what']]
-                    # converting a dict to a list yields the keys:
-                    node['pose'] = random.choice(
-                        list(material['tmp']['sprites'])
-                    )
-                    # print("generated " + node['what'] + " pose " +
-                    #       node['pose'] + " at " + sk)
-                    stacks[sk].append(node)
-                # else:
-                    # print("generated None at " + sk)
-        print("  placing...")
-    _place_world()
-    print("  finished (load_world).")
+    for i in range(len(stacks)):
+        stack = array('H')
+        stacks[i] = stack
+        if len(materials) > 0:
+            if bedrock_what is not None:
+                stack.append(get_node_id({'what': bedrock_what}))
+            node = {}
+            node['what'] = rng.choice(material_choose)
+            if node['what'] is not None:
+                material = materials[node['what']]
+                if material.get('default_animate') is True:
+                    node['animate'] = True
+                # else None or False so don't waste storage space
+                # converting a dict to a list yields the keys:
+                node['pose'] = rng.choice(list(material['tmp']['sprites']))
+                stack.append(get_node_id(node))
+    chunk['count'] = len(stacks)
+    # It doesn't need to be saved unless changed, since generating it
+    # again makes the same chunk:
+    chunk['dirty'] = False
+    return chunk
+
+
+def _get_streamed_chunk(chunk_loc):
+    """Get a chunk, loading it from the chunk store or (if the world has
+    a seed) generating it if it is not loaded yet (None if neither).
+    """
+    chunks = world['tmp']['chunks']
+    chunk = chunks.get(chunk_loc)
+    if chunk is not None:
+        return chunk
+    if chunk_loc in autosave_state['pending']:
+        # (so the chunk is read after it is written, not generated):
+        wait_for_autosave()
+    store = world['tmp'].get('chunk_store')
+    stacks = None
+    if store is not None:
+        with save_lock:
+            if chunk_loc in store['index']:
+                stacks = chunkfile.read_chunk(
+                    store, chunk_loc, CHUNK_SIZE * CHUNK_SIZE,
+                    intern=get_node_id
+                )
+    if stacks is not None:
+        chunk = new_chunk(chunk_loc)
+        chunk['stacks'] = [None if (stack is None) else array('H', stack)
+                           for stack in stacks]
+        chunk['count'] = (len(chunk['stacks'])
+                          - chunk['stacks'].count(None))
+        chunk['dirty'] = False
+    elif world.get('seed') is not None:
+        chunk = generate_chunk(chunk_loc)
+    if chunk is not None:
+        chunks[chunk_loc] = chunk
+        _add_chunk_heights(chunk)
+    return chunk
+
+
+def stream_chunks_near(locs):
+    """Make sure chunks within the 'stream_radius_chunks' setting of
+    each (col, row) in locs and the chunks draw_frame last drew (see
+    stream_state['draw_area']) are loaded (or generated), then unload the
+    least recently needed chunks if more than the 'max_loaded_chunks'
+    setting are loaded.
+    """
+    stream_state['clock'] += 1
+    clock = stream_state['clock']
+    radius = settings['stream_radius_chunks']
+    centers = set()
+    for loc in locs:
+        centers.add((int(loc[0]) >> CHUNK_SHIFT, int(loc[1]) >> CHUNK_SHIFT))
+    for center in centers:
+        for cz in range(center[1] - radius, center[1] + radius + 1):
+            for cx in range(center[0] - radius, center[0] + radius + 1):
+                chunk = _get_streamed_chunk((cx, cz))
+                if chunk is not None:
+                    chunk['used'] = clock
+    if stream_state['draw_area'] is not None:
+        _stream_area(stream_state['draw_area'], clock)
+    if len(world['tmp']['chunks']) > settings['max_loaded_chunks']:
+        _evict_chunks(clock)
+
+
+def _stream_area(area, clock):
+    """Make sure every chunk overlapping area (min_col, min_row,
+    max_col, max_row) is loaded (or generated), and mark it used at
+    clock so _evict_chunks keeps it.
+    """
+    for cz in range(area[1] >> CHUNK_SHIFT, (area[3] >> CHUNK_SHIFT) + 1):
+        for cx in range(area[0] >> CHUNK_SHIFT,
+                        (area[2] >> CHUNK_SHIFT) + 1):
+            chunk = _get_streamed_chunk((cx, cz))
+            if chunk is not None:
+                chunk['used'] = clock
+
+
+def _evict_chunks(clock):
+    """Unload the least recently used chunks (not used at clock) until
+    'max_loaded_chunks' are loaded, saving them first if changed.
+    """
+    # (so a chunk whose autosave failed is saved before unloading it):
+    _take_autosave_failures()
+    chunks = world['tmp']['chunks']
+    old = [chunk for chunk in chunks.values()
+           if chunk.get('used', 0) != clock]
+    old.sort(key=lambda chunk: chunk.get('used', 0))
+    old = old[:len(chunks) - settings['max_loaded_chunks']]
+    pending = autosave_state['pending']
+    for chunk in old:
+        if chunk['loc'] in pending:
+            # The autosave thread has a snapshot of it that is not
+            # written yet (and if writing fails, the chunk becomes dirty
+            # again), so finish autosaving before deciding what to save:
+            wait_for_autosave()
+            break
+    dirty = [(chunk['loc'], chunk['stacks']) for chunk in old
+             if chunk['dirty']]
+    if len(dirty) > 0:
+        if last_loaded_world_name is None:
+            # nowhere to save them, so keep them loaded:
+            old = [chunk for chunk in old if not chunk['dirty']]
+        else:
+            # so an older autosave of these doesn't overwrite them:
+            wait_for_autosave()
+            files_path = os.path.join(appdata_path, last_loaded_world_name)
+            if not world['tmp'].get('settings_saved'):
+                # (a new world, so the saved chunks would be next to
+                # chunks generated from another seed after a crash):
+                _save_world_settings(files_path)
+            store, is_new = _get_chunk_store(files_path)
+            with save_lock:
+                chunkfile.write_chunks(store, dirty, palette=node_palette)
+    for chunk in old:
+        _remove_chunk_heights(chunk)
+        del chunks[chunk['loc']]
+
+
+def update_streaming():
+    """Load or generate chunks near the camera and every unit, and
+    unload far ones (step_world calls this).
+    """
+    if world.get('tmp') is None:
+        return
+    locs = [get_location_at_pos(camera['pos'])]
+    locs.extend(unit_cells)  # the location of every unit
+    stream_chunks_near(locs)
+# endregion streaming
+
+
+# region autosave
+save_lock = threading.Lock()
+"""held while writing world files (so saves on the autosave thread and
+the main thread do not mix)"""
+autosave_state = {}
+autosave_state['queue'] = None  # jobs for the autosave thread
+autosave_state['thread'] = None
+autosave_state['next_time'] = None  # time.monotonic() of next autosave
+# chunk_loc: how many queued autosave jobs have not written it yet (only
+# changed while holding save_lock):
+autosave_state['pending'] = {}
+# path: the data autosave_now last queued for that file (so unchanged
+# units are not copied or written again):
+autosave_state['saved'] = {}
+# chunk locations and file paths the autosave thread failed to write
+# (only changed while holding save_lock; see _take_autosave_failures):
+autosave_state['failed_chunks'] = set()
+autosave_state['failed_paths'] = set()
+
+
+def _add_pending_chunks(chunks, count):
+    """Add count to how many autosave jobs will write each chunk in a
+    list of (chunk_loc, stacks).
+    """
+    pending = autosave_state['pending']
+    with save_lock:
+        for chunk_loc, stacks in chunks:
+            left = pending.get(chunk_loc, 0) + count
+            if left > 0:
+                pending[chunk_loc] = left
+            else:
+                pending.pop(chunk_loc, None)
+
+
+def _autosave_worker(jobs):
+    while True:
+        job = jobs.get()
+        try:
+            with save_lock:
+                if job['world'] is not None:
+                    save_json_atomic(job['world_path'], job['world'])
+                chunkfile.write_chunks(job['store'], job['chunks'],
+                                       palette=node_palette)
+                for path, data in job['units']:
+                    save_json_atomic(path, data)
+        except Exception as ex:
+            # keep the thread alive, and let the main thread try them
+            # again next time (see _take_autosave_failures):
+            print("ERROR: autosave failed: " + str(ex))
+            with save_lock:
+                autosave_state['failed_chunks'].update(
+                    chunk_loc for chunk_loc, stacks in job['chunks'])
+                autosave_state['failed_paths'].add(job['world_path'])
+                autosave_state['failed_paths'].update(
+                    path for path, data in job['units'])
+        _add_pending_chunks(job['chunks'], -1)
+        jobs.task_done()
+
+
+def _take_autosave_failures():
+    """Mark chunks the autosave thread failed to write as dirty again,
+    and forget what was queued for files it failed to write, so the
+    next save writes them (only call this on the main thread).
+    """
+    failed_chunks = autosave_state['failed_chunks']
+    failed_paths = autosave_state['failed_paths']
+    if (len(failed_chunks) < 1) and (len(failed_paths) < 1):
+        return
+    with save_lock:
+        chunk_locs = list(failed_chunks)
+        paths = list(failed_paths)
+        failed_chunks.clear()
+        failed_paths.clear()
+    for chunk_loc in chunk_locs:
+        chunk = get_chunk(chunk_loc)
+        if chunk is not None:
+            chunk['dirty'] = True
+    saved = autosave_state['saved']
+    for path in paths:
+        saved.pop(path, None)
+
+
+def autosave_now():
+    """Save the world settings, changed chunks and changed units (the
+    same way save does; see get_saved_data) on the autosave thread. Only
+    copying them happens on the calling thread, so the game does not
+    wait for files.
+
+    Returns False if there is no loaded world to save.
+    """
+    name = last_loaded_world_name
+    if name is None:
+        return False
+    _take_autosave_failures()
+    files_path = os.path.join(appdata_path, name)
+    if not os.path.isdir(files_path):
+        os.makedirs(files_path)
+    store, chunks = _take_dirty_chunks(files_path, snapshot=True)
+    _add_pending_chunks(chunks, 1)
+    saved = autosave_state['saved']
+    job = {}
+    job['world_path'] = os.path.join(files_path, "world.json")
+    job['world'] = None
+    data = trim_dict(world)
+    if data != saved.get(job['world_path']):
+        job['world'] = copy.deepcopy(data)
+        saved[job['world_path']] = job['world']
+    job['store'] = store
+    job['chunks'] = chunks
+    job['units'] = []
+    for unit_name, unit in units.items():
+        path = os.path.join(files_path, unit_name + ".json")
+        # Comparing is much faster than copying, so only copy changes:
+        data = get_saved_data(unit)
+        if data != saved.get(path):
+            data = copy.deepcopy(data)
+            saved[path] = data
+            job['units'].append((path, data))
+    if autosave_state['thread'] is None:
+        autosave_state['queue'] = queue.Queue()
+        thread = threading.Thread(target=_autosave_worker,
+                                  args=(autosave_state['queue'],))
+        thread.daemon = True
+        thread.start()
+        autosave_state['thread'] = thread
+    autosave_state['queue'].put(job)
+    return True
+
+
+def wait_for_autosave():
+    """Wait until the autosave thread has written everything queued."""
+    jobs = autosave_state['queue']
+    if jobs is not None:
+        jobs.join()
+    _take_autosave_failures()
+
+
+def update_autosave():
+    """Call autosave_now every 'autosave_sec' setting seconds (draw_frame
+    calls this; call it yourself if not using draw_frame).
+    """
+    _take_autosave_failures()
+    interval = settings['autosave_sec']
+    if (interval is None) or (interval <= 0):
+        return
+    now = time.monotonic()
+    if autosave_state['next_time'] is None:
+        autosave_state['next_time'] = now + interval
+    elif now >= autosave_state['next_time']:
+        autosave_state['next_time'] = now + interval
+        autosave_now()
+# endregion autosave
 
 
 def dump_internals():
@@ -0,0 +1,217 @@
+#!/usr/bin/env python
+"""Time the hot paths of mgep (offscreen, using SDL's dummy drivers) and
+save the results as JSON so they can be compared across commits.
+
+Run it like:
+python -m mgep.benchmark -o before.json
+(or mgep-cli --benchmark before.json)
+"""
+import argparse
+import json
+import os
+import platform
+import random
+import shutil
+import tempfile
+import time
+
+os.environ.setdefault('SDL_VIDEODRIVER', 'dummy')
+os.environ.setdefault('SDL_AUDIODRIVER', 'dummy')
+
+import pygame as pg
+
+import mgep
+from .command_line import load_default_assets
+
+WIN_SIZES = [(640, 480), (1280, 720), (1920, 1080)]
+SCALES = [1, 2, 3]
+UNIT_COUNTS = [1, 100, 1000, 5000]
+WORLD_NAME = "benchmark"
+WORLD_CHUNKS = 8
+"""the world benchmarks generate, save and load a WORLD_CHUNKS by
+WORLD_CHUNKS block of chunks (since load_world only streams the chunks
+near the origin)"""
+
+
+def time_calls(f, count, before=None):
+    """Call f count times and get timing stats in milliseconds.
+
+    Keyword arguments:
+    before -- if not None, call this before each call to f (not timed)
+    """
+    times = []
+    for i in range(count):
+        if before is not None:
+            before()
+        start = time.perf_counter()
+        f()
+        times.append((time.perf_counter() - start) * 1000.0)
+    times.sort()
+    return {
+        'count': count,
+        'mean_ms': sum(times) / count,
+        'median_ms': times[count // 2],
+        'min_ms': times[0],
+        'max_ms': times[-1],
+    }
+
+
+def _place_walkers(count):
+    """Replace all units with count units walking in random directions
+    (the first one is the player unit).
+    """
+    mgep.units.clear()
+    mgep.unit_cells.clear()
+    mgep.player_unit_name = None
+    directions = ['N', 'S', 'E', 'W']
+    for i in range(count):
+        name = "walker" + str(i)
+        mgep.place_character(
+            random.choice(['male', 'female']), name,
+            (random.randint(-25, 25), random.randint(-25, 25))
+        )
+        mgep.move_direction(name, random.choice(directions))
+
+
+def _stream_world_block():
+    """Load (or generate) every chunk of the WORLD_CHUNKS block."""
+    start = -(WORLD_CHUNKS // 2)
+    for chunk_row in range(start, start + WORLD_CHUNKS):
+        for chunk_col in range(start, start + WORLD_CHUNKS):
+            mgep._get_streamed_chunk((chunk_col, chunk_row))
+
+
+def _mark_chunks_dirty():
+    # (generated chunks are not saved unless changed, so make
+    # save_world write all of them):
+    for chunk in mgep.world['tmp']['chunks'].values():
+        chunk['dirty'] = True
+
+
+def bench_world(results, count):
+    path = os.path.join(mgep.appdata_path, WORLD_NAME)
+    shutil.rmtree(path, ignore_errors=True)
+
+    def generate():
+        mgep.load_world(WORLD_NAME, generate=True)
+        _stream_world_block()
+
+    def load():
+        mgep.load_world(WORLD_NAME)
+        _stream_world_block()
+
+    results['load_world_generate'] = time_calls(generate, count)
+    results['save_world'] = time_calls(mgep.save_world, count,
+                                       before=_mark_chunks_dirty)
+    results['load_world_saved'] = time_calls(load, count)
+
+    results['_recalculate_tops'] = time_calls(mgep._recalculate_tops,
+                                              count)
+
+
+def bench_physics(results, steps):
+    step_sec = mgep.settings['physics_step_sec']
+    for unit_count in UNIT_COUNTS:
+        _place_walkers(unit_count)
+        mgep.step_world(step_sec)  # warm up (place units on ground)
+        results['step_world.units=' + str(unit_count)] = time_calls(
+            lambda: mgep.step_world(step_sec),
+            steps
+        )
+
+
+def bench_draw(results, frames):
+    _place_walkers(1)
+    mgep.set_auto_step(False)  # only time drawing
+    for win_size in WIN_SIZES:
+        screen = pg.display.set_mode(win_size)
+        for scale in SCALES:
+            mgep.set_scale(scale)
+            mgep.move_camera_to(mgep.player_unit_name)
+            mgep.draw_frame(screen)  # warm up (caches and scale)
+            name = ("draw_frame." + str(win_size[0]) + "x" +
+                    str(win_size[1]) + ".scale=" + str(scale))
+            results[name] = time_calls(lambda: mgep.draw_frame(screen),
+                                       frames)
+    mgep.set_auto_step(True)
+
+
+def bench_picking(results, count):
+    screen = pg.display.set_mode(WIN_SIZES[0])
+    mgep.set_scale(SCALES[0])
+    _place_walkers(1)
+    mgep.move_camera_to(mgep.player_unit_name)
+    mgep.draw_frame(screen)
+    unit = mgep.units[mgep.player_unit_name]
+    pixels = [(random.randrange(WIN_SIZES[0][0]),
+               random.randrange(WIN_SIZES[0][1]))
+              for i in range(count)]
+    state = {'i': 0}
+
+    def pick():
+        mgep.vec3_from_vec2(pixels[state['i']], unit['pos'])
+        state['i'] += 1
+
+    results['vec3_from_vec2'] = time_calls(pick, count)
+
+
+def run(path, label=None, seed=0, repeat=20):
+    """Run every benchmark and save the results as JSON.
+
+    Sequential arguments:
+    path -- where to save the JSON results
+
+    Keyword arguments:
+    label -- a name to store with the results (such as a commit)
+    seed -- seed for random (so every run generates the same world)
+    repeat -- how many times to time each case (frames, steps, etc.)
+    """
+    random.seed(seed)
+    # keep the benchmark's world, units and settings out of the real
+    # profile (and use the default settings, so runs compare):
+    mgep.appdata_path = tempfile.mkdtemp(prefix="mgep-benchmark-")
+    mgep.settings_path = os.path.join(mgep.appdata_path,
+                                      "settings-mgep.json")
+    mgep.load_settings()
+    pg.init()
+    pg.display.set_mode(WIN_SIZES[0])
+    load_default_assets()
+    results = {}
+    bench_world(results, repeat)
+    bench_physics(results, repeat)
+    bench_draw(results, repeat)
+    bench_picking(results, repeat * 10)
+    shutil.rmtree(mgep.appdata_path, ignore_errors=True)
+    data = {
+        'label': label,
+        'time': time.strftime("%Y-%m-%dT%H:%M:%S"),
+        'python': platform.python_version(),
+        'pygame': pg.version.ver,
+        'platform': platform.platform(),
+        'seed': seed,
+        'repeat': repeat,
+        'world_chunks': WORLD_CHUNKS,
+        'results': results,
+    }
+    with open(path, "w") as outs:
+        json.dump(data, outs, indent=2, sort_keys=True)
+    print("saved benchmark results to " + path)
+    return data
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        prog="mgep.benchmark",
+        description="Time mgep's hot paths and save JSON results."
+    )
+    parser.add_argument('-o', '--output', default="mgep-benchmark.json")
+    parser.add_argument('--label', default=None,
+                        help="name stored with the results")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--repeat', type=int, default=20)
+    args = parser.parse_args()
+    run(args.output, label=args.label, seed=args.seed, repeat=args.repeat)
+
+
+if __name__ == "__main__":
+    main()
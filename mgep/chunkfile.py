@@ -0,0 +1,284 @@
+#!/usr/bin/env python
+"""Binary chunk storage for mgep worlds.
+
+A store is a directory containing:
+* chunks.dat -- chunk records, each starting at a SECTOR_SIZE boundary
+  and using one or more whole sectors: a little-endian uint32 length
+  then zlib-compressed data, where each of the chunk's stacks is a
+  varint (0 for no stack, otherwise 1 + the number of nodes) followed
+  by a varint palette index for each node.
+* palette.json -- a list of distinct nodes (dicts such as
+  {"what": "grass", "pose": "0"}); it only grows, so older records stay
+  valid.
+* chunks.idx -- INDEX_MAGIC, a uint32 count, then for each chunk an
+  int32 chunk column, int32 chunk row, uint32 first sector and uint32
+  sector count.
+
+Records are never overwritten in place: a changed chunk is written to
+free sectors, then the palette and index are replaced (atomically via
+rename), then the chunk's old sectors become free.
+"""
+import json
+import os
+import struct
+import zlib
+
+SECTOR_SIZE = 1024
+INDEX_MAGIC = b'MGEPCHK1'
+_INDEX_ENTRY = struct.Struct('<iiII')
+_LENGTH = struct.Struct('<I')
+
+
+def _replace_file(path, data):
+    """Write data (bytes) to path.tmp then rename it to path."""
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "wb") as outs:
+        outs.write(data)
+        outs.flush()
+        os.fsync(outs.fileno())
+    os.replace(tmp_path, path)
+
+
+def _put_varint(out, n):
+    while n > 0x7F:
+        out.append((n & 0x7F) | 0x80)
+        n >>= 7
+    out.append(n)
+
+
+def _get_varint(data, i):
+    """Get (value, next_i) from a varint in data starting at i."""
+    n = 0
+    shift = 0
+    while True:
+        b = data[i]
+        i += 1
+        n |= (b & 0x7F) << shift
+        if b < 0x80:
+            return n, i
+        shift += 7
+
+
+def open_store(dir_path, reset=False):
+    """Open (or, if not present or reset is True, start) a chunk store
+    in dir_path, and get it as a dict.
+    """
+    store = {}
+    store['path'] = dir_path
+    store['data_path'] = os.path.join(dir_path, "chunks.dat")
+    store['index_path'] = os.path.join(dir_path, "chunks.idx")
+    store['palette_path'] = os.path.join(dir_path, "palette.json")
+    store['index'] = {}  # chunk_loc: (first_sector, sector_count)
+    store['palette'] = []
+    store['palette_ids'] = {}  # palette key (see _node_key): index
+    store['palette_count'] = 0  # how many entries are saved
+    store['shared'] = []  # interned palette entries (see decode_stacks)
+    # store palette index by index in the palette given to encode_stacks:
+    store['palette_map'] = {}
+    store['sector_count'] = 0  # sectors in the data file
+    store['free'] = set()  # unused sectors before sector_count
+    if not os.path.isdir(dir_path):
+        os.makedirs(dir_path)
+    if reset:
+        for path in (store['index_path'], store['data_path'],
+                     store['palette_path']):
+            if os.path.isfile(path):
+                os.remove(path)
+        return store
+    if os.path.isfile(store['palette_path']):
+        with open(store['palette_path'], "r") as ins:
+            store['palette'] = json.load(ins)
+        for i in range(len(store['palette'])):
+            store['palette_ids'][_node_key(store['palette'][i])] = i
+        store['palette_count'] = len(store['palette'])
+    if os.path.isfile(store['index_path']):
+        with open(store['index_path'], "rb") as ins:
+            data = ins.read()
+        if data[:len(INDEX_MAGIC)] != INDEX_MAGIC:
+            raise ValueError("ERROR: " + store['index_path'] +
+                             " is not an mgep chunk index")
+        offset = len(INDEX_MAGIC)
+        count = _LENGTH.unpack_from(data, offset)[0]
+        offset += _LENGTH.size
+        for i in range(count):
+            cx, cz, sector, sectors = _INDEX_ENTRY.unpack_from(data,
+                                                               offset)
+            offset += _INDEX_ENTRY.size
+            store['index'][(cx, cz)] = (sector, sectors)
+    if os.path.isfile(store['data_path']):
+        size = os.path.getsize(store['data_path'])
+        store['sector_count'] = (size + SECTOR_SIZE - 1) // SECTOR_SIZE
+    store['free'] = set(range(store['sector_count']))
+    for sector, sectors in store['index'].values():
+        store['free'].difference_update(range(sector, sector + sectors))
+    return store
+
+
+def get_chunk_locs(store):
+    """Get a list of the (chunk_col, chunk_row) of every saved chunk."""
+    return list(store['index'])
+
+
+def _node_key(node):
+    return json.dumps(node, sort_keys=True)
+
+
+def encode_stacks(store, stacks, palette=None):
+    """Get a chunk record (without the length) as bytes, adding any new
+    kinds of nodes to the store's palette.
+
+    Keyword arguments:
+    palette -- if not None, each stack is a sequence of indexes into
+               this list of nodes instead of a list of nodes (the list
+               must only grow, since the store remembers which of its
+               own palette entries each index is)
+    """
+    palette_ids = store['palette_ids']
+    palette_map = store['palette_map']
+    out = bytearray()
+    for stack in stacks:
+        if stack is None:
+            out.append(0)
+            continue
+        _put_varint(out, len(stack) + 1)
+        for node in stack:
+            if palette is not None:
+                node_id = palette_map.get(node)
+                if node_id is not None:
+                    _put_varint(out, node_id)
+                    continue
+                palette_i = node
+                node = palette[palette_i]
+            key = _node_key(node)
+            node_id = palette_ids.get(key)
+            if node_id is None:
+                node_id = len(store['palette'])
+                store['palette'].append(dict(node))
+                palette_ids[key] = node_id
+            if palette is not None:
+                palette_map[palette_i] = node_id
+            _put_varint(out, node_id)
+    return zlib.compress(bytes(out))
+
+
+def decode_stacks(store, data, stack_count, intern=None):
+    """Get a list of stack_count stacks (each None or a list of new node
+    dicts) from a chunk record made by encode_stacks.
+
+    Keyword arguments:
+    intern -- if not None, call this with a copy of each palette entry
+              and use what it returns (such as a shared node, or an
+              index into another palette) for every node of that kind
+              instead of a new dict for every node
+    """
+    data = zlib.decompress(data)
+    palette = store['palette']
+    if intern is not None:
+        shared = store['shared']
+        while len(shared) < len(palette):
+            shared.append(intern(dict(palette[len(shared)])))
+    stacks = [None] * stack_count
+    i = 0
+    for si in range(stack_count):
+        n, i = _get_varint(data, i)
+        if n == 0:
+            continue
+        stack = []
+        for ni in range(n - 1):
+            node_id, i = _get_varint(data, i)
+            if intern is not None:
+                stack.append(shared[node_id])
+            else:
+                stack.append(dict(palette[node_id]))
+        stacks[si] = stack
+    return stacks
+
+
+def read_chunk(store, chunk_loc, stack_count, intern=None):
+    """Get the stacks of a saved chunk, or None if not saved (see
+    decode_stacks for intern).
+    """
+    entry = store['index'].get(chunk_loc)
+    if entry is None:
+        return None
+    with open(store['data_path'], "rb") as ins:
+        ins.seek(entry[0] * SECTOR_SIZE)
+        length = _LENGTH.unpack(ins.read(_LENGTH.size))[0]
+        data = ins.read(length)
+    return decode_stacks(store, data, stack_count, intern=intern)
+
+
+def _allocate(store, sectors):
+    """Get the first sector of a run of free sectors (or append)."""
+    free = store['free']
+    if sectors == 1:
+        if len(free) > 0:
+            sector = min(free)
+            free.discard(sector)
+            return sector
+    else:
+        run_start = None
+        run = 0
+        for sector in sorted(free):
+            if (run_start is not None) and (sector == run_start + run):
+                run += 1
+            else:
+                run_start = sector
+                run = 1
+            if run == sectors:
+                free.difference_update(range(run_start,
+                                             run_start + sectors))
+                return run_start
+    sector = store['sector_count']
+    store['sector_count'] += sectors
+    return sector
+
+
+def save_index(store):
+    """Replace the palette (if it has new entries) and the index."""
+    if len(store['palette']) != store['palette_count']:
+        _replace_file(store['palette_path'],
+                      json.dumps(store['palette']).encode('utf-8'))
+        store['palette_count'] = len(store['palette'])
+    data = bytearray(INDEX_MAGIC)
+    data += _LENGTH.pack(len(store['index']))
+    for chunk_loc, entry in store['index'].items():
+        data += _INDEX_ENTRY.pack(chunk_loc[0], chunk_loc[1],
+                                  entry[0], entry[1])
+    _replace_file(store['index_path'], bytes(data))
+
+
+def write_chunks(store, chunks, palette=None):
+    """Save chunks, then save the index.
+
+    Sequential arguments:
+    chunks -- a list of (chunk_loc, stacks) tuples
+
+    Keyword arguments:
+    palette -- see encode_stacks
+    """
+    if len(chunks) < 1:
+        return
+    old_entries = []
+    mode = "r+b"
+    if not os.path.isfile(store['data_path']):
+        mode = "w+b"
+    with open(store['data_path'], mode) as outs:
+        for chunk_loc, stacks in chunks:
+            data = encode_stacks(store, stacks, palette=palette)
+            record = _LENGTH.pack(len(data)) + data
+            sectors = (len(record) + SECTOR_SIZE - 1) // SECTOR_SIZE
+            sector = _allocate(store, sectors)
+            outs.seek(sector * SECTOR_SIZE)
+            outs.write(record)
+            # pad so the file size is a whole number of sectors:
+            outs.write(bytes(sectors * SECTOR_SIZE - len(record)))
+            old_entry = store['index'].get(chunk_loc)
+            if old_entry is not None:
+                old_entries.append(old_entry)
+            store['index'][chunk_loc] = (sector, sectors)
+        outs.flush()
+        os.fsync(outs.fileno())
+    save_index(store)
+    for sector, sectors in old_entries:
+        store['free'].update(range(sector, sector + sectors))
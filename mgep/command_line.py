@@ -1,7 +1,100 @@
 #!/usr/bin/env python
 
+import argparse
+import random
+import tempfile
+import time
+
+import mgep
 from . import *
 
+MGEP_PATH = os.path.dirname(os.path.abspath(__file__))
+
+
+def load_default_assets():
+    """Load the materials and characters used by example-sandbox.pyw
+    (from the mgep package directory).
+    """
+    load_tileset(
+        os.path.join(MGEP_PATH, "collections", "misc",
+                     "underworld_load-outdoor-32x32.png"),
+        8, 8
+    )
+    load_material('bedrock', 7, 2, native=False)
+    load_material('dirt', 1, 2)
+    load_material('grass', 1, 3)
+    load_material('grass', 2, 3)
+    load_material('grass', 3, 3)
+    load_material('sand', 1, 4)
+    load_tileset(os.path.join(MGEP_PATH, "sprites", "Hyptosis",
+                              "people.png"), 4, 8)
+    load_character_3x4('male', 1, 1)
+    load_character_3x4('female', 1, 5)
+
+
+def run_headless(ticks, world_name, unit_count, seed=0):
+    """Load or generate a world without a display, place walking units,
+    run ticks, then print the timing. The world is kept in a temporary
+    folder with the default settings, so your own settings, worlds and
+    units are not used.
+
+    Keyword arguments:
+    seed -- seed for random (so generated worlds and unit movement are
+            the same every run)
+    """
+    random.seed(seed)
+    # keep the simulation's world, units and settings out of the real
+    # profile (and use the default settings, so runs compare):
+    mgep.appdata_path = tempfile.mkdtemp(prefix="mgep-headless-")
+    mgep.settings_path = os.path.join(mgep.appdata_path,
+                                      "settings-mgep.json")
+    mgep.load_settings()
+    init_headless()
+    load_default_assets()
+    load_world(world_name, generate=True)
+    directions = ['N', 'S', 'E', 'W']
+    for i in range(unit_count):
+        name = "npc" + str(i)
+        place_character(random.choice(['male', 'female']), name,
+                        (random.randint(-20, 20), random.randint(-20, 20)),
+                        load_saved=False)
+        move_direction(name, random.choice(directions))
+    start = time.perf_counter()
+    steps = run_ticks(ticks)
+    elapsed = time.perf_counter() - start
+    print("ticks: " + str(ticks))
+    print("steps: " + str(steps))
+    print("units: " + str(unit_count))
+    print("seconds: " + fmt_f(elapsed, places=4))
+    if ticks > 0:
+        print("ms per tick: " + fmt_f(elapsed * 1000.0 / ticks, places=4))
+    return elapsed
+
+
 def main():
-    print("The mgep command line interface just shows internals...")
-    dump_internals()
+    parser = argparse.ArgumentParser(
+        prog="mgep-cli",
+        description="Show mgep internals, or run a headless simulation."
+    )
+    parser.add_argument('--ticks', type=int, default=None,
+                        help="run this many physics steps without a"
+                             " display and report the timing")
+    parser.add_argument('--world', default="headless",
+                        help="world name (generated in a temporary"
+                             " folder)")
+    parser.add_argument('--units', type=int, default=10,
+                        help="how many walking units to place")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--benchmark', metavar="PATH", default=None,
+                        help="time draw_frame, physics, picking and"
+                             " world load/save, and save JSON results")
+    args = parser.parse_args()
+    if args.benchmark is not None:
+        from . import benchmark
+        benchmark.run(args.benchmark, seed=args.seed)
+        return
+    if args.ticks is None:
+        print("The mgep command line interface just shows internals...")
+        dump_internals()
+        return
+    run_headless(args.ticks, args.world, args.units, seed=args.seed)
@@ -20,3 +20,523 @@ class TestMgep(TestCase):
         self.assertEqual(byte_of_f(0.0), 128)
         self.assertEqual(byte_of_f(-1.0), 0)
         self.assertEqual(byte_of_f(1.0), 255)
+
+    def test_chunked_stacks(self):
+        self.assertEqual(get_chunk_loc(-1, 16), (-1, 1))
+        self.assertEqual(get_loc_from_key('-3,7'), (-3, 7))
+        stack = [{'what': 'dirt'}]
+        set_stack_at(-17, 33, stack)
+        self.assertEqual(get_stack_at(-17, 33), stack)
+        self.assertEqual(get_stack('-17,33'), stack)
+        self.assertIn(((-17, 33), stack), list(iterate_stacks()))
+        set_stack_at(-17, 33, None)
+        self.assertIsNone(get_stack_at(-17, 33))
+
+    def test_get_percentile(self):
+        values = list(range(1, 101))
+        self.assertEqual(get_percentile(values, 50), 50)
+        self.assertEqual(get_percentile(values, 99), 99)
+        self.assertEqual(get_percentile(values, 100), 100)
+        self.assertEqual(get_percentile([7], 95), 7)
+        self.assertIsNone(get_percentile([], 50))
+
+    def test_chunkfile_round_trip(self):
+        import tempfile
+        path = tempfile.mkdtemp()
+        store = chunkfile.open_store(path)
+        stacks = [None] * 256
+        stacks[0] = [{'what': 'dirt'}, {'what': 'grass', 'pose': '0'}]
+        stacks[255] = [{'what': 'dirt'}] * 200
+        chunkfile.write_chunks(store, [((-1, 2), stacks)])
+        stacks[0] = []
+        chunkfile.write_chunks(store, [((-1, 2), stacks)])
+        store = chunkfile.open_store(path)
+        self.assertEqual(chunkfile.get_chunk_locs(store), [(-1, 2)])
+        self.assertEqual(chunkfile.read_chunk(store, (-1, 2), 256),
+                         stacks)
+        self.assertEqual(len(store['palette']), 2)
+        import shutil
+        shutil.rmtree(path)
+
+    def test_generate_heights_same_without_numpy(self):
+        import mgep
+        if mgep.np is None:
+            self.skipTest("NumPy is not installed")
+        for seed in (99, 4294967291):
+            got = generate_heights(-20, 7, 24, 9, seed=seed)
+            np_module = mgep.np
+            mgep.np = None
+            try:
+                expected = generate_heights(-20, 7, 24, 9, seed=seed)
+            finally:
+                mgep.np = np_module
+            for got_values, expected_values in zip(got, expected):
+                self.assertEqual(got_values.tolist(), expected_values)
+
+    def test_stack_heights(self):
+        import mgep
+        set_stack_at(40, 40, [{'what': 'dirt'}] * 30)
+        set_stack_at(41, 40, [{'what': 'dirt'}] * 30)
+        self.assertEqual(mgep.stack_max, 30)
+        self.assertEqual(get_tallest_stack_keys(), {(40, 40), (41, 40)})
+        pop_node((40, 40))
+        self.assertEqual(get_tallest_stack_keys(), {(41, 40)})
+        pop_node((41, 40))
+        self.assertEqual(mgep.stack_max, 29)
+        push_node((41, 40), {'what': 'dirt'})
+        self.assertEqual(get_tallest_stack_keys(), {(41, 40)})
+        self.assertEqual(get_chunk(get_chunk_loc(41, 40))['max_height'],
+                         30)
+        set_stack_at(40, 40, None)
+        set_stack_at(41, 40, None)
+        self.assertNotIn((41, 40), get_tallest_stack_keys())
+
+    def test_ground_height(self):
+        import mgep
+        set_stack_at(-5, 3, [{'what': 'dirt'}, {'what': 'dirt'}])
+        self.assertEqual(ground_height(-5.2, 2.7), 2.0)
+        push_node((-5, 3), {'what': 'dirt'})
+        self.assertEqual(ground_height(-5.0, 3.0), 3.0)
+        self.assertEqual(get_stack_height(-5, 3), 3)
+        set_stack_at(-5, 3, None)
+        self.assertEqual(ground_height(-5.0, 3.0), mgep.nothing_y)
+        self.assertEqual(get_stack_height(-5, 3), -1)
+
+    def _make_batch_critters(self):
+        """Make a test world with a wall and get 12 unit dicts of a fake
+        material for comparing _step_units_batch and _step_unit.
+        """
+        import mgep
+
+        class Anim:
+            def iter(self):
+                pass
+
+            def advance(self):
+                pass
+
+        sprites = {}
+        for mode in ('idle', 'walk'):
+            for cardinal in ('E', 'N', 'W', 'S'):
+                sprites[mode + '.' + cardinal] = Anim()
+        materials['batch_critter'] = {'tmp': {'sprites': sprites}}
+        mgep.world['gravity'] = 9.8
+        for row in range(-8, 9):
+            for col in range(-8, 9):
+                # a wall that is too high to climb at col 2:
+                height = 5 if col == 2 else 2
+                set_stack_at(col, row, [{'what': 'dirt'}] * height)
+        start = {}
+        for i in range(12):
+            start['critter' + str(i)] = {
+                'what': 'batch_critter',
+                'pos': (float(i % 4 - 2), 4.0, float(i // 4 - 1)),
+                'pose': 'idle.S',
+                'animate': True,
+                'yaw_deg': -90.0,
+                'mps_vec3': [0.0, 0.0, 0.0],
+                'auto_climb_max': 0.2,
+                'move_in_air': False,
+                'tmp': {'move_multipliers': [(i % 3) - 1.0, 0.0,
+                                             (i % 2) * 0.5]},
+            }
+        return start
+
+    def test_step_units_batch_same_as_step_unit(self):
+        import copy
+        import mgep
+        if mgep.np is None:
+            self.skipTest("NumPy is not installed")
+        start = self._make_batch_critters()
+        results = []
+        for batch in (False, True):
+            mgep.units.clear()
+            mgep.units.update(copy.deepcopy(start))
+            for name, unit in mgep.units.items():
+                unit['tmp']['name'] = name
+            for step in range(120):
+                if batch:
+                    mgep._step_units_batch(1.0 / 60.0)
+                else:
+                    for name, unit in mgep.units.items():
+                        mgep._step_unit(name, unit, 1.0 / 60.0)
+            results.append({name: (unit['pos'], list(unit['mps_vec3']),
+                                   unit['yaw_deg'], unit['pose'])
+                            for name, unit in mgep.units.items()})
+        mgep.units.clear()
+        mgep.unit_cells.clear()
+        self.assertEqual(results[0], results[1])
+        # the critters walking east stopped at the wall:
+        self.assertGreater(results[1]['critter2'][0][0], 1.0)
+        self.assertLess(results[1]['critter2'][0][0], 1.5)
+
+    def test_materials_change_frees_terrain_layers(self):
+        import mgep
+        set_stack_at(30, 30, [{'what': 'dirt'}])
+        chunk = get_chunk(get_chunk_loc(30, 30))
+        # (as if drawn before materials loaded; see _get_terrain_strip)
+        chunk['layer'] = {'size': (1, 1), 'strips': [None] * CHUNK_SIZE}
+        mgep.terrain_layer_chunks.add(chunk['loc'])
+        mgep._reset_palette_anims()
+        self.assertIsNone(chunk['layer'])
+        self.assertEqual(len(mgep.terrain_layer_chunks), 0)
+        set_stack_at(30, 30, None)
+
+    def test_intern_node(self):
+        set_stack_at(20, 20, [{'what': 'dirt'}, {'what': 'sand'}])
+        set_stack_at(21, 20, [{'what': 'dirt'}])
+        push_node((21, 20), {'what': 'sand'})
+        self.assertIs(get_stack((20, 20))[0], get_stack((21, 20))[0])
+        self.assertIs(get_stack((20, 20))[1], get_stack((21, 20))[1])
+        node = pop_node((21, 20))
+        node['pose'] = '1'  # popped nodes are copies, so this is ok
+        self.assertEqual(get_stack((20, 20))[1], {'what': 'sand'})
+        set_stack_at(20, 20, None)
+        set_stack_at(21, 20, None)
+
+    def test_stack_view(self):
+        import mgep
+        set_stack_at(22, 20, [{'what': 'dirt'}])
+        stack = get_stack((22, 20))
+        stack.append({'what': 'sand'})  # (changes the world)
+        self.assertEqual(get_stack_at(22, 20),
+                         [{'what': 'dirt'}, {'what': 'sand'}])
+        self.assertEqual(get_stack_height(22, 20), 2)
+        self.assertEqual(stack.pop(), {'what': 'sand'})
+        self.assertEqual(len(get_stack_ids_at(22, 20)), 1)
+        set_stack_at(22, 20, None)
+        palette_len = len(mgep.node_palette)
+        for i in range(3):
+            # (a list value is unhashable, so it is keyed by JSON)
+            get_node_id({'what': 'sign', 'lines': ["hi"]})
+        self.assertEqual(len(mgep.node_palette), palette_len + 1)
+
+    def test_text_cache(self):
+        pg.font.init()
+        old_size = settings['text_cache_size']
+        settings['text_cache_size'] = 2
+        self.assertIsNone(get_text_surface("a", (255, 255, 255),
+                                           render=False))
+        surf = get_text_surface("a", (255, 255, 255), render=False)
+        self.assertIsNotNone(surf)
+        self.assertIs(get_text_surface("a", (255, 255, 255)), surf)
+        get_text_surface("b", (255, 255, 255))
+        get_text_surface("c", (255, 255, 255))  # evicts "a"
+        self.assertEqual(len(text_cache), 2)
+        self.assertIsNot(get_text_surface("a", (255, 255, 255)), surf)
+        settings['text_cache_size'] = old_size
+
+    def test_glyph_line(self):
+        import mgep
+        pg.font.init()
+        ensure_default_font()
+        line = "frame p50 12.34"
+        mgep._push_glyph_line(line, (255, 255, 255), 100, 0, right=True)
+        dests = [dest for surf, dest in text_blits]
+        del text_blits[:]
+        # a right-aligned line ends where the whole line would:
+        self.assertEqual(dests[0][0],
+                         100 - mgep.default_font.size(line)[0])
+        advances = [metrics[4]
+                    for metrics in mgep.default_font.metrics(line)]
+        self.assertEqual(dests[-1][0], dests[0][0] + sum(advances[:-1]))
+
+    def test_widget_grid(self):
+        pg.font.init()
+        screen = pg.Surface((200, 100))
+        a = add_widget((0, 0), (.5, .5), text="a")
+        b = add_widget((.25, 0), (.5, 1))
+        self.assertIs(get_font(), get_font())
+        self.assertEqual(get_widgets_at(screen, (60, 10)), [a, b])
+        self.assertEqual(get_widgets_at(screen, (10, 10)), [a])
+        self.assertEqual(get_widgets_at(screen, (140, 90)), [b])
+        self.assertEqual(get_widgets_at(screen, (160, 10)), [])
+        screen = pg.Surface((400, 100))  # the layout follows the size
+        self.assertEqual(get_widgets_at(screen, (160, 90)), [b])
+        self.assertEqual(get_widgets_at(screen, (350, 90)), [])
+        remove_widget(a)
+        remove_widget(b)
+        self.assertEqual(get_widgets_at(screen, (160, 90)), [])
+        image = pg.Surface((4, 4))
+        image.fill((255, 0, 0))
+        c = add_widget((.25, 0), (.5, 1), surface=image,
+                       border_color=(0, 255, 0), auto_add=False)
+        render_widget(screen, c)  # the border is drawn over the surface
+        self.assertEqual(tuple(screen.get_at((100, 0)))[:3], (0, 255, 0))
+        self.assertEqual(tuple(screen.get_at((200, 50)))[:3], (255, 0, 0))
+
+    def test_inventory_version(self):
+        import mgep
+        units['inv_test'] = {}
+        version = mgep.inventory_version
+        push_unit_item('inv_test', {'what': 'dirt'})
+        self.assertGreater(mgep.inventory_version, version)
+        version = mgep.inventory_version
+        self.assertIsNotNone(pop_unit_what_item('inv_test', 'dirt'))
+        self.assertGreater(mgep.inventory_version, version)
+        version = mgep.inventory_version
+        self.assertIsNone(pop_unit_what_item('inv_test', 'dirt'))
+        self.assertEqual(mgep.inventory_version, version)
+        set_unit_value('inv_test', 'stacks', {'dirt': 3})
+        self.assertGreater(mgep.inventory_version, version)
+        version = mgep.inventory_version
+        set_unit_value('inv_test', 'reach', 2.0)
+        self.assertEqual(mgep.inventory_version, version)
+        del units['inv_test']
+
+    def test_indexed_inventory(self):
+        units['inv_test'] = {}
+        set_unstackable('inv_tool', True)
+        for i in range(3):
+            push_unit_item('inv_test', {'what': 'dirt'})
+        push_unit_item('inv_test', {'what': 'sand'})
+        push_unit_item('inv_test', {'what': 'inv_tool', 'pose': '0'})
+        self.assertEqual(get_unit_item_count('inv_test', 'dirt'), 3)
+        self.assertEqual(get_all_slots_count('inv_test'), 3)
+        # items come first, then material slots (as drawn):
+        self.assertEqual(get_unit_slot_what('inv_test', 0), 'inv_tool')
+        self.assertEqual(get_unit_slot_what('inv_test', 2), 'sand')
+        self.assertEqual(select_unit_slot('inv_test', 5), 2)
+        self.assertEqual(get_what_unit_wielding('inv_test'), 'sand')
+        # an unstackable item is found by what, not just the last one:
+        item = pop_unit_what_item('inv_test', 'inv_tool')
+        self.assertEqual(item, {'what': 'inv_tool', 'pose': '0'})
+        self.assertIsNone(pop_unit_what_item('inv_test', 'inv_tool'))
+        self.assertEqual(get_what_unit_wielding('inv_test'), 'sand')
+        data = pack_inventory(units['inv_test'])
+        self.assertEqual(data['slots'], [['dirt', 3], ['sand', 1]])
+        unpack_inventory(data)
+        self.assertEqual(data['material_slots'], ['dirt', 'sand'])
+        self.assertEqual(data['stacks'], {'dirt': 3, 'sand': 1})
+        del units['inv_test']
+
+    def test_region_edits(self):
+        import mgep
+        clear_chunks()
+        set_stack_at(30, 30, [{'what': 'dirt'}])
+        self.assertEqual(fill_region((29, 29), (31, 30), {'what': 'sand'},
+                                     3), 6)
+        self.assertEqual(get_stack_height(30, 30), 3)
+        self.assertEqual(get_stack((30, 30))[0], {'what': 'dirt'})
+        self.assertEqual(mgep.stack_heights, {3: 6})
+        self.assertEqual(replace_in_region((29, 29), (29, 30), 'sand',
+                                           {'what': 'dirt'}), 2)
+        self.assertEqual(get_stack((29, 29))[2], {'what': 'dirt'})
+        region = copy_region((29, 29), (30, 29))
+        self.assertEqual(clear_region((29, 29), (31, 30)), 6)
+        self.assertEqual(mgep.stack_max, 1)
+        self.assertEqual(paste_region(region, (40, 40)), 2)
+        self.assertEqual(get_stack((40, 40)),
+                         [{'what': 'dirt'}, {'what': 'dirt'},
+                          {'what': 'dirt'}])
+        self.assertEqual(mgep.stack_max, 3)
+        self.assertEqual(clear_region((29, 29), (41, 41), bottom=0), 8)
+        self.assertEqual(mgep.stack_max, 0)
+        self.assertEqual(mgep.stack_heights, {})
+
+    def test_wielding_without_selected_slot(self):
+        units['inv_test'] = {'tmp': {}}
+        self.assertIsNone(get_what_unit_wielding('inv_test'))
+        self.assertIsNone(pop_unit_item('inv_test'))
+        self.assertEqual(units['inv_test']['selected_slot'], 0)
+        units['inv_test'] = {'tmp': {}, 'material_slots': ['dirt'],
+                             'stacks': {'dirt': 2}}
+        self.assertEqual(get_what_unit_wielding('inv_test'), 'dirt')
+        data = get_saved_data(units['inv_test'])
+        self.assertNotIn('tmp', data)
+        self.assertEqual(data['slots'], [['dirt', 2]])
+        del units['inv_test']
+
+    def test_item_replaced_in_place(self):
+        set_unstackable('tool', True)
+        set_unstackable('gem', True)
+        units['inv_test'] = {'tmp': {}}
+        push_unit_item('inv_test', {'what': 'tool'})
+        units['inv_test']['items'][0] = {'what': 'gem'}  # (same length)
+        self.assertIsNone(pop_unit_what_item('inv_test', 'tool'))
+        self.assertEqual(pop_unit_what_item('inv_test', 'gem'),
+                         {'what': 'gem'})
+        self.assertEqual(units['inv_test']['items'], [])
+        del units['inv_test']
+
+    def test_save_only_changed_chunks(self):
+        import mgep
+        import shutil
+        import tempfile
+        old_path = mgep.appdata_path
+        old_tileset_path = mgep.last_loaded_path
+        mgep.appdata_path = tempfile.mkdtemp()
+        mgep.last_loaded_path = "test"  # (no tileset is drawn)
+        try:
+            load_world("save_test", generate=True)
+            push_node((0, 0), {'what': 'dirt'})
+            save_world()
+            store = mgep.world['tmp']['chunk_store']
+            # generated chunks that did not change are not saved:
+            self.assertEqual(chunkfile.get_chunk_locs(store), [(0, 0)])
+            save_world("save_test2")  # (save as copies every chunk)
+            store = mgep.world['tmp']['chunk_store']
+            self.assertGreater(len(chunkfile.get_chunk_locs(store)), 1)
+        finally:
+            shutil.rmtree(mgep.appdata_path)
+            mgep.appdata_path = old_path
+            mgep.last_loaded_path = old_tileset_path
+            mgep.last_loaded_world_name = None
+            clear_chunks()
+
+    def test_evict_chunks_of_new_world(self):
+        import mgep
+        import os
+        import shutil
+        import tempfile
+        old_path = mgep.appdata_path
+        old_tileset_path = mgep.last_loaded_path
+        old_max = mgep.settings['max_loaded_chunks']
+        old_area = mgep.stream_state['draw_area']
+        old_world = mgep.world
+        mgep.appdata_path = tempfile.mkdtemp()
+        mgep.last_loaded_path = "test"  # (no tileset is drawn)
+        world_path = os.path.join(mgep.appdata_path, "evict_test",
+                                  "world.json")
+        try:
+            load_world("evict_test", generate=True)
+            self.assertFalse(os.path.isfile(world_path))
+            push_node((0, 0), {'what': 'dirt'})
+            mgep.settings['max_loaded_chunks'] = 30
+            # chunks draw_frame draws stay loaded even if far away:
+            mgep.stream_state['draw_area'] = (200, 200, 210, 210)
+            stream_chunks_near([(1000, 1000)])
+            self.assertIsNone(get_chunk((0, 0)))
+            self.assertIsNotNone(get_chunk((200 >> CHUNK_SHIFT,
+                                            200 >> CHUNK_SHIFT)))
+            # so the saved chunk is not next to chunks from another seed:
+            self.assertTrue(os.path.isfile(world_path))
+        finally:
+            shutil.rmtree(mgep.appdata_path)
+            mgep.appdata_path = old_path
+            mgep.last_loaded_path = old_tileset_path
+            mgep.last_loaded_world_name = None
+            mgep.settings['max_loaded_chunks'] = old_max
+            mgep.stream_state['draw_area'] = old_area
+            mgep.world = old_world
+            clear_chunks()
+
+    def test_autosave_changed_units(self):
+        import mgep
+        import os
+        import shutil
+        import tempfile
+        old_path = mgep.appdata_path
+        old_tileset_path = mgep.last_loaded_path
+        old_world = mgep.world
+        mgep.appdata_path = tempfile.mkdtemp()
+        mgep.last_loaded_path = "test"  # (no tileset is drawn)
+        saved = mgep.autosave_state['saved']
+        try:
+            load_world("autosave_test", generate=True)
+            units['auto_a'] = {'pos': (0.0, 0.0, 0.0), 'tmp': {}}
+            units['auto_b'] = {'pos': (1.0, 0.0, 0.0), 'tmp': {}}
+            path_a = os.path.join(mgep.appdata_path, "autosave_test",
+                                  "auto_a.json")
+            path_b = os.path.join(mgep.appdata_path, "autosave_test",
+                                  "auto_b.json")
+            autosave_now()
+            wait_for_autosave()
+            data_a = saved[path_a]
+            data_b = saved[path_b]
+            units['auto_b']['pos'] = (2.0, 0.0, 0.0)
+            autosave_now()
+            wait_for_autosave()
+            self.assertIs(saved[path_a], data_a)  # (not copied again)
+            self.assertIsNot(saved[path_b], data_b)
+            # If writing fails, the main thread marks the chunk dirty:
+            push_node((0, 0), {'what': 'dirt'})
+            units['no_dir/auto_c'] = {'tmp': {}}
+            autosave_now()
+            self.assertFalse(get_chunk((0, 0))['dirty'])
+            wait_for_autosave()
+            self.assertTrue(get_chunk((0, 0))['dirty'])
+        finally:
+            for name in ('auto_a', 'auto_b', 'no_dir/auto_c'):
+                units.pop(name, None)
+            shutil.rmtree(mgep.appdata_path)
+            mgep.appdata_path = old_path
+            mgep.last_loaded_path = old_tileset_path
+            mgep.last_loaded_world_name = None
+            mgep.world = old_world
+            clear_chunks()
+
+    def test_step_units_batch_after_teleport(self):
+        import copy
+        import mgep
+        if mgep.np is None:
+            self.skipTest("NumPy is not installed")
+        start = self._make_batch_critters()
+        results = []
+        for batch in (False, True):
+            mgep.units.clear()
+            mgep.units.update(copy.deepcopy(start))
+            for name, unit in mgep.units.items():
+                unit['tmp']['name'] = name
+            for step in range(61):
+                if step == 60:
+                    # change units between steps like game code can:
+                    # (critter4 and critter10 are standing still, and
+                    # critter5 is walking)
+                    teleport_unit(mgep.units['critter4'], (-5.0, 2.0, 3.0))
+                    mgep.units['critter10']['pos'] = (4.0, 2.0, -4.0)
+                    teleport_unit(mgep.units['critter5'], (0.0, 5.0, 0.0))
+                    mgep.units['critter5']['tmp']['at_edge'] = True
+                    mgep.units['critter3']['pose'] = 'idle.N'
+                if batch:
+                    mgep._step_units_batch(1.0 / 60.0)
+                else:
+                    for name, unit in mgep.units.items():
+                        unit['tmp']['prev_pos'] = unit['pos']
+                        mgep._step_unit(name, unit, 1.0 / 60.0)
+            mgep._detach_units()
+            results.append({name: (unit['pos'], list(unit['mps_vec3']),
+                                   unit['yaw_deg'], unit['pose'],
+                                   unit['tmp']['prev_pos'],
+                                   unit['tmp'].get('at_edge') is True,
+                                   unit['tmp'].get('moved_since_advance'))
+                            for name, unit in mgep.units.items()})
+        mgep.units.clear()
+        mgep.unit_cells.clear()
+        self.assertEqual(results[0], results[1])
+
+    def test_unit_view(self):
+        import copy
+        import mgep
+        if mgep.np is None:
+            self.skipTest("NumPy is not installed")
+        start = self._make_batch_critters()
+        mgep.units.clear()
+        for name, unit in start.items():
+            unit['tmp']['name'] = name
+            mgep.units[name] = mgep.UnitDict(unit)
+        unit = mgep.units['critter0']
+        mgep._step_units_batch(1.0 / 60.0)
+        self.assertIs(type(unit), mgep.UnitView)
+        self.assertIs(mgep.units['critter0'], unit)  # (same dict)
+        arrays = mgep.unit_arrays['pos']
+        unit['pos'] = (1.5, 6.0, 0.5)  # (sets the array)
+        self.assertEqual(unit['pos'], (1.5, 6.0, 0.5))
+        unit['mps_vec3'][1] = 2.0  # (changes the array in place)
+        mgep._step_units_batch(1.0 / 60.0)
+        self.assertIs(mgep.unit_arrays['pos'], arrays)  # not gathered
+        self.assertGreater(unit['pos'][1], 6.0)
+        teleport_unit(unit, (-1.0, 4.0, 0.0))
+        self.assertEqual(get_unit_render_pos(unit), unit['pos'])
+        saved = copy.deepcopy(unit)
+        self.assertIs(type(saved), dict)
+        self.assertEqual(saved['pos'], unit['pos'])
+        self.assertEqual(saved['mps_vec3'], [0.0, 0.0, 0.0])
+        del mgep.units['critter1']  # (the arrays are gathered again)
+        mgep._step_units_batch(1.0 / 60.0)
+        self.assertIsNot(mgep.unit_arrays['pos'], arrays)
+        mgep._detach_units()
+        self.assertIs(type(unit), mgep.UnitDict)
+        self.assertEqual(type(unit['mps_vec3']), list)
+        mgep.units.clear()
+        mgep.unit_cells.clear()